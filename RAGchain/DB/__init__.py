@@ -1,2 +1,3 @@
 from .pickle_db import PickleDB
 from .mongo_db import MongoDB
+from .sqlite_db import SQLiteDB
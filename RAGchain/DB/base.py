@@ -1,9 +1,10 @@
 from abc import ABC, abstractmethod
-from typing import List, Union, Optional
+from typing import Callable, List, Union, Optional
 from uuid import UUID
 
-from RAGchain.schema import Passage
+from RAGchain.schema import Passage, LazyPassage
 from RAGchain.schema.db_origin import DBOrigin
+from RAGchain.utils.executor import run_in_thread
 
 
 class BaseDB(ABC):
@@ -30,6 +31,14 @@ class BaseDB(ABC):
         """Abstract method for loading existed database."""
         pass
 
+    def load_if_changed(self):
+        """
+        Load the database only when it is not loaded yet or the underlying store changed since the last load.
+        Retrievals call this before every fetch, so override it when load is expensive.
+        Default implementation always loads.
+        """
+        self.load()
+
     @abstractmethod
     def create_or_load(self, *args, **kwargs):
         """Abstract method for creating a new database or loading existing database."""
@@ -41,8 +50,11 @@ class BaseDB(ABC):
         pass
 
     @abstractmethod
-    def fetch(self, ids: List[UUID]) -> List[Passage]:
-        """Abstract method for fetching passages from the database based on their passage IDs."""
+    def fetch(self, ids: List[UUID], fields: Optional[List[str]] = None) -> List[Union[Passage, LazyPassage]]:
+        """
+        Abstract method for fetching passages from the database based on their passage IDs.
+        When fields is given, return LazyPassage which has only id and the fields.
+        """
         pass
 
     @abstractmethod
@@ -50,8 +62,9 @@ class BaseDB(ABC):
                id: Optional[List[Union[UUID, str]]] = None,
                content: Optional[List[str]] = None,
                filepath: Optional[List[str]] = None,
+               fields: Optional[List[str]] = None,
                **kwargs
-               ) -> List[Passage]:
+               ) -> List[Union[Passage, LazyPassage]]:
         """
             Abstract method for search Passage from DB using filter Dict.
             This function can search Passage using 'id', 'content', 'filepath' and 'metadata_etc'.
@@ -62,10 +75,46 @@ class BaseDB(ABC):
                 id (Optional[List[Union[UUID, str]]]): List of Passage ID to search.
                 content (Optional[List[str]]): List of Passage content to search.
                 filepath (Optional[List[str]]): List of Passage filepath to search.
+                fields (Optional[List[str]]): Passage fields to return. If given, return LazyPassage
+                    which has only id and the fields. Use empty list to get ids only.
                 **kwargs: Additional metadata to search.
         """
         pass
 
+    async def afetch(self, ids: List[Union[UUID, str]], fields: Optional[List[str]] = None) -> List[
+        Union[Passage, LazyPassage]]:
+        """
+        Async version of fetch. Default implementation runs fetch at a thread.
+        Override it when the database has a native async client.
+        """
+        return await run_in_thread(self.fetch, ids, fields=fields)
+
+    async def asearch(self,
+                      id: Optional[List[Union[UUID, str]]] = None,
+                      content: Optional[List[str]] = None,
+                      filepath: Optional[List[str]] = None,
+                      fields: Optional[List[str]] = None,
+                      **kwargs
+                      ) -> List[Union[Passage, LazyPassage]]:
+        """
+        Async version of search. Default implementation runs search at a thread.
+        Override it when the database has a native async client.
+        """
+        return await run_in_thread(self.search, id=id, content=content, filepath=filepath, fields=fields, **kwargs)
+
+    def _lazy_loader(self, passage_id: Union[UUID, str]) -> Callable[[], Passage]:
+        """
+        Get loader of LazyPassage, which fetches the full passage of the id.
+        The passage can be deleted after it is projected, so the loader raises KeyError when it is not found.
+        """
+        def load() -> Passage:
+            passages = self.fetch([passage_id])
+            if len(passages) == 0:
+                raise KeyError(f'Passage {passage_id} does not exist at {self.db_type}')
+            return passages[0]
+
+        return load
+
     @abstractmethod
     def get_db_origin(self) -> DBOrigin:
         """DBOrigin: Abstract method for retrieving DBOrigin of the database."""
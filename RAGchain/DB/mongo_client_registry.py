@@ -0,0 +1,88 @@
+import asyncio
+import logging
+import os
+import threading
+import weakref
+from typing import Dict
+
+import pymongo
+
+logger = logging.getLogger(__name__)
+
+
+class MongoClientRegistry:
+    """
+    MongoClientRegistry keeps one MongoClient for each mongo url in a process.
+    MongoClient has its own connection pool and is thread-safe, so every MongoDB instance shares it
+    instead of opening new connections.
+    Clients are keyed by mongo url only, so MongoDB made from its db origin, which has no client options,
+    shares the client of the MongoDB made with client options.
+    Client options are applied when the client of the url is made, and later options of the url are ignored.
+    MongoClient must not be shared across forked processes, so clients are kept for each process id.
+    Async clients of motor are kept for each event loop too, because they belong to the loop.
+    """
+    __clients: Dict[tuple, pymongo.MongoClient] = {}
+    __async_clients: Dict[tuple, weakref.WeakKeyDictionary] = {}
+    # client options of each key, which the clients of the key are made with
+    __client_kwargs: Dict[tuple, dict] = {}
+    __lock = threading.Lock()
+
+    @classmethod
+    def get_client(cls, mongo_url: str, **client_kwargs) -> pymongo.MongoClient:
+        """
+        Get the shared MongoClient of the mongo url. Make new one with the client options if it does not exist.
+        :param mongo_url: str, the url of mongoDB server.
+        :param client_kwargs: options of MongoClient, like maxPoolSize, minPoolSize and maxIdleTimeMS.
+        """
+        key = (os.getpid(), mongo_url)
+        with cls.__lock:
+            cls.__check_client_kwargs(key, client_kwargs)
+            if key not in cls.__clients:
+                cls.__clients[key] = pymongo.MongoClient(mongo_url, uuidRepresentation='standard',
+                                                         **cls.__client_kwargs[key])
+            return cls.__clients[key]
+
+    @classmethod
+    def get_async_client(cls, mongo_url: str, **client_kwargs):
+        """
+        Get the shared AsyncIOMotorClient of the mongo url for the running event loop.
+        :param mongo_url: str, the url of mongoDB server.
+        :param client_kwargs: options of the client, same as get_client.
+        :return: AsyncIOMotorClient. None if motor is not installed.
+        """
+        try:
+            from motor.motor_asyncio import AsyncIOMotorClient
+        except ImportError:
+            return None
+        loop = asyncio.get_running_loop()
+        key = (os.getpid(), mongo_url)
+        with cls.__lock:
+            cls.__check_client_kwargs(key, client_kwargs)
+            clients = cls.__async_clients.setdefault(key, weakref.WeakKeyDictionary())
+            if loop not in clients:
+                clients[loop] = AsyncIOMotorClient(mongo_url, uuidRepresentation='standard', io_loop=loop,
+                                                   **cls.__client_kwargs[key])
+            return clients[loop]
+
+    @classmethod
+    def close_all(cls):
+        """Close all clients of this process."""
+        with cls.__lock:
+            for key in [key for key in cls.__clients if key[0] == os.getpid()]:
+                cls.__clients.pop(key).close()
+            for key in [key for key in cls.__client_kwargs if key[0] == os.getpid()]:
+                cls.__client_kwargs.pop(key)
+            for key in [key for key in cls.__async_clients if key[0] == os.getpid()]:
+                for client in cls.__async_clients.pop(key).values():
+                    client.close()
+
+    @classmethod
+    def __check_client_kwargs(cls, key: tuple, client_kwargs: dict):
+        """
+        Keep the client options of the key at the first call. It must be called with the lock.
+        Empty options, like MongoDB made from its db origin, use the kept options.
+        """
+        kept_kwargs = cls.__client_kwargs.setdefault(key, dict(client_kwargs))
+        if len(client_kwargs) > 0 and client_kwargs != kept_kwargs:
+            logger.warning(f"MongoClient of {key[1]} is already made with {kept_kwargs}, "
+                           f"so the client options {client_kwargs} are ignored.")
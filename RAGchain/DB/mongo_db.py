@@ -1,31 +1,47 @@
+import logging
+import time
 from typing import List, Optional, Union
 from uuid import UUID
 
-import pymongo
+from pymongo import ReplaceOne
+from pymongo.errors import BulkWriteError
 
 from RAGchain.DB.base import BaseDB
-from RAGchain.schema import Passage
+from RAGchain.DB.mongo_client_registry import MongoClientRegistry
+from RAGchain.schema import Passage, LazyPassage
 from RAGchain.schema.db_origin import DBOrigin
-from RAGchain.utils.linker.redisdbSingleton import RedisDBSingleton
+from RAGchain.utils.linker import LinkerFactory
+
+logger = logging.getLogger(__name__)
 
 
 class MongoDB(BaseDB):
     """
     MongoDB class for using MongoDB as a database for passage contents.
+    MongoDB instances of the same mongo url share one MongoClient and its connection pool in a process.
+    The client is made with client_kwargs of the first MongoDB instance of the url. See MongoClientRegistry.
+    afetch and asearch use motor when it is installed, otherwise they run fetch and search at a thread.
     """
-    def __init__(self, mongo_url: str, db_name: str, collection_name: str, *args, **kwargs):
+    def __init__(self, mongo_url: str, db_name: str, collection_name: str, batch_size: int = 1000,
+                 client_kwargs: Optional[dict] = None, *args, **kwargs):
         """
         :param mongo_url: str, the url of mongoDB server.
         :param db_name: str, the name of mongoDB database.
         :param collection_name: str, the name of collection in mongoDB database.
+        :param batch_size: int, count of passages to write in one bulk request at save. Default is 1000.
+        :param client_kwargs: Optional[dict], connection pool options of MongoClient,
+        like maxPoolSize, minPoolSize and maxIdleTimeMS. Default is None, which uses pymongo defaults.
+        They are not in the db origin, so MongoDB made from the db origin shares the client made with them.
         """
         self.client = None
         self.db = None
         self.mongo_url = mongo_url
         self.db_name = db_name
         self.collection_name = collection_name
+        self.batch_size = batch_size
+        self.client_kwargs = client_kwargs or {}
         self.collection = None
-        self.redis_db = RedisDBSingleton()
+        self.linker = LinkerFactory().get()
 
     @property
     def db_type(self) -> str:
@@ -46,6 +62,14 @@ class MongoDB(BaseDB):
             raise ValueError(f'{self.collection_name} does not exist')
         self.collection = self.db.get_collection(self.collection_name)
 
+    def load_if_changed(self):
+        """
+        Loads the collection only when it is not loaded yet.
+        Passages are read from MongoDB server at each query, so the loaded collection is always up to date.
+        """
+        if self.collection is None:
+            self.load()
+
     def create_or_load(self):
         """Creates the collection if it does not exist, otherwise loads it."""
         self.set_db()
@@ -54,36 +78,99 @@ class MongoDB(BaseDB):
         else:
             self.create()
 
-    def save(self, passages: List[Passage]):
-        """Saves the passages to MongoDB collection."""
-        for passage in passages:
+    def save(self, passages: List[Passage], upsert: bool = False):
+        """
+        Saves the passages to MongoDB collection with bulk writes of batch_size passages.
+        Links of each batch are saved to the linker with one request.
+        :param passages: List[Passage], passages to save.
+        :param upsert: bool, if True, replace passages that have the same id instead of raising error.
+        Use it when you ingest passages again. Default is False.
+        When some passages of a batch fail to be written, like duplicated ids, the other passages of the batch
+        are still written and linked, and BulkWriteError is raised.
+        """
+        start_time = time.perf_counter()
+        db_origin_dict = self.get_db_origin().to_dict()
+        for start in range(0, len(passages), self.batch_size):
+            batch = passages[start:start + self.batch_size]
             # save to mongoDB
-            passage_to_dict = passage.to_dict()
-            self.collection.insert_one(passage_to_dict)
-            # save to redisDB
-            db_origin = self.get_db_origin()
-            db_origin_dict = db_origin.to_dict()
-            self.redis_db.client.json().set(str(passage.id), '$', db_origin_dict)
-
-    def fetch(self, ids: List[UUID]) -> List[Passage]:
-        """Fetches the passages from MongoDB collection by their passage ids."""
-        dict_passages = list(self.collection.find({"_id": {"$in": ids}}))
-        return [Passage(id=dict_passage['_id'], **dict_passage) for dict_passage in dict_passages]
+            try:
+                if upsert:
+                    self.collection.bulk_write([ReplaceOne({'_id': passage.id}, passage.to_dict(), upsert=True)
+                                                for passage in batch], ordered=False)
+                else:
+                    self.collection.insert_many([passage.to_dict() for passage in batch], ordered=False)
+            except BulkWriteError as e:
+                # other passages of the batch are written with ordered=False, so link them before raising
+                failed_indexes = {error['index'] for error in e.details.get('writeErrors', [])}
+                written_ids = [passage.id for i, passage in enumerate(batch) if i not in failed_indexes]
+                self.linker.set_json(written_ids, [db_origin_dict] * len(written_ids))
+                raise
+            # save to linker
+            self.linker.set_json([passage.id for passage in batch], [db_origin_dict] * len(batch))
+        elapsed_time = time.perf_counter() - start_time
+        logger.info(f"Saved {len(passages)} passages to MongoDB in {elapsed_time:.2f}s "
+                    f"({len(passages) / max(elapsed_time, 1e-9):.0f} passages/s)")
+
+    def fetch(self, ids: List[UUID], fields: Optional[List[str]] = None) -> List[Union[Passage, LazyPassage]]:
+        """
+        Fetches the passages from MongoDB collection by their passage ids.
+        :param ids: List[UUID], list of Passage ID to fetch.
+        :param fields: Optional[List[str]], Passage fields to return. If given, only the fields are transferred
+        from MongoDB, and return LazyPassage which has only id and the fields.
+        """
+        cursor = self.collection.find({"_id": {"$in": ids}}, projection=self._projection(fields))
+        return self._to_passages(cursor, fields)
+
+    async def afetch(self, ids: List[UUID], fields: Optional[List[str]] = None) -> List[
+        Union[Passage, LazyPassage]]:
+        """Async version of fetch. See fetch."""
+        collection = self._async_collection()
+        if collection is None:
+            return await super().afetch(ids, fields)
+        cursor = collection.find({"_id": {"$in": ids}}, projection=self._projection(fields))
+        return self._to_passages(await cursor.to_list(length=None), fields)
 
     def search(self,
                id: Optional[List[Union[UUID, str]]] = None,
                content: Optional[List[str]] = None,
                filepath: Optional[List[str]] = None,
+               fields: Optional[List[str]] = None,
                **kwargs
-               ) -> List[Passage]:
+               ) -> List[Union[Passage, LazyPassage]]:
         """
         Searches the MongoDB collection based on the provided filters and returns the resulting passages.
         :param id: Optional[List[Union[UUID, str]]], list of Passage ID to search.
         :param content: Optional[List[str]], list of Passage content to search.
         :param filepath: Optional[List[str]], list of Passage filepath to search.
+        :param fields: Optional[List[str]], Passage fields to return. If given, only the fields are transferred
+        from MongoDB, and return LazyPassage which has only id and the fields.
         :param kwargs: Additional metadata to search.
         :return: List[Passage], list of Passage extract from the MongoDB.
         """
+        cursor = self.collection.find(self._filter_dict(id, content, filepath, **kwargs),
+                                      projection=self._projection(fields))
+        return self._to_passages(cursor, fields)
+
+    async def asearch(self,
+                      id: Optional[List[Union[UUID, str]]] = None,
+                      content: Optional[List[str]] = None,
+                      filepath: Optional[List[str]] = None,
+                      fields: Optional[List[str]] = None,
+                      **kwargs
+                      ) -> List[Union[Passage, LazyPassage]]:
+        """Async version of search. See search."""
+        collection = self._async_collection()
+        if collection is None:
+            return await super().asearch(id=id, content=content, filepath=filepath, fields=fields, **kwargs)
+        cursor = collection.find(self._filter_dict(id, content, filepath, **kwargs),
+                                 projection=self._projection(fields))
+        return self._to_passages(await cursor.to_list(length=None), fields)
+
+    @staticmethod
+    def _filter_dict(id: Optional[List[Union[UUID, str]]] = None,
+                     content: Optional[List[str]] = None,
+                     filepath: Optional[List[str]] = None,
+                     **kwargs) -> dict:
         filter_dict = {}
         if id is not None:
             filter_dict["_id"] = {'$in': id}
@@ -94,12 +181,33 @@ class MongoDB(BaseDB):
         if kwargs is not None and len(kwargs) > 0:
             for key, value in kwargs.items():
                 filter_dict[f'metadata_etc.{key}'] = {'$in': value}
+        return filter_dict
+
+    def _async_collection(self):
+        client = MongoClientRegistry.get_async_client(self.mongo_url, **self.client_kwargs)
+        if client is None:
+            return None
+        return client.get_database(self.db_name).get_collection(self.collection_name)
+
+    def _to_passages(self, cursor, fields: Optional[List[str]]) -> List[Union[Passage, LazyPassage]]:
+        if fields is None:
+            return [Passage(id=passage['_id'], **passage) for passage in cursor]
+        return [LazyPassage(passage['_id'], self._lazy_loader(passage['_id']),
+                            **{field: passage.get(field) for field in fields}) for passage in cursor]
 
-        cursor = self.collection.find(filter_dict)
-        return [Passage(id=passage['_id'], **passage) for passage in cursor]
+    @staticmethod
+    def _projection(fields: Optional[List[str]]) -> Optional[dict]:
+        if fields is None:
+            return None
+        LazyPassage.check_fields(fields)
+        # empty projection returns all fields, so project _id explicitly
+        return {'_id': 1, **{field: 1 for field in fields}}
 
     def set_db(self):
-        self.client = pymongo.MongoClient(self.mongo_url, uuidRepresentation='standard')
+        """Sets the database with the shared MongoClient. Existence of the database is checked only once."""
+        if self.db is not None:
+            return
+        self.client = MongoClientRegistry.get_client(self.mongo_url, **self.client_kwargs)
         if self.db_name not in self.client.list_database_names():
             raise ValueError(f'{self.db_name} does not exists')
         self.db = self.client.get_database(self.db_name)
@@ -107,6 +215,7 @@ class MongoDB(BaseDB):
     def get_db_origin(self) -> DBOrigin:
         """
         Returns the DBOrigin object representing the MongoDB database.
+        client_kwargs are not in it, because MongoDB instances of the same mongo url share one client.
         """
         db_path = {'mongo_url': self.mongo_url, 'db_name': self.db_name, 'collection_name': self.collection_name}
         return DBOrigin(db_type=self.db_type, db_path=db_path)
@@ -1,30 +1,62 @@
 import os
 import pickle
-from typing import List, Optional, Union
+import threading
+import warnings
+import zlib
+from typing import Dict, List, Optional, Union
 from uuid import UUID
 
 from RAGchain.DB.base import BaseDB
-from RAGchain.schema import Passage
+from RAGchain.DB.secondary_index import SecondaryIndex
+from RAGchain.schema import Passage, LazyPassage
 from RAGchain.schema.db_origin import DBOrigin
-from RAGchain.utils.linker import RedisDBSingleton
+from RAGchain.utils.file_lock import file_lock
+from RAGchain.utils.linker import LinkerFactory
 from RAGchain.utils.util import FileChecker
 
 
 class PickleDB(BaseDB):
     """
     This DB stores passages in a pickle file format at your local disk.
+    The file is an append-only log of pickled passage lists. Each save appends one record,
+    so it costs only the saved passages, and load replays the records in order.
+    When a passage id is saved again, the later passage replaces the earlier one.
+    Call compact to rewrite the log to one record without replaced passages.
+    Processes take flock of '{save_path}.lock' file, so a process does not read half-written records,
+    and records appended by other processes are not lost at compact.
+    A file written by the previous versions is a log of one record, so it can be loaded as it is.
+    Search uses in-memory hash indexes of filepath and the given metadata_etc keys,
+    so it checks only the passages which can match instead of all passages.
     """
-    def __init__(self, save_path: str, *args, **kwargs):
+    # bytes before the end of the read records, which are checked to be unchanged before reading appended records
+    LOG_TAIL_CHECK_SIZE = 4096
+
+    def __init__(self, save_path: str, index_filepath: bool = True,
+                 index_metadata_keys: Optional[List[str]] = None, *args, **kwargs):
         """
         Initializes a PickleDB object.
 
         :param save_path: The path to the pickle file where the passages are stored. It must be .pickle or .pkl file.
+        :param index_filepath: If True, index filepath of passages for search. Default is True.
+        :param index_metadata_keys: metadata_etc keys to index for search. Default is None, which indexes no key.
         :rtype: None
         """
         FileChecker(save_path).check_type(file_types=['.pickle', '.pkl'])
         self.save_path = save_path
+        self.index_keys = (['filepath'] if index_filepath else []) + list(index_metadata_keys or [])
         self.db: List[Passage] = list()
-        self.redis_db = RedisDBSingleton()
+        # id -> passage and id -> position at self.db, for fetching by id without scanning self.db
+        self.id_to_passage: Dict[Union[UUID, str], Passage] = dict()
+        self.id_to_position: Dict[Union[UUID, str], int] = dict()
+        # filter key -> secondary index, for searching without scanning self.db
+        self.indexes: Dict[str, SecondaryIndex] = self._new_indexes()
+        # (inode, size, mtime) of the pickle file when self.db was loaded or written
+        self._file_signature = None
+        # end of the last record that self.db has, and checksum of the bytes before it
+        self._log_offset = 0
+        self._log_tail_checksum = None
+        self._load_lock = threading.Lock()
+        self.linker = LinkerFactory().get()
 
     @property
     def db_type(self) -> str:
@@ -41,10 +73,51 @@ class PickleDB(BaseDB):
 
     def load(self):
         """Loads the data from the existing pickle file into the database."""
+        with file_lock(self._lock_path, exclusive=False):
+            self._load()
+
+    def _load(self):
+        """load without taking the file lock. The caller must hold it."""
         if not FileChecker(self.save_path).check_type(file_types=['.pickle', '.pkl']).is_exist():
             raise FileNotFoundError(f'{self.save_path} does not exist')
-        with open(self.save_path, 'rb') as f:
-            self.db = pickle.load(f)
+        # get signature before reading, so changes while reading are loaded at the next call
+        signature = self._get_file_signature()
+        db, id_to_position, id_to_passage, indexes = list(), dict(), dict(), self._new_indexes()
+        offset, complete = self._read_log(0, db, id_to_position, id_to_passage, indexes)
+        self.id_to_passage, self.id_to_position, self.indexes, self.db = id_to_passage, id_to_position, indexes, db
+        self._log_offset, self._log_tail_checksum = offset, self._get_log_tail_checksum(offset)
+        # when a record can not be read, do not keep the signature, so the file is loaded again at the next call
+        self._file_signature = signature if complete else None
+
+    def load_if_changed(self):
+        """
+        Loads the data from the pickle file only when the file changed since the last load or write.
+        It compares inode, size and modified time of the file, so it costs one stat call when nothing changed.
+        When other processes only appended passages, it reads the appended records only.
+        The file can be rewritten in place, so the bytes before the appended records are checked first,
+        and the whole file is loaded when they changed or a record can not be read.
+        """
+        with self._load_lock:
+            if self._file_signature is not None and self._get_file_signature() == self._file_signature:
+                return
+            with file_lock(self._lock_path, exclusive=False):
+                self._load_if_changed_locked()
+
+    def _load_if_changed_locked(self):
+        """load_if_changed without taking self._load_lock and the file lock. The caller must hold them."""
+        signature = self._get_file_signature()
+        if self._file_signature is not None and signature == self._file_signature:
+            return
+        if self._file_signature is not None and signature is not None \
+                and signature[0] == self._file_signature[0] and signature[1] > self._log_offset \
+                and self._get_log_tail_checksum(self._log_offset) == self._log_tail_checksum:
+            offset, complete = self._read_log(self._log_offset, self.db, self.id_to_position,
+                                              self.id_to_passage, self.indexes)
+            if complete:
+                self._log_offset, self._log_tail_checksum = offset, self._get_log_tail_checksum(offset)
+                self._file_signature = signature
+                return
+        self._load()
 
     def create_or_load(self):
         """Creates a new pickle file if it doesn't exist, otherwise loads the data from the existing file."""
@@ -54,25 +127,36 @@ class PickleDB(BaseDB):
             self.create()
 
     def save(self, passages: List[Passage]):
-        """Saves the given list of Passage objects to the pickle database. It also saves the data to the Linker."""
-        # save to pickleDB
-        self.db.extend(passages)
-        self._write_pickle()
+        """
+        Saves the given list of Passage objects to the pickle database. It also saves the data to the Linker.
+        When a passage id already exists, the passage is replaced at its position.
+        """
+        # save to pickleDB. Indexes are changed in place, so change them with the lock which search takes
+        with self._load_lock, file_lock(self._lock_path):
+            self._put(passages, self.db, self.id_to_position, self.id_to_passage, self.indexes)
+            self._append_log(passages)
         # save to redisDB
         db_origin = self.get_db_origin()
         db_origin_dict = db_origin.to_dict()
-        [self.redis_db.client.json().set(str(passage.id), '$', db_origin_dict) for passage in passages]
+        self.linker.set_json([passage.id for passage in passages], [db_origin_dict] * len(passages))
 
-    def fetch(self, ids: List[UUID]) -> List[Passage]:
-        """Retrieves the Passage objects from the database based on the given list of passage IDs."""
-        result = list(filter(lambda x: x.id in ids, self.db))
-        return result
+    def fetch(self, ids: List[UUID], fields: Optional[List[str]] = None) -> List[Union[Passage, LazyPassage]]:
+        """
+        Retrieves the Passage objects from the database based on the given list of passage IDs.
+        Passages are returned in the order of the given ids, and ids which are not in the database are skipped.
+        :param ids: List of Passage ID to fetch.
+        :param fields: Passage fields to return. If given, return LazyPassage which has only id and the fields.
+        """
+        id_to_passage = self.id_to_passage
+        result = [id_to_passage[find_id] for find_id in ids if find_id in id_to_passage]
+        return result if fields is None else self._project(result, fields)
 
     def search(self,
                id: Optional[List[Union[UUID, str]]] = None,
                content: Optional[List[str]] = None,
                filepath: Optional[List[str]] = None,
-               **kwargs) -> List[Passage]:
+               fields: Optional[List[str]] = None,
+               **kwargs) -> List[Union[Passage, LazyPassage]]:
         """
         Searches for Passage objects in the database based on the given filters.
         This function is an implicit AND operation,
@@ -82,6 +166,7 @@ class PickleDB(BaseDB):
         :param id: List of Passage ID to search.
         :param content: List of Passage content to search.
         :param filepath: List of Passage filepath to search.
+        :param fields: Passage fields to return. If given, return LazyPassage which has only id and the fields.
         :param kwargs: Additional metadata to search.
         """
 
@@ -99,21 +184,134 @@ class PickleDB(BaseDB):
             for key, value in kwargs.items():
                 filter_dict[key] = value
 
+        # check only the passages of the given ids and the passages found at indexes, instead of all passages
+        candidate_ids = None if id is None else set(id)
+        # save and load_if_changed change the indexes in place with the lock
+        with self._load_lock:
+            for key, value in filter_dict.items():
+                if key not in self.indexes:
+                    continue
+                index_ids = self.indexes[key].candidates(value)
+                if index_ids is not None:
+                    candidate_ids = index_ids if candidate_ids is None else candidate_ids & index_ids
+        if candidate_ids is None:
+            candidates = self.db
+        else:
+            candidates = sorted(self.fetch(list(candidate_ids)), key=lambda x: self.id_to_position[x.id])
         result = list(
             filter(
                 lambda x: all(
                     getattr(x, key) in value if is_default_elem(key) else x.metadata_etc.get(key) in value
                     for key, value in filter_dict.items()
                 ),
-                self.db
+                candidates
             )
         )
-        return result
+        return result if fields is None else self._project(result, fields)
+
+    def compact(self):
+        """
+        Rewrites the pickle file to one record of the current database contents.
+        The new file replaces the old file atomically, so other processes reading the file are not affected.
+        Records appended by other processes since the last load are read first, so they are kept.
+        It holds the file lock, so other processes can not append records until the new file replaces the old file.
+        """
+        with self._load_lock, file_lock(self._lock_path):
+            self._load_if_changed_locked()
+            temp_path = f'{self.save_path}.tmp'
+            with open(temp_path, 'wb') as w:
+                pickle.dump(self.db, w, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, self.save_path)
+            self._file_signature = self._get_file_signature()
+            self._log_offset = self._file_signature[1]
+            self._log_tail_checksum = self._get_log_tail_checksum(self._log_offset)
+
+    def _append_log(self, passages: List[Passage]):
+        """
+        Appends one record of the given passages to the pickle file.
+        The caller must hold self._load_lock and the file lock.
+        """
+        # write the record at once, so records of other processes are not interleaved
+        record = pickle.dumps(list(passages), protocol=pickle.HIGHEST_PROTOCOL)
+        with open(self.save_path, 'ab') as w:
+            w.write(record)
+            w.flush()
+            end = w.tell()
+        # when other processes appended records after the last load, leave them to load_if_changed
+        if end - len(record) == self._log_offset:
+            self._log_offset = end
+            self._log_tail_checksum = self._get_log_tail_checksum(end)
+            self._file_signature = self._get_file_signature()
+
+    def _read_log(self, offset: int, db: List[Passage], id_to_position: Dict[Union[UUID, str], int],
+                  id_to_passage: Dict[Union[UUID, str], Passage],
+                  indexes: Dict[str, SecondaryIndex]) -> tuple[int, bool]:
+        """
+        Reads records of the pickle file from the offset, and puts their passages to the given database.
+        :return: end offset of the last complete record, and whether all records to the end of the file are read.
+        """
+        with open(self.save_path, 'rb') as f:
+            file_size = os.fstat(f.fileno()).st_size
+            f.seek(offset)
+            while offset < file_size:
+                try:
+                    passages = pickle.load(f)
+                except (EOFError, pickle.UnpicklingError, ValueError, KeyError, AttributeError, IndexError,
+                        TypeError, ImportError):
+                    passages = None
+                if not isinstance(passages, list):
+                    # the last record is being written by other process, or cut by a crash
+                    warnings.warn(f'{self.save_path} has an incomplete record at {offset}. It is skipped.')
+                    return offset, False
+                self._put(passages, db, id_to_position, id_to_passage, indexes)
+                offset = f.tell()
+        return offset, True
+
+    def _get_log_tail_checksum(self, offset: int) -> Optional[int]:
+        """Get checksum of LOG_TAIL_CHECK_SIZE bytes before the offset of the pickle file."""
+        if not os.path.exists(self.save_path):
+            return None
+        start = max(offset - self.LOG_TAIL_CHECK_SIZE, 0)
+        with open(self.save_path, 'rb') as f:
+            f.seek(start)
+            tail = f.read(offset - start)
+        return zlib.crc32(tail) if len(tail) == offset - start else None
+
+    @staticmethod
+    def _project(passages: List[Passage], fields: List[str]) -> List[LazyPassage]:
+        LazyPassage.check_fields(fields)
+        return [LazyPassage.from_passage(passage, fields) for passage in passages]
+
+    def _new_indexes(self) -> Dict[str, SecondaryIndex]:
+        return {key: SecondaryIndex(key) for key in self.index_keys}
+
+    @staticmethod
+    def _put(passages: List[Passage], db: List[Passage], id_to_position: Dict[Union[UUID, str], int],
+             id_to_passage: Dict[Union[UUID, str], Passage], indexes: Dict[str, SecondaryIndex]):
+        """Puts passages to the database. A passage replaces the passage of the same id at its position."""
+        for passage in passages:
+            position = id_to_position.get(passage.id)
+            if position is None:
+                id_to_position[passage.id] = len(db)
+                db.append(passage)
+            else:
+                for index in indexes.values():
+                    index.remove(db[position])
+                db[position] = passage
+            id_to_passage[passage.id] = passage
+            for index in indexes.values():
+                index.add(passage)
+
+    @property
+    def _lock_path(self) -> str:
+        # the pickle file is replaced at compact, so lock other file
+        return f'{self.save_path}.lock'
 
-    def _write_pickle(self):
-        """Writes the current database contents to the pickle file."""
-        with open(self.save_path, 'wb') as w:
-            pickle.dump(self.db, w)
+    def _get_file_signature(self) -> Optional[tuple[int, int, int]]:
+        if not os.path.exists(self.save_path):
+            return None
+        stat = os.stat(self.save_path)
+        return stat.st_ino, stat.st_size, stat.st_mtime_ns
 
     def get_db_origin(self) -> DBOrigin:
         """Returns a DBOrigin object that represents the origin of the database."""
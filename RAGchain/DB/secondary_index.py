@@ -0,0 +1,57 @@
+from collections import defaultdict
+from typing import Any, Dict, Iterable, Optional, Set, Union
+from uuid import UUID
+
+from RAGchain.schema import Passage
+
+
+class SecondaryIndex:
+    """
+    Hash index from a field value to passage ids, for searching passages without scanning all passages.
+    The field is 'filepath' or a key of metadata_etc.
+    Passages whose value is not hashable, like a list, can not be indexed by value,
+    so they are always returned as candidates. So candidates must be checked with the filter again.
+    """
+
+    def __init__(self, key: str):
+        """
+        :param key: 'filepath' or a key of metadata_etc.
+        """
+        self.key = key
+        self.value_to_ids: Dict[Any, Set[Union[UUID, str]]] = defaultdict(set)
+        self.unhashable_ids: Set[Union[UUID, str]] = set()
+
+    def get_value(self, passage: Passage) -> Any:
+        if self.key == 'filepath':
+            return passage.filepath
+        return passage.metadata_etc.get(self.key)
+
+    def add(self, passage: Passage):
+        try:
+            self.value_to_ids[self.get_value(passage)].add(passage.id)
+        except TypeError:
+            self.unhashable_ids.add(passage.id)
+
+    def remove(self, passage: Passage):
+        try:
+            ids = self.value_to_ids.get(self.get_value(passage))
+        except TypeError:
+            self.unhashable_ids.discard(passage.id)
+            return
+        if ids is not None:
+            ids.discard(passage.id)
+            if len(ids) == 0:
+                del self.value_to_ids[self.get_value(passage)]
+
+    def candidates(self, values: Iterable[Any]) -> Optional[Set[Union[UUID, str]]]:
+        """
+        Get ids of passages which can have one of the values.
+        :return: set of passage ids. None if the values can not be looked up, like unhashable values.
+        """
+        result = set(self.unhashable_ids)
+        try:
+            for value in values:
+                result.update(self.value_to_ids.get(value, ()))
+        except TypeError:
+            return None
+        return result
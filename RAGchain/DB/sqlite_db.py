@@ -0,0 +1,226 @@
+import json
+import os
+import sqlite3
+import threading
+from typing import List, Optional, Union, Any
+from uuid import UUID
+
+from RAGchain.DB.base import BaseDB
+from RAGchain.schema import Passage, LazyPassage
+from RAGchain.schema.db_origin import DBOrigin
+from RAGchain.utils.linker import LinkerFactory
+
+
+class SQLiteDB(BaseDB):
+    """
+    This DB stores passages in a SQLite file at your local disk.
+    It does not need any server, and passages are read from the file at each query, so memory usage is bounded.
+    It uses WAL journal mode, so many threads and processes can read while one writes.
+    filepath and the given metadata_etc keys are indexed for search.
+    """
+    # SQLite limits the count of variables in one query
+    QUERY_BATCH_SIZE = 500
+
+    def __init__(self, save_path: str, index_metadata_keys: Optional[List[str]] = None, *args, **kwargs):
+        """
+        Initializes a SQLiteDB object.
+
+        :param save_path: The path to the SQLite file where the passages are stored.
+        :param index_metadata_keys: metadata_etc keys to index for search. Default is None, which indexes no key.
+        """
+        self.save_path = save_path
+        self.index_metadata_keys = list(index_metadata_keys or [])
+        # each thread has its own connection, so threads can read concurrently
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        self.linker = LinkerFactory().get()
+
+    @property
+    def db_type(self) -> str:
+        """Returns the type of the database as a string."""
+        return 'sqlite_db'
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        """SQLite connection of the current thread."""
+        if getattr(self._local, 'connection', None) is None:
+            self._local.connection = sqlite3.connect(self.save_path)
+        return self._local.connection
+
+    def create(self):
+        """Creates a new SQLite file for the database. Raises a `FileExistsError` if the file already exists."""
+        if os.path.exists(self.save_path):
+            raise FileExistsError(f'{self.save_path} already exists')
+        if os.path.dirname(self.save_path) != '' and not os.path.exists(os.path.dirname(self.save_path)):
+            os.makedirs(os.path.dirname(self.save_path))
+        self._create_schema()
+
+    def load(self):
+        """Loads the existing SQLite file. Indexes of index_metadata_keys are created if they do not exist."""
+        if not os.path.exists(self.save_path):
+            raise FileNotFoundError(f'{self.save_path} does not exist')
+        self._create_schema()
+
+    def load_if_changed(self):
+        """
+        Loads the SQLite file only when it is not loaded yet.
+        Passages are read from the file at each query, so the loaded database is always up to date.
+        """
+        if getattr(self._local, 'connection', None) is None:
+            self.load()
+
+    def create_or_load(self):
+        """Creates a new SQLite file if it doesn't exist, otherwise loads the existing file."""
+        if os.path.exists(self.save_path):
+            self.load()
+        else:
+            self.create()
+
+    def save(self, passages: List[Passage]):
+        """
+        Saves the given list of Passage objects to the SQLite database in one transaction.
+        It also saves the data to the Linker. When a passage id already exists, the passage is replaced.
+        """
+        with self._write_lock, self.connection as connection:
+            connection.executemany(
+                'INSERT INTO passages (id, content, filepath, previous_passage_id, next_passage_id, metadata_etc) '
+                'VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(id) DO UPDATE SET content = excluded.content, '
+                'filepath = excluded.filepath, previous_passage_id = excluded.previous_passage_id, '
+                'next_passage_id = excluded.next_passage_id, metadata_etc = excluded.metadata_etc',
+                (self._to_row(passage) for passage in passages))
+        # save to linker
+        db_origin = self.get_db_origin()
+        db_origin_dict = db_origin.to_dict()
+        self.linker.set_json([passage.id for passage in passages], [db_origin_dict] * len(passages))
+
+    def fetch(self, ids: List[Union[UUID, str]], fields: Optional[List[str]] = None) -> List[
+        Union[Passage, LazyPassage]]:
+        """
+        Retrieves the Passage objects from the database based on the given list of passage IDs.
+        Passages are returned in the order of the given ids, and ids which are not in the database are skipped.
+        :param ids: List of Passage ID to fetch.
+        :param fields: Passage fields to return. If given, only the fields are read from the file,
+        and return LazyPassage which has only id and the fields.
+        """
+        columns = self._columns(fields)
+        str_ids = [str(find_id) for find_id in ids]
+        rows = {}
+        for start in range(0, len(str_ids), self.QUERY_BATCH_SIZE):
+            batch = str_ids[start:start + self.QUERY_BATCH_SIZE]
+            cursor = self.connection.execute(
+                f'SELECT {", ".join(columns)} FROM passages WHERE id IN ({",".join("?" * len(batch))})', batch)
+            rows.update((row[1], dict(zip(columns, row))) for row in cursor)
+        return [self._from_row(rows[find_id], fields) for find_id in str_ids if find_id in rows]
+
+    def search(self,
+               id: Optional[List[Union[UUID, str]]] = None,
+               content: Optional[List[str]] = None,
+               filepath: Optional[List[str]] = None,
+               fields: Optional[List[str]] = None,
+               **kwargs) -> List[Union[Passage, LazyPassage]]:
+        """
+        Searches for Passage objects in the database based on the given filters.
+        This function is an implicit AND operation,
+        which is return Passage that matches all values to corresponding keys in filter_dict.
+        When the match value is not exist, return empty list.
+        Filters are run as SQL query with the indexes. Metadata values which are not str or number,
+        like None or list, can not be compared in SQL, so they are compared after the query.
+
+        :param id: List of Passage ID to search.
+        :param content: List of Passage content to search.
+        :param filepath: List of Passage filepath to search.
+        :param fields: Passage fields to return. If given, only the fields are read from the file,
+        and return LazyPassage which has only id and the fields.
+        :param kwargs: Additional metadata to search.
+        """
+        columns = self._columns(fields)
+        if len(kwargs) > 0 and 'metadata_etc' not in columns:
+            # metadata_etc is needed to check metadata filters after the query
+            columns.append('metadata_etc')
+        conditions, params = [], []
+        for column, values in [('content', content), ('filepath', filepath)]:
+            if values is not None:
+                conditions.append(f'{column} IN ({",".join("?" * len(values))})')
+                params.extend(values)
+        for key, values in kwargs.items():
+            if all(self._is_sql_value(value) for value in values):
+                conditions.append(f'{self._metadata_expression(key)} IN ({",".join("?" * len(values))})')
+                params.extend(values)
+
+        # search ids in batches, because SQLite limits the count of variables in one query
+        id_batches = [None] if id is None else \
+            [[str(find_id) for find_id in id[start:start + self.QUERY_BATCH_SIZE]]
+             for start in range(0, len(id), self.QUERY_BATCH_SIZE)]
+        rows = {}
+        for id_batch in id_batches:
+            batch_conditions, batch_params = list(conditions), list(params)
+            if id_batch is not None:
+                batch_conditions.append(f'id IN ({",".join("?" * len(id_batch))})')
+                batch_params.extend(id_batch)
+            where = f' WHERE {" AND ".join(batch_conditions)}' if len(batch_conditions) > 0 else ''
+            rows.update((row[0], dict(zip(columns, row))) for row in
+                        self.connection.execute(f'SELECT {", ".join(columns)} FROM passages{where}', batch_params))
+        # return passages in saved order, like other DBs
+        rows = [rows[ordinal] for ordinal in sorted(rows)]
+        if len(kwargs) > 0:
+            rows = [row for row in rows if all(json.loads(row['metadata_etc']).get(key) in values
+                                               for key, values in kwargs.items())]
+        return [self._from_row(row, fields) for row in rows]
+
+    def get_db_origin(self) -> DBOrigin:
+        """Returns a DBOrigin object that represents the origin of the database."""
+        return DBOrigin(db_type=self.db_type, db_path={'save_path': self.save_path})
+
+    def _create_schema(self):
+        with self._write_lock, self.connection as connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            # ordinal keeps saved order of passages, and id has a unique index for fetch
+            connection.execute('CREATE TABLE IF NOT EXISTS passages (ordinal INTEGER PRIMARY KEY, '
+                               'id TEXT UNIQUE NOT NULL, content TEXT NOT NULL, filepath TEXT NOT NULL, '
+                               'previous_passage_id TEXT, next_passage_id TEXT, metadata_etc TEXT NOT NULL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS idx_filepath ON passages (filepath)')
+            for i, key in enumerate(self.index_metadata_keys):
+                index_name = 'idx_metadata_' + ''.join(c if c.isalnum() else '_' for c in key) + f'_{i}'
+                connection.execute(f'CREATE INDEX IF NOT EXISTS {index_name} '
+                                   f'ON passages ({self._metadata_expression(key)})')
+
+    @staticmethod
+    def _metadata_expression(key: str) -> str:
+        # the JSON path must be a literal, so the query can use the index of the same expression
+        path = '$."' + key.replace('"', '\\"') + '"'
+        return "json_extract(metadata_etc, '" + path.replace("'", "''") + "')"
+
+    @staticmethod
+    def _is_sql_value(value: Any) -> bool:
+        return isinstance(value, (str, int, float))
+
+    @staticmethod
+    def _columns(fields: Optional[List[str]]) -> List[str]:
+        if fields is None:
+            return ['ordinal', 'id', *LazyPassage.FIELDS]
+        LazyPassage.check_fields(fields)
+        return ['ordinal', 'id', *fields]
+
+    @staticmethod
+    def _to_passage_id(str_id: str) -> Union[UUID, str]:
+        # ids are stored as str, and Passage parses UUID str to UUID
+        try:
+            return UUID(str_id)
+        except ValueError:
+            return str_id
+
+    @staticmethod
+    def _to_row(passage: Passage) -> tuple:
+        def to_str(passage_id: Optional[Union[UUID, str]]) -> Optional[str]:
+            return None if passage_id is None else str(passage_id)
+
+        return (str(passage.id), passage.content, passage.filepath, to_str(passage.previous_passage_id),
+                to_str(passage.next_passage_id), json.dumps(passage.metadata_etc))
+
+    def _from_row(self, row: dict, fields: Optional[List[str]]) -> Union[Passage, LazyPassage]:
+        values = {field: json.loads(row[field]) if field == 'metadata_etc' else row[field]
+                  for field in (LazyPassage.FIELDS if fields is None else fields)}
+        if fields is None:
+            return Passage(id=row['id'], **values)
+        passage_id = self._to_passage_id(row['id'])
+        return LazyPassage(passage_id, self._lazy_loader(passage_id), **values)
@@ -34,15 +34,16 @@ class LLMReranker(BaseReranker):
         return self.make_passages(new_items, passages)
 
     def make_item(self, query: str, passages: List[Passage]) -> dict:
-        hits_list = [{'content': passage.content} for passage in passages]
+        # keep index of each passage, so reranked hits are mapped to passages without searching content
+        hits_list = [{'content': passage.content, 'passage_index': i} for i, passage in enumerate(passages)]
         return {
             "query": query,
             "hits": hits_list
         }
 
     def make_passages(self, items: dict, original_passages: List[Passage]) -> List[Passage]:
-        content_list = [item['content'] for item in items['hits']]
-        return [self.find_passages(original_passages, content) for content in content_list]
+        return [original_passages[item['passage_index']] if 'passage_index' in item
+                else self.find_passages(original_passages, item['content']) for item in items['hits']]
 
     def find_passages(self, target_passages: List[Passage], content: str):
         for target_passage in target_passages:
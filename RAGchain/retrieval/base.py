@@ -1,12 +1,13 @@
-import concurrent.futures
+import asyncio
 from abc import ABC, abstractmethod
 from typing import List, Union, Optional
 from uuid import UUID
 
-from RAGchain.DB import MongoDB, PickleDB
+from RAGchain.DB import MongoDB, PickleDB, SQLiteDB
 from RAGchain.DB.base import BaseDB
-from RAGchain.schema import Passage, DBOrigin
-from RAGchain.utils.linker import RedisDBSingleton
+from RAGchain.schema import Passage, DBOrigin, LazyPassage
+from RAGchain.utils.executor import RetrievalExecutor, run_in_thread
+from RAGchain.utils.linker import LinkerFactory
 
 
 class BaseRetrieval(ABC):
@@ -15,7 +16,8 @@ class BaseRetrieval(ABC):
     """
     def __init__(self):
         self.db_instance_list: List[BaseDB] = []
-        self.redis_db = RedisDBSingleton()
+        self.db_origins: Optional[List[dict]] = None
+        self.linker = LinkerFactory().get()
 
     @abstractmethod
     def retrieve(self, query: str, top_k: int = 5, *args, **kwargs) -> List[Passage]:
@@ -46,6 +48,42 @@ class BaseRetrieval(ABC):
         """
         pass
 
+    async def aretrieve(self, query: str, top_k: int = 5, *args, **kwargs) -> List[Passage]:
+        """
+        Async version of retrieve. It retrieves ids with aretrieve_id, and fetches passages with afetch_data.
+        """
+        ids = await self.aretrieve_id(query, top_k, *args, **kwargs)
+        return await self.afetch_data(ids)
+
+    async def aretrieve_id(self, query: str, top_k: int = 5, *args, **kwargs) -> List[Union[str, UUID]]:
+        """
+        Async version of retrieve_id. Default implementation runs retrieve_id at a thread.
+        Override it when the retrieval has a native async client.
+        """
+        return await run_in_thread(self.retrieve_id, query, top_k, *args, **kwargs)
+
+    async def aretrieve_id_with_scores(self, query: str, top_k: int = 5, *args, **kwargs) -> tuple[
+        List[Union[str, UUID]], List[float]]:
+        """
+        Async version of retrieve_id_with_scores. Default implementation runs retrieve_id_with_scores at a thread.
+        Override it when the retrieval has a native async client.
+        """
+        return await run_in_thread(self.retrieve_id_with_scores, query, top_k, *args, **kwargs)
+
+    def supports_allowed_ids(self) -> bool:
+        """
+        Whether retrieve_id and retrieve_id_with_scores accept allowed_ids keyword argument,
+        which restricts retrieved passages to the given ids. Override it when the retrieval supports it.
+        """
+        return False
+
+    def max_allowed_ids(self) -> Optional[int]:
+        """
+        Max count of allowed_ids which retrieve_id accepts. None means no limit.
+        When more passages match the filters, retrieve_with_filter filters retrieved passages instead.
+        """
+        return None
+
     def retrieve_with_filter(self, query: str, top_k: int = 5,
                              content: Optional[List[str]] = None,
                              filepath: Optional[List[str]] = None,
@@ -56,6 +94,10 @@ class BaseRetrieval(ABC):
                              ):
         """
         retrieve passages which matches filter_dict conditions.
+        When the retrieval supports allowed_ids and its dbs are known (see search_allowed_ids),
+        ids of passages which match the filters are searched at the dbs first, and only those passages are retrieved.
+        When more passages than max_allowed_ids match, retrieved passages are filtered.
+        Otherwise, retrieved passages are filtered, and more passages are retrieved until top_k passages match.
         :param query: query string
         :param top_k: passages count to retrieve
         :param content: content list to filter
@@ -65,101 +107,222 @@ class BaseRetrieval(ABC):
         :param retrieve_range_mult: multiplier for retrieve range
         :param max_trial: max trial count for retrieve
         """
-        result_passages = []
+        if content is None and filepath is None and len(kwargs) == 0:
+            return self.fetch_data(self.retrieve_id(query, top_k=top_k))
+        if self.supports_allowed_ids():
+            allowed_ids = self.search_allowed_ids(content=content, filepath=filepath, **kwargs)
+            max_allowed_ids = self.max_allowed_ids()
+            if allowed_ids is not None and len(allowed_ids) == 0:
+                return []
+            if allowed_ids is not None and (max_allowed_ids is None or len(allowed_ids) <= max_allowed_ids):
+                return self.fetch_data(self.retrieve_id(query, top_k=top_k, allowed_ids=allowed_ids))
+
+        result_ids = []
         for _ in range(max_trial):
             ids = self.retrieve_id(query, top_k=retrieve_range_mult * top_k)
-            passages = self.search_data(ids, content=content, filepath=filepath, **kwargs)
-            result_passages = passages[:top_k]
-            if len(result_passages) >= top_k:
+            # search ids only, and fetch full passages of top_k ids at the end
+            matched_ids = {str(passage.id) for passage in
+                           self.search_data(ids, content=content, filepath=filepath, fields=[], **kwargs)}
+            result_ids = [_id for _id in ids if str(_id) in matched_ids][:top_k]
+            if len(result_ids) >= top_k:
                 break
             retrieve_range_mult *= multi_num
 
-        return result_passages
+        return self.fetch_data(result_ids)
+
+    def set_db_origins(self, db_origins: List[Union[DBOrigin, dict]]):
+        """
+        Set db origins of all dbs which store passages of this retrieval.
+        retrieve_with_filter searches passages which match the filters only at these dbs.
+        :param db_origins: list of DBOrigin or its dict. You can get it with get_db_origin of each db.
+        """
+        self.db_origins = [db_origin.to_dict() if isinstance(db_origin, DBOrigin) else dict(db_origin)
+                           for db_origin in db_origins]
 
-    def fetch_data(self, ids: List[Union[UUID, str]]) -> List[Passage]:
+    def get_db_origins(self) -> Optional[List[dict]]:
+        """
+        Get db origins of all dbs which store passages of this retrieval.
+        If they are not set with set_db_origins, use db origins of the linker only when the linker knows all of them,
+        and all of them are dbs which this retrieval already fetched from. So dbs which this retrieval does not use
+        are not loaded.
+        :return: list of db origins. None if they are not known.
+        """
+        if self.db_origins is not None:
+            return self.db_origins
+        linked_db_origins = self.linker.get_db_origins()
+        if linked_db_origins is None:
+            return None
+        used_db_origins = [instance.get_db_origin().to_dict() for instance in self.db_instance_list]
+        if all(db_origin in used_db_origins for db_origin in linked_db_origins):
+            return linked_db_origins
+        return None
+
+    def search_allowed_ids(self, content: Optional[List[str]] = None,
+                           filepath: Optional[List[str]] = None,
+                           **kwargs) -> Optional[List[Union[UUID, str]]]:
+        """
+        search ids of all passages which match the filters at the dbs of get_db_origins.
+        Dbs search with their indexes, and only ids are read from dbs.
+        :param content: content list to filter
+        :param filepath: filepath list to filter
+        :param kwargs: metadata_etc to filter
+        :return: ids of matched passages. None if the dbs of this retrieval are not known.
+        """
+        db_origins = self.get_db_origins()
+        if db_origins is None:
+            return None
+        final_db_origin = self.duplicate_check(db_origins)
+        executor = RetrievalExecutor.get()
+        futures = [executor.submit(self.search_ids_from_db_origin, dict(db_origin), content, filepath, **kwargs)
+                   for db_origin in final_db_origin.keys()]
+        return self.__unique_ids([_id for future in futures for _id in future.result()])
+
+    def search_ids_from_db_origin(self, db_origin: dict,
+                                  content: Optional[List[str]] = None,
+                                  filepath: Optional[List[str]] = None,
+                                  **kwargs) -> List[Union[UUID, str]]:
+        db_path = dict(db_origin['db_path'])
+        db = self.is_created(db_origin['db_type'], db_path)
+        db.load_if_changed()
+        return [passage.id for passage in db.search(content=content, filepath=filepath, fields=[], **kwargs)]
+
+    def fetch_data(self, ids: List[Union[UUID, str]], fields: Optional[List[str]] = None) -> List[
+        Union[Passage, LazyPassage]]:
         """
         fetch passages from each db. This can fetch data from multiple db.
+        Passages are returned in the order of ids, and duplicated ids are fetched once.
+        Ids which are not found are skipped. Use fetch_data_with_misses to get them.
         :param ids: list of passage ids
+        :param fields: passage fields to fetch. If given, return LazyPassage which has only id and the fields.
         """
-        db_origin_list = self.redis_db.get_json(ids)
-        # Sometimes redis doesn't find the id, so we need to filter that db_origin is None.
-        filter_db_origin = list(filter(lambda db_origin: db_origin is not None, db_origin_list))
-        # Check duplicated db origin in one retrieval.
-        final_db_origin = self.duplicate_check(filter_db_origin)
+        passages, _ = self.fetch_data_with_misses(ids, fields)
+        return passages
+
+    def fetch_data_with_misses(self, ids: List[Union[UUID, str]], fields: Optional[List[str]] = None) -> tuple[
+        List[Union[Passage, LazyPassage]], List[Union[UUID, str]]]:
+        """
+        fetch passages from each db like fetch_data, and return ids which are not found at the linker or dbs.
+        :param ids: list of passage ids
+        :param fields: passage fields to fetch. If given, return LazyPassage which has only id and the fields.
+        :return: passages in the order of ids, and ids which are not found.
+        """
+        unique_ids = self.__unique_ids(ids)
+        db_origin_list = self.linker.get_json(unique_ids)
+        # Check duplicated db origin in one retrieval. Ids which are not found at the linker are skipped.
+        final_db_origin = self.duplicate_check(db_origin_list)
         # fetch data from each db
-        return self.fetch_each_db(final_db_origin, ids)
+        passages = self.fetch_each_db(final_db_origin, unique_ids, fields)
+        found_ids = {str(passage.id) for passage in passages}
+        return passages, [_id for _id in unique_ids if str(_id) not in found_ids]
+
+    async def afetch_data(self, ids: List[Union[UUID, str]], fields: Optional[List[str]] = None) -> List[
+        Union[Passage, LazyPassage]]:
+        """
+        Async version of fetch_data. The linker and dbs are queried with their async methods,
+        and dbs are fetched concurrently at the event loop.
+        """
+        passages, _ = await self.afetch_data_with_misses(ids, fields)
+        return passages
+
+    async def afetch_data_with_misses(self, ids: List[Union[UUID, str]], fields: Optional[List[str]] = None) -> \
+            tuple[List[Union[Passage, LazyPassage]], List[Union[UUID, str]]]:
+        """Async version of fetch_data_with_misses."""
+        unique_ids = self.__unique_ids(ids)
+        db_origin_list = await self.linker.aget_json(unique_ids)
+        final_db_origin = self.duplicate_check(db_origin_list)
+        passages = self.__assemble(unique_ids, await asyncio.gather(
+            *[self.afetch_data_from_db_origin(unique_ids, dict(db_origin), target_ids, fields)
+              for db_origin, target_ids in final_db_origin.items()]))
+        found_ids = {str(passage.id) for passage in passages}
+        return passages, [_id for _id in unique_ids if str(_id) not in found_ids]
 
     def search_data(self, ids: List[Union[UUID, str]],
                     content: Optional[List[str]] = None,
                     filepath: Optional[List[str]] = None,
+                    fields: Optional[List[str]] = None,
                     **kwargs
-                    ) -> List[Passage]:
+                    ) -> List[Union[Passage, LazyPassage]]:
         """
         search passages from each db with given filters. This can search data from multiple db.
         :param ids: list of passage ids
         :param content: content list to filter
         :param filepath: filepath list to filter
+        :param fields: passage fields to return. If given, return LazyPassage which has only id and the fields.
         :param kwargs: metadata_etc to filter. Put metadata_etc key as kwargs key and metadata_etc value as kwargs value.
         """
-        db_origin_list = self.redis_db.get_json(ids)
-        filter_db_origin = list(filter(lambda db_origin: db_origin is not None, db_origin_list))
-        final_db_origin = self.duplicate_check(filter_db_origin)
-        return self.search_each_db(final_db_origin, ids, content=content, filepath=filepath, **kwargs)
+        ids = self.__unique_ids(ids)
+        db_origin_list = self.linker.get_json(ids)
+        final_db_origin = self.duplicate_check(db_origin_list)
+        return self.search_each_db(final_db_origin, ids, content=content, filepath=filepath, fields=fields,
+                                   **kwargs)
 
-    def fetch_each_db(self, final_db_origin: dict[tuple, list[int]], ids: List[Union[UUID, str]]) -> List[Passage]:
+    def fetch_each_db(self, final_db_origin: dict[tuple, list[int]], ids: List[Union[UUID, str]],
+                      fields: Optional[List[str]] = None) -> List[Union[Passage, LazyPassage]]:
         """
         check_dict = {(("db_type": "mongo_db"),
             (('mongo_url': "~"), ('db_name': "~"), ('collection_name': "~"))): [0,  2], ...}
+        Passages of all dbs are assembled in the order of ids, and ids which are not found are skipped.
         """
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            futures = [executor.submit(self.fetch_data_from_db_origin, ids, dict(db_origin), target_ids)
-                       for db_origin, target_ids in final_db_origin.items()]
-        result = []
-        for future in futures:
-            result.extend(future.result())
-        return result
+        executor = RetrievalExecutor.get()
+        futures = [executor.submit(self.fetch_data_from_db_origin, ids, dict(db_origin), target_ids, fields)
+                   for db_origin, target_ids in final_db_origin.items()]
+        return self.__assemble(ids, [future.result() for future in futures])
 
     def search_each_db(self, final_db_origin: dict[tuple, list[int]], ids: List[Union[UUID, str]],
                        content: Optional[List[str]] = None,
                        filepath: Optional[List[str]] = None,
+                       fields: Optional[List[str]] = None,
                        **kwargs
-                       ) -> List[Passage]:
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            futures = [executor.submit(self.search_data_from_db_origin, ids, dict(db_origin),
-                                       target_ids, content, filepath, **kwargs)
-                       for db_origin, target_ids in final_db_origin.items()]
+                       ) -> List[Union[Passage, LazyPassage]]:
+        executor = RetrievalExecutor.get()
+        futures = [executor.submit(self.search_data_from_db_origin, ids, dict(db_origin),
+                                   target_ids, content, filepath, fields, **kwargs)
+                   for db_origin, target_ids in final_db_origin.items()]
         result = []
         for future in futures:
             result.extend(future.result())
         return result
 
-    def fetch_data_from_db_origin(self, ids: List[Union[UUID, str]], db_origin: dict, target_ids: List[int]) -> List[
-        Passage]:
+    def fetch_data_from_db_origin(self, ids: List[Union[UUID, str]], db_origin: dict, target_ids: List[int],
+                                  fields: Optional[List[str]] = None) -> List[Union[Passage, LazyPassage]]:
         db_path = dict(db_origin['db_path'])
         # make db instance
         db = self.is_created(db_origin['db_type'], db_path)
-        db.load()
+        db.load_if_changed()
         # make each id list
         each_ids = [ids[i] for i in target_ids]
         # fetch data
-        fetch_data = db.fetch(each_ids)
+        fetch_data = db.fetch(each_ids, fields=fields)
         return fetch_data
 
+    async def afetch_data_from_db_origin(self, ids: List[Union[UUID, str]], db_origin: dict, target_ids: List[int],
+                                         fields: Optional[List[str]] = None) -> List[Union[Passage, LazyPassage]]:
+        db_path = dict(db_origin['db_path'])
+        # making and loading db are blocking, so they run at a thread
+        db = await run_in_thread(self.__loaded_db, db_origin['db_type'], db_path)
+        return await db.afetch([ids[i] for i in target_ids], fields=fields)
+
+    def __loaded_db(self, db_type: str, db_path: dict) -> BaseDB:
+        db = self.is_created(db_type, db_path)
+        db.load_if_changed()
+        return db
+
     def search_data_from_db_origin(self, ids: List[Union[UUID, str]],
                                    db_origin: dict,
                                    target_ids: List[int],
                                    content: Optional[List[str]] = None,
                                    filepath: Optional[List[str]] = None,
+                                   fields: Optional[List[str]] = None,
                                    **kwargs
-                                   ):
+                                   ) -> List[Union[Passage, LazyPassage]]:
         db_path = dict(db_origin['db_path'])
         # make db instance
         db = self.is_created(db_origin['db_type'], db_path)
-        db.load()
+        db.load_if_changed()
         # make each id list
         each_ids = [ids[i] for i in target_ids]
         # search data
-        result_data = db.search(id=each_ids, content=content, filepath=filepath, **kwargs)
+        result_data = db.search(id=each_ids, content=content, filepath=filepath, fields=fields, **kwargs)
         return result_data
 
     def is_created(self, db_type: str, db_path: dict):
@@ -187,9 +350,25 @@ class BaseRetrieval(ABC):
             return MongoDB(**db_path)
         elif db_type == "pickle_db":
             return PickleDB(**db_path)
+        elif db_type == "sqlite_db":
+            return SQLiteDB(**db_path)
         else:
             raise ValueError(f"Unknown db type: {db_type}")
 
+    @staticmethod
+    def __assemble(ids: List[Union[UUID, str]], passage_lists: List[List[Union[Passage, LazyPassage]]]) -> List[
+        Union[Passage, LazyPassage]]:
+        # passage ids of db can be str of UUID ids or vice versa, so match them with str
+        id_to_passage = {}
+        for passages in passage_lists:
+            id_to_passage.update((str(passage.id), passage) for passage in passages)
+        return [id_to_passage[str_id] for str_id in dict.fromkeys(str(_id) for _id in ids)
+                if str_id in id_to_passage]
+
+    @staticmethod
+    def __unique_ids(ids: List[Union[UUID, str]]) -> List[Union[UUID, str]]:
+        return list(dict.fromkeys(ids))
+
     @staticmethod
     def duplicate_check(db_origin_list: list[dict]) -> dict[tuple, list[int]]:
         """
@@ -203,6 +382,9 @@ class BaseRetrieval(ABC):
         check_origin_duplicate = []
         result = {}
         for index, db_origin in enumerate(db_origin_list):
+            # Sometimes linker doesn't find the id, so skip it and keep index of other ids.
+            if db_origin is None:
+                continue
             # db_origin(dict) to tuple
             tuple_db_origin = tuple(db_origin.items())
             # replace db_path(dict) to tuple
@@ -1,29 +1,46 @@
-import pickle
-from typing import List, Union
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Union, Optional
 from uuid import UUID
 
-import numpy as np
-from rank_bm25 import BM25Okapi
 from tqdm import tqdm
 from transformers import AutoTokenizer
 
 from RAGchain.retrieval.base import BaseRetrieval
 from RAGchain.schema import Passage
+from RAGchain.utils.bm25 import BM25Index, ShardedBM25Index
 from RAGchain.utils.util import FileChecker
 
+_worker_tokenizer = None
+
+
+def _init_tokenizer_worker(tokenizer_name: str):
+    global _worker_tokenizer
+    _worker_tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
+
+
+def _tokenize_in_worker(values: List[str]) -> List[List[int]]:
+    return _worker_tokenizer(values, return_attention_mask=False).input_ids
+
 
 class BM25Retrieval(BaseRetrieval):
     """
     BM25Retrieval class for BM25 retrieval. Save bm25 representation as pkl file and retrieve it.
-    Default data structure looks like this:
-    {
-        "tokens" : [], # 2d list of tokens
-        "passage_id" : [], # 2d list of passage_id. Type must be UUID.
-    }
+    BM25 representation is a segmented inverted index. See BM25Index.
+    save_path stores the manifest of the index, and each ingest appends a new segment to
+    '{save_path without extension}_segments' directory, so ingest costs time proportional to the ingested passages.
+    Small segments are merged at background.
+    Segments are opened with memory-map, so constructing BM25Retrieval is fast, and worker processes that use
+    the same save_path share one page-cache copy of the index.
+    BM25 data saved before segments were introduced must be migrated with BM25Index.migrate before loading.
     """
 
     def __init__(self, save_path: str,
                  tokenizer_name: str = "gpt2",
+                 merge_factor: int = 10,
+                 mode: str = 'exhaustive',
+                 batch_size: int = 1000,
+                 num_workers: int = 0,
+                 num_shards: int = 1,
                  *args, **kwargs):
         """
         Initialize a new instance of the BM25Retrieval class.
@@ -31,72 +48,108 @@ class BM25Retrieval(BaseRetrieval):
         :param save_path: A string representing the path to the saved BM25 data. Must be .pkl or .pickle file.
         :param tokenizer_name: The name of the tokenizer to be used. Must be huggingface tokenizer name.
         Default is "gpt2".
+        :param merge_factor: Segments are merged when this many segments are in the same size tier. Default is 10.
+        :param mode: Top-k retrieval mode. Choose between 'exhaustive', 'wand' and 'bmw'.
+        'wand' and 'bmw' (Block-Max WAND) return same top-k as 'exhaustive', but skip most postings of common terms.
+        You can see the count of evaluated postings at index.postings_evaluated. Default is 'exhaustive'.
+        :param batch_size: Passages count to tokenize at once while ingesting.
+        Fast tokenizer tokenizes a batch in parallel, so it is much faster than tokenizing each passage. Default is 1000.
+        :param num_workers: Process count to tokenize batches while ingesting. It is useful for very large corpus.
+        If it is 0 or 1, tokenize in the current process. Default is 0.
+        :param num_shards: If it is larger than 1, partition the index into this many shards,
+        and score each shard at its own worker process. Use it to score with many cores. See ShardedBM25Index.
+        It must be same as the count of shards of the saved index. Default is 1.
         :param args: Additional positional arguments.
         :param kwargs: Additional keyword arguments.
 
         :returns: None
         """
         super().__init__()
-        self.data = self.load_data(save_path)
-        assert (len(self.data["tokens"]) == len(self.data["passage_id"]))
+        if mode not in BM25Index.MODES:
+            raise ValueError(f"mode should be one of {BM25Index.MODES}, but got {mode}")
+        self.mode = mode
+        FileChecker(save_path).check_type(file_types=[".pkl", ".pickle"])
+        if num_shards > 1:
+            self.index = ShardedBM25Index.load(save_path, num_shards, merge_factor=merge_factor)
+        else:
+            self.index = BM25Index.load(save_path, merge_factor=merge_factor)
         self.save_path = save_path
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.tokenizer_name = tokenizer_name
         self.tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
 
-    @staticmethod
-    def load_data(save_path: str):
-        if FileChecker(save_path).check_type(file_types=[".pkl", ".pickle"]).is_exist():
-            with open(save_path, 'rb') as f:
-                data = pickle.load(f)
-            assert ('tokens' and 'passage_id' in list(data.keys()))
-            return data
-        else:
-            if not FileChecker(save_path).check_type(file_types=[".pkl", ".pickle"]):
-                raise ValueError("input save_path is not pickle file.")
-            return {
-                "tokens": [],
-                "passage_id": [],
-            }
-
     def retrieve(self, query: str, top_k: int = 5, *args, **kwargs) -> List[Passage]:
         ids = self.retrieve_id(query, top_k)
         passage_list = self.fetch_data(ids)
         return passage_list
 
-    def retrieve_id(self, query: str, top_k: int = 5, *args, **kwargs) -> List[Union[str, UUID]]:
-        ids, scores = self.retrieve_id_with_scores(query, top_k)
+    def retrieve_id(self, query: str, top_k: int = 5, *args,
+                    allowed_ids: Optional[List[Union[str, UUID]]] = None, **kwargs) -> List[Union[str, UUID]]:
+        ids, scores = self.retrieve_id_with_scores(query, top_k, allowed_ids=allowed_ids)
         return ids
 
     def ingest(self, passages: List[Passage]):
-        for passage in tqdm(passages):
-            self._save_one(passage)
-        self.persist(self.save_path)
+        self.index.add(self.__tokenize_passages(passages), [passage.id for passage in passages])
 
-    def retrieve_id_with_scores(self, query: str, top_k: int = 5, *args, **kwargs) -> tuple[
-        List[Union[str, UUID]], List[float]]:
-        if self.data is None:
-            raise ValueError("BM25Retriever.data is None. Please save data first.")
+    def upsert(self, passages: List[Passage]):
+        """
+        Ingest passages, and delete existing passages which have the same ids.
+        Use it to re-ingest edited passages, without rebuilding the whole index.
+        :param passages: list of passages to ingest.
+        """
+        self.index.upsert(self.__tokenize_passages(passages), [passage.id for passage in passages])
+
+    def delete(self, ids: List[Union[str, UUID]]) -> int:
+        """
+        Delete passages from the bm25 index. It does not delete passages at DB.
+        Deleted passages are not retrieved, and they are removed from BM25 corpus statistics right away.
+        They are purged from the saved index when their segments are merged.
+        :param ids: list of passage ids to delete. Ids not in the index are ignored.
+        :return: count of deleted passages.
+        """
+        return self.index.delete(ids)
 
-        bm25 = BM25Okapi(self.data["tokens"])
+    def retrieve_id_with_scores(self, query: str, top_k: int = 5, *args,
+                                allowed_ids: Optional[List[Union[str, UUID]]] = None, **kwargs) -> tuple[
+        List[Union[str, UUID]], List[float]]:
+        """
+        retrieve passage ids and bm25 scores of the query.
+        :param query: query string
+        :param top_k: passages count to retrieve
+        :param allowed_ids: If given, only passages of these ids are scored and retrieved.
+        """
         tokenized_query = self.__tokenize([query])[0]
-        scores = bm25.get_scores(tokenized_query)
-        sorted_scores = sorted(scores, reverse=True)
-        top_n_index = np.argsort(scores)[::-1][:top_k]  # this code is from rank_bm25.py in rank_bm25 package
-        ids = [self.data['passage_id'][i] for i in top_n_index]
-        return ids, sorted_scores[:top_k]
-
-    def _save_one(self, passage: Passage):
-        tokenized = self.__tokenize([passage.content])[0]
-        self.data["tokens"].append(tokenized)
-        self.data["passage_id"].append(passage.id)
-
-    def persist(self, save_path: str):
+        return self.index.top_k(tokenized_query, top_k, mode=self.mode, allowed_ids=allowed_ids)
+
+    def supports_allowed_ids(self) -> bool:
+        return True
+
+    def retrieve_id_with_scores_batch(self, queries: List[str], top_k: int = 5) -> tuple[
+        List[List[Union[str, UUID]]], List[List[float]]]:
         """
-        Persist data to save_path as pickle file.
+        retrieve passage ids and scores for multiple queries at once.
+        All queries are tokenized at once and scored with sparse matrix product, so it is much faster than
+        calling retrieve_id_with_scores for each query.
+        :param queries: list of query strings
+        :param top_k: passages count to retrieve for each query
+        :return: 2d list of passage ids and 2d list of scores. Each row is the result of each query.
         """
-        FileChecker(save_path).check_type(file_types=[".pkl", ".pickle"])
-        with open(save_path, 'wb') as f:
-            pickle.dump(self.data, f)
+        tokenized_queries = self.__tokenize(queries)
+        return self.index.top_k_batch(tokenized_queries, top_k)
+
+    def __tokenize_passages(self, passages: List[Passage]) -> List[List[int]]:
+        contents = [passage.content for passage in passages]
+        batches = [contents[i:i + self.batch_size] for i in range(0, len(contents), self.batch_size)]
+        if self.num_workers > 1 and len(batches) > 1:
+            # executor.map keeps the order of batches, so tokens are aligned with passage ids
+            with ProcessPoolExecutor(max_workers=self.num_workers, initializer=_init_tokenizer_worker,
+                                     initargs=(self.tokenizer_name,)) as executor:
+                tokenized_batches = list(tqdm(executor.map(_tokenize_in_worker, batches), total=len(batches)))
+        else:
+            tokenized_batches = [self.__tokenize(batch) for batch in tqdm(batches)]
+        return [token for tokenized_batch in tokenized_batches for token in tokenized_batch]
 
     def __tokenize(self, values: List[str]):
-        tokenized = self.tokenizer(values)
+        tokenized = self.tokenizer(values, return_attention_mask=False)
         return tokenized.input_ids
@@ -1,18 +1,19 @@
-import concurrent.futures
+import asyncio
 from typing import List, Union, Optional
 from uuid import UUID
 
 import numpy as np
-import pandas as pd
 
 from RAGchain.retrieval.base import BaseRetrieval
 from RAGchain.schema import Passage
+from RAGchain.utils.executor import RetrievalExecutor
 
 
 class HybridRetrieval(BaseRetrieval):
     """
     Hybrid Retrieval class for retrieve passages from multiple retrievals.
     You can combine retrieval scores with rrf algorithm or convex combination algorithm.
+    Scores are fused with numpy arrays, and passage ids are interned into integer slots.
     """
     def __init__(self, retrievals: List[BaseRetrieval],
                  weights: Optional[List[float]] = None,
@@ -62,32 +63,80 @@ class HybridRetrieval(BaseRetrieval):
 
     def retrieve_id_with_scores(self, query: str, top_k: int = 5, *args, **kwargs) -> tuple[
         List[Union[str, UUID]], List[float]]:
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            futures = [executor.submit(self.retrieve_id_with_scores_parallel, retrieval, query, self.p, *args, **kwargs)
-                       for retrieval in self.retrievals]
+        executor = RetrievalExecutor.get()
+        futures = [executor.submit(self.retrieve_id_with_scores_parallel, retrieval, query, self.p, *args, **kwargs)
+                   for retrieval in self.retrievals]
+        return self.fuse([future.result() for future in futures], top_k)
+
+    async def aretrieve_id(self, query: str, top_k: int = 5, *args, **kwargs) -> List[Union[str, UUID]]:
+        ids, scores = await self.aretrieve_id_with_scores(query, top_k=top_k, *args, **kwargs)
+        return ids
+
+    async def aretrieve_id_with_scores(self, query: str, top_k: int = 5, *args, **kwargs) -> tuple[
+        List[Union[str, UUID]], List[float]]:
+        """
+        Async version of retrieve_id_with_scores. Each retrieval runs concurrently with aretrieve_id_with_scores.
+        """
+        results = await asyncio.gather(*[retrieval.aretrieve_id_with_scores(query, self.p, *args, **kwargs)
+                                         for retrieval in self.retrievals])
+        return self.fuse(results, top_k)
+
+    def fuse(self, results: List[tuple[List[Union[str, UUID]], List[float]]], top_k: int) -> tuple[
+        List[Union[str, UUID]], List[float]]:
+        """
+        Fuse retrieved ids and scores of each retrieval with self.method.
+        cc fuses passages which are retrieved at every retrieval, and rrf fuses passages retrieved at any retrieval.
+        :param results: ids and scores of each retrieval, in the order of self.retrievals.
+        :param top_k: passages count to return.
+        :return: top_k passage ids and fused scores, sorted by descending fused score.
+        """
+        if self.method not in ('cc', 'rrf'):
+            raise ValueError("method should be either 'cc' or 'rrf'")
+        # intern ids into slots, and make (retrieval count, slot count) score matrix. NaN if not retrieved.
+        slots = {}
+        slot_lists = [[slots.setdefault(str(_id), len(slots)) for _id in ids] for ids, _ in results]
+        score_matrix = np.full((len(results), len(slots)), np.nan)
+        for row, (slot_list, (_, scores)) in enumerate(zip(slot_lists, results)):
+            score_matrix[row, slot_list] = scores
+        is_retrieved = ~np.isnan(score_matrix)
 
         if self.method == 'cc':
-            scores_df = pd.concat([future.result() for future in futures], axis=1, join="inner")
-            normalized_scores = (scores_df - scores_df.min()) / (scores_df.max() - scores_df.min())
-            normalized_scores['weighted_sum'] = normalized_scores.mul(self.weights).sum(axis=1)
-            normalized_scores = normalized_scores.sort_values(by='weighted_sum', ascending=False)
-            return (list(map(self.__str_to_uuid, normalized_scores.index[:top_k].tolist())),
-                    normalized_scores['weighted_sum'][:top_k].tolist())
-        elif self.method == 'rrf':
-            scores_df = pd.concat([future.result() for future in futures], axis=1)
-            rank_df = scores_df.rank(ascending=False, method='min')
-            rank_df = rank_df.fillna(0)
-            rank_df['rrf'] = rank_df.apply(self.__rrf_calculate, axis=1)
-            rank_df = rank_df.sort_values(by='rrf', ascending=False)
-            return (list(map(self.__str_to_uuid, rank_df.index[:top_k].tolist())),
-                    rank_df['rrf'][:top_k].tolist())
+            candidates = np.flatnonzero(is_retrieved.all(axis=0))
+            candidate_scores = score_matrix[:, candidates]
+            if len(candidates) > 0:
+                min_scores = candidate_scores.min(axis=1, keepdims=True)
+                score_ranges = candidate_scores.max(axis=1, keepdims=True) - min_scores
+                # if all scores of a retrieval are the same, they are normalized to 0
+                candidate_scores = np.divide(candidate_scores - min_scores, score_ranges,
+                                             out=np.zeros_like(candidate_scores), where=score_ranges != 0)
+            fused_scores = np.asarray(self.weights, dtype=np.float64) @ candidate_scores
         else:
-            raise ValueError("method should be either 'cc' or 'rrf'")
+            candidates = np.arange(len(slots))
+            # rank with 'min' method: one plus count of higher scores in the same retrieval
+            ranks = np.zeros_like(score_matrix)
+            for row in range(len(results)):
+                retrieved_scores = score_matrix[row, is_retrieved[row]]
+                sorted_scores = np.sort(retrieved_scores)
+                ranks[row, is_retrieved[row]] = len(sorted_scores) - np.searchsorted(
+                    sorted_scores, retrieved_scores, side='right') + 1
+            fused_scores = np.where(is_retrieved, 1 / (ranks + self.rrf_k), 0.0).sum(axis=0)
+
+        top_k_index = self.__arg_top_k(fused_scores, top_k)
+        str_ids = list(slots)
+        return ([self.__str_to_uuid(str_ids[slot]) for slot in candidates[top_k_index]],
+                fused_scores[top_k_index].tolist())
+
+    def supports_allowed_ids(self) -> bool:
+        return all(retrieval.supports_allowed_ids() for retrieval in self.retrievals)
+
+    def max_allowed_ids(self) -> Optional[int]:
+        limits = [retrieval.max_allowed_ids() for retrieval in self.retrievals]
+        limits = [limit for limit in limits if limit is not None]
+        return min(limits) if len(limits) > 0 else None
 
     def retrieve_id_with_scores_parallel(self, retrieval: BaseRetrieval, query: str, top_k: int, *args,
-                                         **kwargs) -> pd.Series:
-        ids, scores = retrieval.retrieve_id_with_scores(query, top_k=top_k, *args, **kwargs)
-        return pd.Series(dict(zip(list(map(str, ids)), scores)))
+                                         **kwargs) -> tuple[List[Union[str, UUID]], List[float]]:
+        return retrieval.retrieve_id_with_scores(query, top_k=top_k, *args, **kwargs)
 
     @staticmethod
     def min_max_normalization(arr: np.ndarray):
@@ -100,10 +149,12 @@ class HybridRetrieval(BaseRetrieval):
         except:
             return input_str
 
-    def __rrf_calculate(self, row):
-        result = 0
-        for r in row:
-            if r == 0:
-                continue
-            result += 1 / (r + self.rrf_k)
-        return result
+    @staticmethod
+    def __arg_top_k(scores: np.ndarray, top_k: int) -> np.ndarray:
+        # passages of same score keep the order of first retrieval
+        if top_k < len(scores):
+            candidate = np.argpartition(-scores, top_k - 1)[:top_k]
+            candidate.sort()
+        else:
+            candidate = np.arange(len(scores))
+        return candidate[np.argsort(-scores[candidate], kind='stable')]
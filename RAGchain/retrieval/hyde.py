@@ -59,6 +59,31 @@ class HyDERetrieval(BaseRetrieval):
         logger.info(f"HyDE answer : {hyde_answer}")
         return self.retrieval.retrieve_id_with_scores(query=hyde_answer, top_k=top_k, *args, **kwargs)
 
+    async def aretrieve_id(self, query: str, top_k: int = 5, model_kwargs: Optional[dict] = {}, *args,
+                           **kwargs) -> List[Union[str, UUID]]:
+        ids, scores = await self.aretrieve_id_with_scores(query, top_k, model_kwargs, *args, **kwargs)
+        return ids
+
+    async def aretrieve_id_with_scores(self, query: str, top_k: int = 5, model_kwargs: Optional[dict] = {}, *args,
+                                       **kwargs) -> tuple[List[Union[str, UUID]], List[float]]:
+        """
+        Async version of retrieve_id_with_scores. Hypothetical passage is generated with async openai API.
+        """
+        user_prompt = f"Question: {query}\nPassage:"
+        completion = await openai.ChatCompletion.acreate(model=self.model_name, messages=[
+            {"role": "system", "content": self.system_prompt},
+            {"role": "user", "content": user_prompt}
+        ], **model_kwargs)
+        hyde_answer = completion["choices"][0]["message"]["content"]
+        logger.info(f"HyDE answer : {hyde_answer}")
+        return await self.retrieval.aretrieve_id_with_scores(hyde_answer, top_k, *args, **kwargs)
+
+    def supports_allowed_ids(self) -> bool:
+        return self.retrieval.supports_allowed_ids()
+
+    def max_allowed_ids(self) -> Optional[int]:
+        return self.retrieval.max_allowed_ids()
+
     @staticmethod
     def make_prompt(prompt: str):
         prompt += "\nQuestion: {0}\nPassage:"
@@ -1,14 +1,30 @@
-from typing import List, Union
+import functools
+import importlib.metadata
+import re
+from typing import List, Union, Optional
 from uuid import UUID
 
 from langchain.schema import Document
-from langchain.vectorstores import VectorStore
+from langchain.vectorstores import VectorStore, Chroma, Pinecone
 
 from RAGchain.retrieval.base import BaseRetrieval
 from RAGchain.schema import Passage
 from RAGchain.utils.vectorstore.base import SlimVectorStore
 
 
+# chromadb supports $in operator at metadata filter from this version
+CHROMA_IN_OPERATOR_VERSION = (0, 4, 9)
+
+
+@functools.lru_cache(maxsize=None)
+def _chroma_supports_in_operator() -> bool:
+    try:
+        version = importlib.metadata.version('chromadb')
+    except importlib.metadata.PackageNotFoundError:
+        return False
+    return tuple(int(number) for number in re.findall(r'\d+', version)[:3]) >= CHROMA_IN_OPERATOR_VERSION
+
+
 class VectorDBRetrieval(BaseRetrieval):
     """
     VectorDBRetrieval is a retrieval class that uses VectorDB as a backend.
@@ -17,12 +33,15 @@ class VectorDBRetrieval(BaseRetrieval):
     When retrieving, embed the query and search the most similar vectors in VectorDB.
     Lastly, return the passages that have the most similar vectors.
     """
-    def __init__(self, vectordb: VectorStore, *args, **kwargs):
+    def __init__(self, vectordb: VectorStore, max_allowed_ids: int = 1000, *args, **kwargs):
         """
         :param vectordb: VectorStore instance. You can all langchain VectorStore classes, also you can use SlimVectorStore for better storage efficiency.
+        :param max_allowed_ids: max count of passage ids at one metadata filter. Pinecone limits count of $in values,
+        so retrieve_with_filter filters retrieved passages when more passages match. Default is 1000.
         """
         super().__init__()
         self.vectordb = vectordb
+        self.__max_allowed_ids = max_allowed_ids
 
     def ingest(self, passages: List[Passage]):
         if isinstance(self.vectordb, SlimVectorStore):
@@ -37,18 +56,47 @@ class VectorDBRetrieval(BaseRetrieval):
         passage_list = self.fetch_data(ids)
         return passage_list
 
-    def retrieve_id(self, query: str, top_k: int = 5, *args, **kwargs) -> List[Union[str, UUID]]:
-        docs = self.vectordb.similarity_search(query=query, k=top_k)
+    def retrieve_id(self, query: str, top_k: int = 5, *args,
+                    allowed_ids: Optional[List[Union[str, UUID]]] = None, **kwargs) -> List[Union[str, UUID]]:
+        docs = self.vectordb.similarity_search(query=query, k=top_k, **self.__filter_kwargs(allowed_ids))
+        return [self.__str_to_uuid(doc.metadata.get('passage_id')) for doc in docs]
+
+    async def aretrieve_id(self, query: str, top_k: int = 5, *args,
+                           allowed_ids: Optional[List[Union[str, UUID]]] = None, **kwargs) -> List[Union[str, UUID]]:
+        docs = await self.vectordb.asimilarity_search(query=query, k=top_k, **self.__filter_kwargs(allowed_ids))
         return [self.__str_to_uuid(doc.metadata.get('passage_id')) for doc in docs]
 
-    def retrieve_id_with_scores(self, query: str, top_k: int = 5, *args, **kwargs) -> tuple[
+    def retrieve_id_with_scores(self, query: str, top_k: int = 5, *args,
+                                allowed_ids: Optional[List[Union[str, UUID]]] = None, **kwargs) -> tuple[
         List[Union[str, UUID]], List[float]]:
-        results = self.vectordb.similarity_search_with_score(query=query, k=top_k)
+        results = self.vectordb.similarity_search_with_score(query=query, k=top_k,
+                                                             **self.__filter_kwargs(allowed_ids))
         results = results[::-1]
         docs = [result[0] for result in results]
         scores = [result[1] for result in results]
         return [self.__str_to_uuid(doc.metadata.get('passage_id')) for doc in docs], scores
 
+    def supports_allowed_ids(self) -> bool:
+        """
+        Chroma and Pinecone filter passage_id metadata with $in operator at the search,
+        so only allowed passages are searched. Chroma supports $in operator from chromadb 0.4.9.
+        """
+        if isinstance(self.vectordb, Pinecone):
+            return True
+        return isinstance(self.vectordb, Chroma) and _chroma_supports_in_operator()
+
+    def max_allowed_ids(self) -> Optional[int]:
+        return self.__max_allowed_ids
+
+    def __filter_kwargs(self, allowed_ids: Optional[List[Union[str, UUID]]]) -> dict:
+        if allowed_ids is None:
+            return {}
+        if not self.supports_allowed_ids():
+            raise ValueError(f"{type(self.vectordb).__name__} does not support allowed_ids")
+        if len(allowed_ids) > self.__max_allowed_ids:
+            raise ValueError(f"allowed_ids count {len(allowed_ids)} is over max_allowed_ids {self.__max_allowed_ids}")
+        return {'filter': {'passage_id': {'$in': [str(_id) for _id in allowed_ids]}}}
+
     @staticmethod
     def __str_to_uuid(input_str: str) -> Union[str, UUID]:
         try:
@@ -1,2 +1,3 @@
 from .db_origin import DBOrigin
 from .passage import Passage
+from .lazy_passage import LazyPassage
@@ -0,0 +1,62 @@
+from typing import Callable, List, Union, Optional
+from uuid import UUID
+
+from RAGchain.schema.passage import Passage
+
+
+class LazyPassage:
+    """
+    Lightweight passage record which has only id and projected fields of the passage.
+    DBs return it when fetch or search is called with fields.
+    Fields which are not projected are loaded with the full passage from the DB at first access.
+    """
+    FIELDS = ('content', 'filepath', 'previous_passage_id', 'next_passage_id', 'metadata_etc')
+
+    def __init__(self, id: Union[UUID, str], loader: Callable[[], Passage], **fields):
+        """
+        :param id: passage id.
+        :param loader: function that loads the full passage from the DB.
+        It raises KeyError when the passage is deleted from the DB.
+        :param fields: projected fields of the passage.
+        """
+        self.id = id
+        self._loader = loader
+        self._passage: Optional[Passage] = None
+        self.__dict__.update(fields)
+
+    def __getattr__(self, name: str):
+        # called only for fields which are not projected
+        if name not in LazyPassage.FIELDS:
+            raise AttributeError(f"'LazyPassage' object has no attribute '{name}'")
+        return getattr(self.to_passage(), name)
+
+    def __eq__(self, other):
+        if isinstance(other, (Passage, LazyPassage)):
+            return self.id == other.id
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __repr__(self):
+        return f'LazyPassage(id={self.id!r})'
+
+    def to_passage(self) -> Passage:
+        """Returns the full passage. It is loaded from the DB only once."""
+        if self._passage is None:
+            self._passage = self._loader()
+        return self._passage
+
+    @classmethod
+    def from_passage(cls, passage: Passage, fields: List[str]) -> 'LazyPassage':
+        """Makes LazyPassage of the passage which is already loaded, like passages of PickleDB."""
+        lazy_passage = cls(passage.id, lambda: passage, **{field: getattr(passage, field) for field in fields})
+        lazy_passage._passage = passage
+        return lazy_passage
+
+    @classmethod
+    def check_fields(cls, fields: List[str]):
+        """Raises ValueError if there is a field which is not a field of Passage."""
+        unknown_fields = [field for field in fields if field not in cls.FIELDS]
+        if len(unknown_fields) > 0:
+            raise ValueError(f"Unknown passage fields: {unknown_fields}. Fields should be one of {cls.FIELDS}")
@@ -44,7 +44,8 @@ class Passage(Serializable):
     def __eq__(self, other):
         if isinstance(other, Passage):
             return self.id == other.id
-        return False
+        # let other types like LazyPassage compare, so comparison is symmetric
+        return NotImplemented
 
     def __hash__(self):
         return hash(self.id)
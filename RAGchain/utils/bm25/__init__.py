@@ -0,0 +1,3 @@
+from .index import BM25Index
+from .segment import BM25Segment
+from .sharded import ShardedBM25Index
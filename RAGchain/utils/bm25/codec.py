@@ -0,0 +1,70 @@
+import numpy as np
+
+
+def varbyte_sizes(values: np.ndarray) -> np.ndarray:
+    """
+    Get encoded byte count of each value with varbyte_encode.
+    """
+    values = np.asarray(values, dtype=np.int64)
+    return 1 + sum((values >= (1 << (7 * i))).astype(np.int64) for i in range(1, 5))
+
+
+def varbyte_encode(values: np.ndarray) -> np.ndarray:
+    """
+    Encode non-negative integers with variable-byte encoding.
+    Each value is split to 7-bit groups from the lowest bits, and the high bit of a byte is set
+    when more bytes of the same value follow. So small values like doc gaps and term frequencies take one byte.
+    :param values: non-negative integers. Must be less than 2 ** 35.
+    :return: uint8 array of encoded bytes.
+    """
+    values = np.asarray(values, dtype=np.int64)
+    if len(values) == 0:
+        return np.zeros(0, dtype=np.uint8)
+    byte_counts = varbyte_sizes(values)
+    value_index = np.repeat(np.arange(len(values)), byte_counts)
+    value_start = np.cumsum(byte_counts) - byte_counts
+    byte_position = np.arange(len(value_index)) - value_start[value_index]
+    encoded = (values[value_index] >> (7 * byte_position)) & 0x7f
+    encoded |= (byte_position < byte_counts[value_index] - 1).astype(np.int64) << 7
+    return encoded.astype(np.uint8)
+
+
+def varbyte_decode(data: np.ndarray) -> np.ndarray:
+    """
+    Decode bytes from varbyte_encode. It is vectorized, so it decodes many values without python loop.
+    :param data: uint8 array of encoded bytes. It must end at the last byte of a value.
+    :return: int64 array of decoded values.
+    """
+    data = np.asarray(data)
+    if len(data) == 0:
+        return np.zeros(0, dtype=np.int64)
+    if data.max() < 0x80:
+        # every value is one byte
+        return data.astype(np.int64)
+    value_end = np.flatnonzero(data < 0x80)
+    values = data[value_end].astype(np.int64)
+    # most values are one byte, so add lower 7-bit groups only to values that have them
+    index = np.arange(len(values))
+    position = value_end
+    while True:
+        position = position - 1
+        has_more = position >= 0
+        has_more[has_more] = data[position[has_more]] >= 0x80
+        index, position = index[has_more], position[has_more]
+        if len(index) == 0:
+            return values
+        values[index] = (values[index] << 7) | (data[position] & 0x7f)
+
+
+def gather_ranges(array: np.ndarray, starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    """
+    Concatenate array[starts[i]:ends[i]] for every i, without python loop.
+    """
+    lengths = ends - starts
+    if len(lengths) == 0:
+        return array[:0]
+    if np.all(starts[1:] == ends[:-1]):
+        # contiguous ranges, like all blocks of one term
+        return array[starts[0]:ends[-1]]
+    index = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths) + np.arange(int(lengths.sum()))
+    return array[index]
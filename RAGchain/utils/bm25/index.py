@@ -0,0 +1,562 @@
+import math
+import os
+import pickle
+import shutil
+import threading
+from collections import Counter
+from typing import List, Union, Optional
+from uuid import UUID
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from RAGchain.utils.bm25.pruning import DynamicPruning, TermPostings
+from RAGchain.utils.bm25.segment import BM25Segment
+from RAGchain.utils.file_lock import file_lock
+
+
+class BM25Index:
+    """
+    Segmented inverted index for BM25 scoring.
+    Each ingest writes a small immutable BM25Segment, and queries fan out across all segments
+    with corpus statistics (idf and average doc length) computed globally, so scores are same as
+    rank_bm25.BM25Okapi over the whole corpus, including epsilon flooring of negative idf values.
+    Small segments are merged into larger ones at background.
+    top_k supports exhaustive scoring, and safe dynamic pruning with WAND or Block-Max WAND.
+    postings_evaluated and postings_total count postings scored and postings of query terms,
+    so you can see how many postings are skipped by dynamic pruning.
+    Deleted passages are marked as tombstones at their segments and filtered at scoring.
+    Corpus statistics exclude them right away, and they are purged when their segments are merged.
+
+    When save_path is given, it stores the manifest of the index as pickle file,
+    and segments are stored at '{save_path without extension}_segments' directory.
+    Saved segments are opened with memory-map, so loading the index is near-instant,
+    and multiple processes share one page-cache copy of the index.
+    Manifest data structure looks like this:
+    {
+        "segments" : [], # directory names of segments, in doc ordinal order
+        "next_segment" : 0, # number of the next segment file name
+        "deleted" : {}, # segment directory name to deleted doc ordinals of the segment
+    }
+    """
+
+    MODES = ['exhaustive', 'wand', 'bmw']
+    # a segment is purged by itself when this ratio of its docs are deleted
+    PURGE_RATIO = 0.3
+
+    def __init__(self, save_path: Optional[str] = None,
+                 k1: float = 1.5, b: float = 0.75, epsilon: float = 0.25,
+                 merge_factor: int = 10, background_merge: bool = True,
+                 max_batch_scores: int = 1 << 24, cache_weight_matrix: bool = False):
+        """
+        :param save_path: path of the manifest pickle file. If None, the index is kept in memory only.
+        :param k1: BM25 k1 parameter. Default is 1.5.
+        :param b: BM25 b parameter. Default is 0.75.
+        :param epsilon: floor of negative idf values, as a ratio of average idf. Default is 0.25.
+        :param merge_factor: merge segments when this many segments are in the same size tier. Default is 10.
+        :param background_merge: If True, merge segments at background thread after add. Default is True.
+        :param max_batch_scores: max count of scores computed at once in top_k_batch.
+        Queries are split into chunks to keep this limit. Default is 2^24.
+        :param cache_weight_matrix: If True, keep the weight matrix of each segment for next top_k_batch calls.
+        The matrix takes 12 bytes per posting, so it is built for each call and dropped by default. Default is False.
+        """
+        self.save_path = save_path
+        self.segment_dir = None if save_path is None else f'{os.path.splitext(save_path)[0]}_segments'
+        self.k1 = k1
+        self.b = b
+        self.epsilon = epsilon
+        self.merge_factor = merge_factor
+        self.background_merge = background_merge
+        self.segments: List[BM25Segment] = []
+        self.next_segment = 0
+        self.df = np.zeros(0, dtype=np.int64)
+        self.corpus_size = 0
+        self.total_len = 0
+        self.idf = np.zeros(0, dtype=np.float64)
+        self.avgdl = 0.0
+        self.max_batch_scores = max_batch_scores
+        self.cache_weight_matrix = cache_weight_matrix
+        self.postings_evaluated = 0
+        self.postings_total = 0
+        self._lock = threading.Lock()
+        self._merge_lock = threading.Lock()
+        self._merge_thread: Optional[threading.Thread] = None
+
+    def __len__(self):
+        return self.corpus_size
+
+    @classmethod
+    def from_tokens(cls, tokens: List[List[int]], passage_ids: List[Union[str, UUID]], **kwargs) -> 'BM25Index':
+        """
+        Build an in-memory index from tokenized passages.
+        :param tokens: 2d list of token ids. Each row is one passage.
+        :param passage_ids: passage id of each row.
+        :param kwargs: parameters of the index. See __init__.
+        """
+        index = cls(**kwargs)
+        index.add(tokens, passage_ids)
+        return index
+
+    @classmethod
+    def load(cls, save_path: str, **kwargs) -> 'BM25Index':
+        """
+        Load index from the manifest pickle file. If the file does not exist, make a new empty index.
+        It does not write any file. Legacy data, which is {"tokens": [], "passage_id": []},
+        must be migrated with migrate first.
+        :param save_path: path of the manifest pickle file.
+        :param kwargs: parameters of the index. See __init__.
+        """
+        index = cls(save_path=save_path, **kwargs)
+        if not os.path.exists(save_path):
+            return index
+        with open(save_path, 'rb') as f:
+            manifest = pickle.load(f)
+        if "tokens" in manifest.keys():
+            raise ValueError(f"{save_path} is legacy BM25 data. Migrate it with BM25Index.migrate first.")
+        index.next_segment = manifest["next_segment"]
+        deleted = manifest.get("deleted", {})
+        for name in manifest["segments"]:
+            segment = BM25Segment.load(os.path.join(index.segment_dir, name), name=name)
+            if name in deleted:
+                segment.deleted = np.zeros(len(segment), dtype=bool)
+                segment.deleted[deleted[name]] = True
+            index._add_segment(segment)
+        index._update_idf()
+        return index
+
+    @classmethod
+    def migrate(cls, save_path: str, **kwargs) -> bool:
+        """
+        Migrate legacy data, which is {"tokens": [], "passage_id": []}, to a segment.
+        The manifest is replaced after the segment is written, and it holds the lock of '{save_path}.lock' file,
+        so other processes migrating the same file wait and do nothing.
+        :param save_path: path of the legacy pickle file.
+        :param kwargs: parameters of the index. See __init__.
+        :return: True if the file is migrated, False if it is not legacy data or does not exist.
+        """
+        with file_lock(f'{save_path}.lock'):
+            if not os.path.exists(save_path):
+                return False
+            with open(save_path, 'rb') as f:
+                manifest = pickle.load(f)
+            if "tokens" not in manifest.keys():
+                return False
+            index = cls(save_path=save_path, **{**kwargs, "background_merge": False})
+            index.add(manifest["tokens"], manifest["passage_id"])
+            return True
+
+    def add(self, tokens: List[List[int]], passage_ids: List[Union[str, UUID]]):
+        """
+        Add tokenized passages as a new segment. It only costs time proportional to the given passages.
+        :param tokens: 2d list of token ids. Each row is one passage.
+        :param passage_ids: passage id of each row.
+        """
+        self._add(tokens, passage_ids, replace=False)
+
+    def upsert(self, tokens: List[List[int]], passage_ids: List[Union[str, UUID]]):
+        """
+        Add tokenized passages as a new segment, and delete existing passages which have the same ids.
+        Queries see both changes at once.
+        :param tokens: 2d list of token ids. Each row is one passage.
+        :param passage_ids: passage id of each row.
+        """
+        self._add(tokens, passage_ids, replace=True)
+
+    def delete(self, passage_ids: List[Union[str, UUID]]) -> int:
+        """
+        Delete passages by ids. Ids are compared as strings.
+        Deleted passages are filtered at scoring, and corpus statistics are updated right away.
+        :param passage_ids: ids of passages to delete. Ids not in the index are ignored.
+        :return: count of deleted passages.
+        """
+        with self._lock:
+            deleted_count = self._delete(passage_ids)
+            if deleted_count > 0:
+                self._update_idf()
+                self._write_manifest()
+        if deleted_count > 0 and self.background_merge:
+            self.merge(wait=False)
+        return deleted_count
+
+    def set_corpus_stats(self, df: np.ndarray, corpus_size: int, total_len: int):
+        """
+        Score with the given corpus statistics instead of the statistics of this index.
+        Use it when this index is a shard of a larger corpus, so scores are same as the whole corpus.
+        Do not add or delete passages after this, because they update the given statistics with this index.
+        :param df: document frequency of each term.
+        :param corpus_size: passages count.
+        :param total_len: sum of token counts of all passages.
+        """
+        with self._lock:
+            self.df = np.array(df, dtype=np.int64)
+            self.corpus_size = corpus_size
+            self.total_len = total_len
+            self._update_idf()
+
+    def _add(self, tokens: List[List[int]], passage_ids: List[Union[str, UUID]], replace: bool):
+        if len(tokens) == 0:
+            return
+        segment = self._save_segment(BM25Segment.from_tokens(tokens, passage_ids))
+        with self._lock:
+            if replace:
+                self._delete(passage_ids)
+            self._add_segment(segment)
+            self._update_idf()
+            self._write_manifest()
+        if self.background_merge:
+            self.merge(wait=False)
+
+    def _delete(self, passage_ids: List[Union[str, UUID]]) -> int:
+        """
+        Mark passages as deleted and remove them from corpus statistics. It must be called with the lock.
+        """
+        deleted_count = 0
+        for segment in self.segments:
+            docs = segment.passage_id.ordinals(passage_ids)
+            if segment.deleted is not None:
+                docs = docs[~segment.deleted[docs]]
+            if len(docs) == 0:
+                continue
+            deleted = np.zeros(len(segment), dtype=bool)
+            deleted[docs] = True
+            self._remove_stats(segment, docs)
+            # replace the array, so running queries and merges keep their own snapshot
+            segment.deleted = deleted if segment.deleted is None else segment.deleted | deleted
+            deleted_count += len(docs)
+        return deleted_count
+
+    def merge(self, wait: bool = True):
+        """
+        Merge small segments into larger ones.
+        Segments are grouped by size tier, and merge_factor segments in the same tier are merged into one.
+        :param wait: If False, merge at background thread and return immediately.
+        """
+        if not wait:
+            if self._merge_thread is not None and self._merge_thread.is_alive():
+                return
+            self._merge_thread = threading.Thread(target=self.merge, daemon=True)
+            self._merge_thread.start()
+            return
+        with self._merge_lock:
+            while True:
+                targets = self._find_merge_targets()
+                if targets is None:
+                    break
+                with self._lock:
+                    deleted = [target.deleted for target in targets]
+                live_count = sum(len(target) - (0 if purged is None else int(purged.sum()))
+                                 for target, purged in zip(targets, deleted))
+                merged = self._save_segment(BM25Segment.merge(targets, deleted)) if live_count > 0 else None
+                with self._lock:
+                    if merged is not None:
+                        self._carry_deleted(targets, deleted, merged)
+                    position = self.segments.index(targets[0])
+                    segments = [segment for segment in self.segments if segment not in targets]
+                    if merged is not None:
+                        segments.insert(position, merged)
+                    # replace the list, so running queries keep their own snapshot
+                    self.segments = segments
+                    self._write_manifest()
+                for target in targets:
+                    # retired segments are kept by running queries only, so they do not need the cache
+                    target.clear_cache()
+                    self._remove_segment(target)
+
+    @staticmethod
+    def _carry_deleted(targets: List[BM25Segment], deleted: List[Optional[np.ndarray]], merged: BM25Segment):
+        """
+        Mark docs deleted while merging at the merged segment.
+        :param deleted: deleted docs of each target when the merge started, which are purged at the merged segment.
+        """
+        offset = 0
+        for target, purged in zip(targets, deleted):
+            purged = np.zeros(len(target), dtype=bool) if purged is None else purged
+            if target.deleted is not None and target.deleted is not purged:
+                new_ordinal = np.cumsum(~purged) - 1 + offset
+                merged_deleted = np.zeros(len(merged), dtype=bool) if merged.deleted is None else merged.deleted
+                merged_deleted[new_ordinal[target.deleted & ~purged]] = True
+                merged.deleted = merged_deleted
+            offset += int((~purged).sum())
+
+    def wait_merge(self):
+        """Wait until the background merge finishes."""
+        if self._merge_thread is not None:
+            self._merge_thread.join()
+
+    def get_scores(self, query_tokens: List[int]) -> np.ndarray:
+        """
+        Get BM25 scores of every live doc in doc ordinal order for a tokenized query.
+        """
+        segments, idf, avgdl = self._snapshot()
+        if len(segments) == 0:
+            return np.zeros(0, dtype=np.float64)
+        return np.concatenate([segment.get_scores(query_tokens, idf, avgdl, self.k1, self.b)[segment.live_docs()]
+                               for segment in segments])
+
+    def top_k(self, query_tokens: List[int], top_k: int = 5, mode: str = 'exhaustive',
+              allowed_ids: Optional[List[Union[str, UUID]]] = None) -> tuple[List[Union[str, UUID]], List[float]]:
+        """
+        Get top_k passage ids and scores for a tokenized query, sorted by descending score.
+        Each segment is scored with global corpus statistics, and top_k of each segment are merged.
+        :param query_tokens: tokenized query.
+        :param top_k: passages count to retrieve.
+        :param mode: 'exhaustive', 'wand' or 'bmw'. 'wand' and 'bmw' return same top_k scores as 'exhaustive',
+        but skip postings that can not make into top_k with WAND or Block-Max WAND. Default is 'exhaustive'.
+        :param allowed_ids: If given, only passages of these ids are scored and retrieved. mode is ignored,
+        because only blocks of postings which may contain the allowed passages are decoded.
+        """
+        if mode not in self.MODES:
+            raise ValueError(f"mode should be one of {self.MODES}, but got {mode}")
+        segments, idf, avgdl = self._snapshot()
+        if len(segments) == 0 or top_k <= 0:
+            return [], []
+        if allowed_ids is not None:
+            return self._top_k_allowed(segments, idf, avgdl, query_tokens, top_k, allowed_ids)
+        if mode != 'exhaustive':
+            pruning = DynamicPruning(segments, idf, avgdl, self.k1, self.b, block_max=(mode == 'bmw'))
+            result = pruning.top_k(query_tokens, top_k)
+            if result is not None:
+                self._count_postings(pruning.postings_evaluated, pruning.postings_total)
+                return ([segments[segment_index].passage_id[doc] for _, segment_index, doc in result],
+                        [score for score, _, _ in result])
+
+        candidate_ids, candidate_scores = [], []
+        postings = 0
+        for segment in segments:
+            scores = segment.get_scores(query_tokens, idf, avgdl, self.k1, self.b)
+            postings += sum(int(segment.term_ptr[term + 1] - segment.term_ptr[term])
+                            for term in set(query_tokens) if term < segment.vocab_size)
+            live_docs = segment.live_docs()
+            top_n_index = live_docs[self.arg_top_k(scores[live_docs], top_k)]
+            candidate_ids.extend(segment.passage_id[i] for i in top_n_index)
+            candidate_scores.append(scores[top_n_index])
+        self._count_postings(postings, postings)
+        candidate_scores = np.concatenate(candidate_scores)
+        top_n_index = self.arg_top_k(candidate_scores, top_k)
+        return [candidate_ids[i] for i in top_n_index], candidate_scores[top_n_index].tolist()
+
+    def _top_k_allowed(self, segments: List[BM25Segment], idf: np.ndarray, avgdl: float,
+                       query_tokens: List[int], top_k: int,
+                       allowed_ids: List[Union[str, UUID]]) -> tuple[List[Union[str, UUID]], List[float]]:
+        """
+        Score only allowed docs of each segment, and merge top_k of each segment.
+        """
+        # repeated query tokens are counted repeatedly, so they are weighted by their count
+        query_terms = [(term, count) for term, count in Counter(query_tokens).items()
+                       if term < len(idf) and idf[term] != 0]
+        candidate_ids, candidate_scores = [], []
+        evaluated, total = 0, 0
+        for segment in segments:
+            docs = segment.passage_id.ordinals(allowed_ids)
+            if segment.deleted is not None:
+                docs = docs[~segment.deleted[docs]]
+            if len(docs) == 0:
+                continue
+            scores = np.zeros(len(docs), dtype=np.float64)
+            for term, count in query_terms:
+                if term >= segment.vocab_size:
+                    continue
+                postings = TermPostings(segment, term, idf[term] * count, avgdl, self.k1, self.b)
+                term_scores, matched = postings.lookup(docs)
+                scores += term_scores
+                evaluated += matched
+                total += len(postings)
+            top_n_index = self.arg_top_k(scores, top_k)
+            candidate_ids.extend(segment.passage_id[docs[i]] for i in top_n_index)
+            candidate_scores.append(scores[top_n_index])
+        self._count_postings(evaluated, total)
+        if len(candidate_scores) == 0:
+            return [], []
+        candidate_scores = np.concatenate(candidate_scores)
+        top_n_index = self.arg_top_k(candidate_scores, top_k)
+        return [candidate_ids[i] for i in top_n_index], candidate_scores[top_n_index].tolist()
+
+    def top_k_batch(self, queries_tokens: List[List[int]], top_k: int = 5) -> tuple[
+        List[List[Union[str, UUID]]], List[List[float]]]:
+        """
+        Get top_k passage ids and scores for each tokenized query, sorted by descending score.
+        All queries are scored against the term-document weight matrix of each segment in one sparse matmul.
+        :param queries_tokens: 2d list of token ids. Each row is one query.
+        :param top_k: passages count to retrieve for each query.
+        :return: 2d list of passage ids and 2d list of scores. Each row is the result of each query.
+        """
+        segments, idf, avgdl = self._snapshot()
+        if len(segments) == 0 or top_k <= 0:
+            return [[] for _ in queries_tokens], [[] for _ in queries_tokens]
+        query_matrix = self._query_matrix(queries_tokens, len(idf))
+        candidate_segments, candidate_docs, candidate_scores = [], [], []
+        for segment_index, segment in enumerate(segments):
+            weight_matrix = segment.weight_matrix(idf, avgdl, self.k1, self.b, cache=self.cache_weight_matrix)
+            segment_query_matrix = query_matrix[:, :segment.vocab_size]
+            chunk_size = max(1, self.max_batch_scores // max(len(segment), 1))
+            docs, scores = [], []
+            for start in range(0, len(queries_tokens), chunk_size):
+                chunk_docs, chunk_scores = self._sparse_top_k_rows(
+                    segment_query_matrix[start:start + chunk_size] @ weight_matrix, top_k, segment.deleted)
+                docs.append(chunk_docs)
+                scores.append(chunk_scores)
+            docs = np.concatenate(docs)
+            candidate_docs.append(docs)
+            candidate_scores.append(np.concatenate(scores))
+            candidate_segments.append(np.full(docs.shape, segment_index))
+        candidate_index, scores = self.arg_top_k_rows(np.concatenate(candidate_scores, axis=1), top_k)
+        segment_index = np.take_along_axis(np.concatenate(candidate_segments, axis=1), candidate_index, axis=1)
+        doc_index = np.take_along_axis(np.concatenate(candidate_docs, axis=1), candidate_index, axis=1)
+        # deleted docs have -inf score, and they are in top_k only when live docs are less than top_k
+        is_live = np.isfinite(scores)
+        ids = [[segments[s].passage_id[d] for s, d in zip(segment_row[live_row], doc_row[live_row])]
+               for segment_row, doc_row, live_row in zip(segment_index, doc_index, is_live)]
+        return ids, [score_row[live_row].tolist() for score_row, live_row in zip(scores, is_live)]
+
+    def _sparse_top_k_rows(self, scores: csr_matrix, top_k: int,
+                           deleted: Optional[np.ndarray] = None) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Get indices and values of top_k scores at each row of sparse scores matrix.
+        Only stored scores are ranked, unless the row has less than top_k positive scores.
+        Then the row is ranked densely, because docs with zero score can be in top_k.
+        Deleted docs are not stored at the weight matrix, so they get -inf score at dense ranking.
+        """
+        top_k = min(top_k, scores.shape[1])
+        docs = np.zeros((scores.shape[0], top_k), dtype=np.int64)
+        values = np.zeros((scores.shape[0], top_k), dtype=np.float64)
+        for row in range(scores.shape[0]):
+            start, end = scores.indptr[row], scores.indptr[row + 1]
+            row_values = scores.data[start:end]
+            if end - start >= top_k and np.sum(row_values > 0) >= top_k:
+                row_top_k = self.arg_top_k(row_values, top_k)
+                docs[row], values[row] = scores.indices[start:end][row_top_k], row_values[row_top_k]
+            else:
+                dense_values = scores[row].toarray()[0]
+                if deleted is not None:
+                    dense_values[deleted] = -np.inf
+                row_top_k = self.arg_top_k(dense_values, top_k)
+                docs[row], values[row] = row_top_k, dense_values[row_top_k]
+        return docs, values
+
+    @staticmethod
+    def _query_matrix(queries_tokens: List[List[int]], vocab_size: int) -> csr_matrix:
+        """
+        Make sparse query-term count matrix, which shape is (query count, vocab_size).
+        Repeated query tokens are counted repeatedly, same as rank_bm25.
+        """
+        rows = np.repeat(np.arange(len(queries_tokens)), [len(tokens) for tokens in queries_tokens])
+        cols = np.fromiter((token for tokens in queries_tokens for token in tokens), dtype=np.int64,
+                           count=len(rows))
+        in_vocab = cols < vocab_size
+        rows, cols = rows[in_vocab], cols[in_vocab]
+        # duplicated (row, col) entries are summed up
+        return csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(len(queries_tokens), vocab_size))
+
+    @staticmethod
+    def arg_top_k_rows(scores: np.ndarray, top_k: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Get indices and values of top_k scores at each row, sorted by descending score.
+        """
+        if top_k < scores.shape[1]:
+            candidate = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+        else:
+            candidate = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+        candidate_scores = np.take_along_axis(scores, candidate, axis=1)
+        order = np.argsort(-candidate_scores, axis=1, kind='stable')
+        return np.take_along_axis(candidate, order, axis=1), np.take_along_axis(candidate_scores, order, axis=1)
+
+    @staticmethod
+    def arg_top_k(scores: np.ndarray, top_k: int) -> np.ndarray:
+        """
+        Get indices of top_k scores, sorted by descending score.
+        """
+        if top_k < len(scores):
+            candidate = np.argpartition(-scores, top_k - 1)[:top_k]
+        else:
+            candidate = np.arange(len(scores))
+        return candidate[np.argsort(-scores[candidate], kind='stable')]
+
+    def _count_postings(self, evaluated: int, total: int):
+        with self._lock:
+            self.postings_evaluated += evaluated
+            self.postings_total += total
+
+    def _snapshot(self) -> tuple[List[BM25Segment], np.ndarray, float]:
+        with self._lock:
+            return self.segments, self.idf, self.avgdl
+
+    def _add_segment(self, segment: BM25Segment):
+        if segment.vocab_size > len(self.df):
+            self.df = np.pad(self.df, (0, segment.vocab_size - len(self.df)))
+        self.df[:segment.vocab_size] += segment.df
+        self.corpus_size += len(segment)
+        self.total_len += int(segment.doc_len.sum())
+        if segment.deleted is not None:
+            self._remove_stats(segment, np.flatnonzero(segment.deleted))
+        self.segments = self.segments + [segment]
+
+    def _remove_stats(self, segment: BM25Segment, docs: np.ndarray):
+        df, total_len = segment.doc_stats(docs)
+        self.df = self.df.copy()
+        self.df[:segment.vocab_size] -= df
+        self.corpus_size -= len(docs)
+        self.total_len -= total_len
+
+    def _update_idf(self):
+        """
+        Compute idf of each term and average doc length from global corpus statistics.
+        """
+        idf = np.zeros(len(self.df), dtype=np.float64)
+        exist = self.df > 0
+        if self.corpus_size > 0 and exist.any():
+            exist_idf = np.log(self.corpus_size - self.df[exist] + 0.5) - np.log(self.df[exist] + 0.5)
+            average_idf = exist_idf.sum() / len(exist_idf)
+            exist_idf[exist_idf < 0] = self.epsilon * average_idf
+            idf[exist] = exist_idf
+        self.idf = idf
+        self.avgdl = self.total_len / self.corpus_size if self.corpus_size > 0 else 0.0
+
+    def _find_merge_targets(self) -> Optional[List[BM25Segment]]:
+        segments, _, _ = self._snapshot()
+        tiers = {}
+        for segment in segments:
+            if segment.deleted_count > 0 and segment.deleted_count >= self.PURGE_RATIO * len(segment):
+                return [segment]
+            tier = int(math.log(max(len(segment), 1), self.merge_factor))
+            tiers.setdefault(tier, []).append(segment)
+            if len(tiers[tier]) >= self.merge_factor:
+                return tiers[tier]
+        return None
+
+    def _save_segment(self, segment: BM25Segment) -> BM25Segment:
+        """
+        Save the segment and return the memory-mapped segment.
+        If the index is in memory only, return the given segment.
+        """
+        if self.save_path is None:
+            return segment
+        with self._lock:
+            if not os.path.exists(self.segment_dir):
+                os.makedirs(self.segment_dir)
+            name = f'segment_{self.next_segment:08d}'
+            self.next_segment += 1
+        path = os.path.join(self.segment_dir, name)
+        # rename after write, so a half-written segment is never visible
+        segment.save(f'{path}.tmp')
+        os.replace(f'{path}.tmp', path)
+        return BM25Segment.load(path, name=name)
+
+    def _remove_segment(self, segment: BM25Segment):
+        if self.save_path is None:
+            return
+        path = os.path.join(self.segment_dir, segment.name)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+
+    def _write_manifest(self):
+        if self.save_path is None:
+            return
+        tmp_path = f'{self.save_path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump({
+                "segments": [segment.name for segment in self.segments],
+                "next_segment": self.next_segment,
+                "deleted": {segment.name: np.flatnonzero(segment.deleted) for segment in self.segments
+                            if segment.deleted is not None},
+            }, f)
+        os.replace(tmp_path, self.save_path)
@@ -0,0 +1,268 @@
+from collections import Counter
+from typing import List, Optional
+
+import numpy as np
+
+from RAGchain.utils.bm25.segment import BM25Segment
+
+
+class TermPostings:
+    """
+    Postings of one query term in one segment, with its BM25 upper bounds.
+    """
+
+    def __init__(self, segment: BM25Segment, term: int, weight: float, avgdl: float, k1: float, b: float):
+        """
+        :param segment: segment of the postings.
+        :param term: term id.
+        :param weight: idf of the term multiplied by its count in the query.
+        """
+        self.segment = segment
+        self.term = term
+        self.size = int(segment.term_ptr[term + 1] - segment.term_ptr[term])
+        self.doc_len = segment.doc_len
+        self.weight = weight
+        self.k1 = k1
+        self.norm_base = 1 - b
+        self.norm_ratio = b / avgdl
+        self.block_start, block_end = int(segment.block_ptr[term]), int(segment.block_ptr[term + 1])
+        self.block_last_doc = segment.block_last_doc[self.block_start:block_end]
+        # a little margin guards against rounding errors, so pruning is always safe
+        self.block_upper_bounds = self.contribution(segment.block_max_tf[self.block_start:block_end],
+                                                    segment.block_min_len[self.block_start:block_end]) * (1 + 1e-9)
+        self.upper_bound = float(self.block_upper_bounds.max()) if len(self.block_upper_bounds) > 0 else 0.0
+        self._postings = None
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def docs(self) -> np.ndarray:
+        return self._decode()[0]
+
+    @property
+    def freqs(self) -> np.ndarray:
+        return self._decode()[1]
+
+    def _decode(self) -> tuple[np.ndarray, np.ndarray]:
+        if self._postings is None:
+            self._postings = self.segment.postings(self.term)
+        return self._postings
+
+    def contribution(self, freqs: np.ndarray, doc_len: np.ndarray) -> np.ndarray:
+        """
+        BM25 score of this term. It grows with term frequency and shrinks with doc length,
+        so max tf and min doc length of a block give the upper bound of the block.
+        """
+        return self.weight * (freqs * (self.k1 + 1) /
+                              (freqs + self.k1 * (self.norm_base + self.norm_ratio * doc_len)))
+
+    def scores(self) -> np.ndarray:
+        """BM25 score of this term for all postings."""
+        return self.contribution(self.freqs, self.doc_len[self.docs])
+
+    def lookup(self, candidates: np.ndarray) -> tuple[np.ndarray, int]:
+        """
+        BM25 score of this term for sorted candidate docs. Zero for docs without this term.
+        If postings are not decoded yet, only blocks which may contain candidates are decoded.
+        :return: scores of candidates, and count of matched postings.
+        """
+        if self._postings is not None:
+            docs, freqs = self._postings
+        else:
+            blocks = np.unique(np.searchsorted(self.block_last_doc, candidates))
+            blocks = blocks[blocks < len(self.block_last_doc)]
+            docs, freqs = self.segment.decode_blocks(blocks + self.block_start)
+        result = np.zeros(len(candidates), dtype=np.float64)
+        if len(docs) == 0:
+            return result, 0
+        positions = np.minimum(np.searchsorted(docs, candidates), len(docs) - 1)
+        matched = docs[positions] == candidates
+        positions = positions[matched]
+        result[matched] = self.contribution(freqs[positions], self.doc_len[docs[positions]])
+        return result, int(matched.sum())
+
+    def block_upper_bounds_at(self, candidates: np.ndarray) -> np.ndarray:
+        """Upper bound of the block which may contain each candidate doc. Zero if it is after the last block."""
+        blocks = np.searchsorted(self.block_last_doc, candidates)
+        result = np.zeros(len(candidates), dtype=np.float64)
+        in_range = blocks < len(self.block_last_doc)
+        result[in_range] = self.block_upper_bounds[blocks[in_range]]
+        return result
+
+
+class TopKCollector:
+    """
+    Collects top_k docs across segments. Its threshold is the k-th best score found so far.
+    """
+
+    def __init__(self, top_k: int):
+        self.top_k = top_k
+        self.scores = np.zeros(0, dtype=np.float64)
+        self.segments = np.zeros(0, dtype=np.int64)
+        self.docs = np.zeros(0, dtype=np.int64)
+
+    @property
+    def threshold(self) -> float:
+        """Docs which score is not greater than threshold can not make into top_k."""
+        return float(self.scores.min()) if len(self.scores) >= self.top_k else 0.0
+
+    def push(self, segment_index: int, docs: np.ndarray, scores: np.ndarray, deleted: Optional[np.ndarray] = None):
+        """
+        :param deleted: deleted docs of the segment, which are not collected.
+        """
+        keep = scores > self.threshold
+        if deleted is not None:
+            keep &= ~deleted[docs]
+        if not keep.any():
+            return
+        self.scores = np.concatenate([self.scores, scores[keep]])
+        self.segments = np.concatenate([self.segments, np.full(int(keep.sum()), segment_index)])
+        self.docs = np.concatenate([self.docs, docs[keep]])
+        if len(self.scores) > self.top_k:
+            top = np.argpartition(-self.scores, self.top_k - 1)[:self.top_k]
+            self.scores, self.segments, self.docs = self.scores[top], self.segments[top], self.docs[top]
+
+
+class DynamicPruning:
+    """
+    Safe early-termination top_k for BM25.
+    It returns top_k of same scores as exhaustive scoring, while skipping postings which can not make into top_k
+    by upper bounds of BM25 score. Segments share the top_k threshold, so later segments are pruned more.
+    Upper bounds come from block max tf and block min doc length, stored at each segment.
+
+    It is vectorized with numpy instead of document-at-a-time cursors, which are too slow in python.
+    Terms which max scores sum is not greater than threshold are non-essential, so only docs in the postings of
+    essential terms are candidates, and non-essential terms are looked up only for candidates that can still
+    exceed threshold. This is MaxScore algorithm, which shares term upper bounds with WAND.
+    - 'wand' mode uses max score of each term as the upper bound of non-essential terms.
+    - 'bmw' mode uses max score of the postings block which may contain each candidate, like Block-Max WAND.
+      It is tighter, so more candidates are dropped before looking up postings.
+    When most postings are essential, the segment is scored exhaustively, because it is faster.
+    """
+    EXHAUSTIVE_RATIO = 0.5
+
+    def __init__(self, segments: List[BM25Segment], idf: np.ndarray, avgdl: float, k1: float, b: float,
+                 block_max: bool = True):
+        """
+        :param segments: segments to search. Corpus statistics must be global.
+        :param block_max: If True, use block max scores ('bmw' mode). Else, use term max scores ('wand' mode).
+        """
+        self.segments = segments
+        self.idf = idf
+        self.avgdl = avgdl
+        self.k1 = k1
+        self.b = b
+        self.block_max = block_max
+        self.postings_evaluated = 0
+        self.postings_total = 0
+
+    def top_k(self, query_tokens: List[int], top_k: int) -> Optional[List[tuple[float, int, int]]]:
+        """
+        Get top_k of (score, segment index, doc ordinal), sorted by descending score.
+        Return None when the query has negative term weights, because upper bounds are not valid.
+        Then use exhaustive scoring instead.
+        """
+        weights = {}
+        for term, count in Counter(query_tokens).items():
+            if term < len(self.idf) and self.idf[term] != 0:
+                weights[term] = count * float(self.idf[term])
+        if any(weight < 0 for weight in weights.values()):
+            return None
+
+        collector = TopKCollector(top_k)
+        for segment_index, segment in enumerate(self.segments):
+            postings = [TermPostings(segment, term, weight, self.avgdl, self.k1, self.b)
+                        for term, weight in weights.items() if term < segment.vocab_size]
+            postings = [term_postings for term_postings in postings if len(term_postings) > 0]
+            self.postings_total += sum(len(term_postings) for term_postings in postings)
+            if len(postings) == 0:
+                continue
+            self._search_segment(segment_index, segment, postings, collector)
+
+        result = sorted(zip(collector.scores.tolist(), collector.segments.tolist(), collector.docs.tolist()),
+                        reverse=True)
+        self._fill_zero_scores(result, top_k)
+        return result
+
+    def _search_segment(self, segment_index: int, segment: BM25Segment, postings: List[TermPostings],
+                        collector: TopKCollector):
+        evaluated = self.postings_evaluated
+        scored = np.zeros(0, dtype=np.int64)
+        if len(collector.scores) < collector.top_k:
+            # raise threshold first by scoring docs of the rarest term
+            scored = np.asarray(min(postings, key=len).docs, dtype=np.int64)
+            collector.push(segment_index, scored, self._score_candidates(scored, postings, []), segment.deleted)
+
+        postings = sorted(postings, key=lambda term_postings: term_postings.upper_bound)
+        upper_bounds = np.cumsum([term_postings.upper_bound for term_postings in postings])
+        non_essential_count = int(np.searchsorted(upper_bounds, collector.threshold, side='right'))
+        if non_essential_count == len(postings):
+            return
+        essential, non_essential = postings[non_essential_count:], postings[:non_essential_count]
+        if sum(len(term_postings) for term_postings in essential) > \
+                self.EXHAUSTIVE_RATIO * sum(len(term_postings) for term_postings in postings):
+            # every posting is scored once, including the postings scored to raise threshold
+            self.postings_evaluated = evaluated
+            self._score_all(segment_index, segment, postings, scored, collector)
+            return
+        candidates = np.unique(np.concatenate([np.asarray(term_postings.docs) for term_postings in essential]))
+        candidates = candidates[~np.isin(candidates, scored, assume_unique=True)]
+        if len(candidates) == 0:
+            return
+        collector.push(segment_index, candidates,
+                       self._score_candidates(candidates, essential, non_essential, collector.threshold),
+                       segment.deleted)
+
+    def _score_candidates(self, candidates: np.ndarray, essential: List[TermPostings],
+                          non_essential: List[TermPostings], threshold: float = 0.0) -> np.ndarray:
+        """
+        Score sorted candidate docs. Non-essential terms are looked up only for candidates
+        that can still exceed threshold with them, from the highest upper bound.
+        Candidates dropped by upper bounds keep partial scores, which are not greater than threshold.
+        """
+        scores = np.zeros(len(candidates), dtype=np.float64)
+        for term_postings in essential:
+            term_scores, matched = term_postings.lookup(candidates)
+            scores += term_scores
+            self.postings_evaluated += matched
+        if len(non_essential) == 0:
+            return scores
+        if self.block_max:
+            bounds = np.stack([term_postings.block_upper_bounds_at(candidates) for term_postings in non_essential])
+        else:
+            bounds = np.array([[term_postings.upper_bound] for term_postings in non_essential])
+        remain_bounds = bounds.sum(axis=0)
+        alive = np.arange(len(candidates))
+        for i in reversed(range(len(non_essential))):
+            alive = alive[scores[alive] + np.broadcast_to(remain_bounds, scores.shape)[alive] > threshold]
+            if len(alive) == 0:
+                break
+            term_scores, matched = non_essential[i].lookup(candidates[alive])
+            scores[alive] += term_scores
+            self.postings_evaluated += matched
+            remain_bounds = remain_bounds - bounds[i]
+        return scores
+
+    def _score_all(self, segment_index: int, segment: BM25Segment, postings: List[TermPostings],
+                   scored: np.ndarray, collector: TopKCollector):
+        scores = np.zeros(len(segment), dtype=np.float64)
+        for term_postings in postings:
+            scores[term_postings.docs] += term_postings.scores()
+            self.postings_evaluated += len(term_postings)
+        scores[scored] = 0
+        docs = np.nonzero(scores)[0]
+        collector.push(segment_index, docs, scores[docs], segment.deleted)
+
+    def _fill_zero_scores(self, result: list, top_k: int):
+        """
+        Exhaustive scoring ranks docs without any query term with zero score,
+        so fill top_k with them when matched docs are less than top_k.
+        """
+        found = {(segment_index, doc) for _, segment_index, doc in result}
+        for segment_index, segment in enumerate(self.segments):
+            for doc in segment.live_docs():
+                if len(result) >= top_k:
+                    return
+                if (segment_index, int(doc)) not in found:
+                    result.append((0.0, segment_index, int(doc)))
@@ -0,0 +1,421 @@
+import itertools
+import os
+from typing import List, Union, Optional, Dict
+from uuid import UUID
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from RAGchain.utils.bm25.codec import varbyte_sizes, varbyte_encode, varbyte_decode, gather_ranges
+
+
+class PassageIdTable:
+    """
+    Passage ids stored as flat numpy arrays, so it can be memory-mapped.
+    Each id is decoded only when it is accessed.
+    Data structure looks like this:
+    {
+        "id_offsets" : [], # bytes of i-th id are id_bytes[id_offsets[i]:id_offsets[i + 1]]
+        "id_bytes" : [], # utf-8 encoded string of all ids
+        "id_is_uuid" : [], # whether i-th id was UUID
+    }
+    """
+
+    def __init__(self, id_offsets: np.ndarray, id_bytes: np.ndarray, id_is_uuid: np.ndarray):
+        self.id_offsets = id_offsets
+        self.id_bytes = id_bytes
+        self.id_is_uuid = id_is_uuid
+        # id string -> ordinals, built at the first lookup. See ordinals.
+        self._ordinal_map: Optional[Dict[str, Union[int, List[int]]]] = None
+
+    def __len__(self):
+        return len(self.id_is_uuid)
+
+    def __getitem__(self, i: int) -> Union[str, UUID]:
+        value = self.id_bytes[self.id_offsets[i]:self.id_offsets[i + 1]].tobytes().decode('utf-8')
+        return UUID(value) if self.id_is_uuid[i] else value
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def ordinals(self, ids: List[Union[str, UUID]]) -> np.ndarray:
+        """
+        Get sorted ordinals of the given ids in this table. Ids are compared as strings, and ids not in it are skipped.
+        The map of id to ordinals is built at the first call, so later calls cost only the given ids.
+        """
+        ordinal_map = self._get_ordinal_map()
+        found = []
+        for _id in ids:
+            ordinal = ordinal_map.get(str(_id))
+            if ordinal is None:
+                continue
+            if isinstance(ordinal, list):
+                found.extend(ordinal)
+            else:
+                found.append(ordinal)
+        return np.unique(np.array(found, dtype=np.int64))
+
+    def isin(self, ids: List[Union[str, UUID]]) -> np.ndarray:
+        """
+        Get boolean mask of ids in this table which are in the given ids. Ids are compared as strings.
+        """
+        mask = np.zeros(len(self), dtype=bool)
+        mask[self.ordinals(ids)] = True
+        return mask
+
+    def _get_ordinal_map(self) -> Dict[str, Union[int, List[int]]]:
+        if self._ordinal_map is None:
+            id_bytes = np.asarray(self.id_bytes).tobytes()
+            offsets = np.asarray(self.id_offsets).tolist()
+            ordinal_map = dict()
+            for i in range(len(self)):
+                key = id_bytes[offsets[i]:offsets[i + 1]].decode('utf-8')
+                ordinal = ordinal_map.setdefault(key, i)
+                # same id can be added twice without replace, so keep every ordinal of it
+                if ordinal != i:
+                    ordinal_map[key] = (ordinal if isinstance(ordinal, list) else [ordinal]) + [i]
+            # assign at once, so concurrent lookups see a complete map
+            self._ordinal_map = ordinal_map
+        return self._ordinal_map
+
+    def select(self, index: np.ndarray) -> 'PassageIdTable':
+        """
+        Get a new table of ids at the given ordinals.
+        """
+        index = np.asarray(index, dtype=np.int64)
+        lengths = self.id_offsets[index + 1] - self.id_offsets[index]
+        id_offsets = np.zeros(len(index) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=id_offsets[1:])
+        return PassageIdTable(id_offsets,
+                              gather_ranges(self.id_bytes, self.id_offsets[index], self.id_offsets[index + 1]),
+                              np.asarray(self.id_is_uuid)[index])
+
+    @classmethod
+    def from_list(cls, ids: List[Union[str, UUID]]) -> 'PassageIdTable':
+        encoded = [str(_id).encode('utf-8') for _id in ids]
+        id_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(value) for value in encoded], out=id_offsets[1:])
+        return cls(id_offsets, np.frombuffer(b''.join(encoded), dtype=np.uint8),
+                   np.array([isinstance(_id, UUID) for _id in ids], dtype=bool))
+
+    @classmethod
+    def concat(cls, tables: List['PassageIdTable']) -> 'PassageIdTable':
+        offsets = [np.zeros(1, dtype=np.int64)]
+        start = 0
+        for table in tables:
+            offsets.append(table.id_offsets[1:] + start)
+            start += int(table.id_offsets[-1])
+        return cls(np.concatenate(offsets),
+                   np.concatenate([table.id_bytes for table in tables]),
+                   np.concatenate([table.id_is_uuid for table in tables]))
+
+
+class BM25Segment:
+    """
+    Immutable inverted index of one ingest batch.
+    Postings are stored term-major, and doc ordinals are local to the segment.
+    Corpus statistics like idf and average doc length are not stored in the segment,
+    because they must be same across all segments. See BM25Index.
+    A saved segment is a directory of .npy files, and it is opened with memory-map.
+    So loading is near-instant, and processes that open the same segment share one page-cache copy.
+
+    Postings of each term are split to blocks of BLOCK_SIZE, and each block is compressed.
+    Doc ordinals are stored as gaps from the previous posting, and gaps and term frequencies are
+    variable-byte encoded, so most postings take 2 bytes instead of 8 bytes.
+    A block is decoded with vectorized numpy operations, so only needed blocks are decoded at search.
+    Data structure looks like this:
+    {
+        "term_ptr" : [], # postings of term t are term_ptr[t]:term_ptr[t + 1]
+        "doc_len" : [], # token count of each doc
+        "id_offsets", "id_bytes", "id_is_uuid" : [], # passage id of each doc ordinal. See PassageIdTable.
+        "block_ptr" : [], # blocks of term t are block_ptr[t]:block_ptr[t + 1]
+        "block_last_doc" : [], # last doc ordinal of each block
+        "block_max_tf" : [], # max term frequency in each block
+        "block_min_len" : [], # min doc length in each block
+        "block_doc_ptr" : [], # encoded doc gaps of block i are doc_bytes[block_doc_ptr[i]:block_doc_ptr[i + 1]]
+        "doc_bytes" : [], # varbyte encoded (doc gap - 1) of all postings
+        "block_freq_ptr" : [], # encoded term frequencies of block i are freq_bytes[block_freq_ptr[i]:block_freq_ptr[i + 1]]
+        "freq_bytes" : [], # varbyte encoded (term frequency - 1) of all postings
+    }
+    Block max tf and min doc length give upper bound of BM25 score in each block for any corpus statistics,
+    which is used for dynamic pruning. See RAGchain.utils.bm25.pruning.
+
+    Deleted docs are marked at deleted, which is a boolean array of doc ordinals, or None if nothing is deleted.
+    Deleted docs still have postings until the segment is merged, so they must be filtered at scoring.
+    It is not saved with the segment, because saved segments are immutable. BM25Index keeps it at its manifest.
+    """
+    BLOCK_SIZE = 128
+    ARRAY_NAMES = ["term_ptr", "doc_len", "id_offsets", "id_bytes", "id_is_uuid",
+                   "block_ptr", "block_last_doc", "block_max_tf", "block_min_len",
+                   "block_doc_ptr", "doc_bytes", "block_freq_ptr", "freq_bytes"]
+
+    def __init__(self, term_ptr: np.ndarray, doc_len: np.ndarray,
+                 passage_id: Union[PassageIdTable, List[Union[str, UUID]]],
+                 block_ptr: np.ndarray, block_last_doc: np.ndarray,
+                 block_max_tf: np.ndarray, block_min_len: np.ndarray,
+                 block_doc_ptr: np.ndarray, doc_bytes: np.ndarray,
+                 block_freq_ptr: np.ndarray, freq_bytes: np.ndarray,
+                 name: Optional[str] = None):
+        """
+        Use from_tokens or from_postings to build a new segment.
+        :param name: directory name of the segment. None if the segment is not saved yet.
+        """
+        self.term_ptr = term_ptr
+        self.doc_len = doc_len
+        self.passage_id = passage_id if isinstance(passage_id, PassageIdTable) \
+            else PassageIdTable.from_list(passage_id)
+        self.block_ptr = block_ptr
+        self.block_last_doc = block_last_doc
+        self.block_max_tf = block_max_tf
+        self.block_min_len = block_min_len
+        self.block_doc_ptr = block_doc_ptr
+        self.doc_bytes = doc_bytes
+        self.block_freq_ptr = block_freq_ptr
+        self.freq_bytes = freq_bytes
+        self.name = name
+        self.deleted: Optional[np.ndarray] = None
+        self._weight_cache = None
+
+    def __len__(self):
+        return len(self.passage_id)
+
+    @property
+    def vocab_size(self) -> int:
+        return len(self.term_ptr) - 1
+
+    @property
+    def df(self) -> np.ndarray:
+        """Document frequency of each term in this segment."""
+        return np.diff(self.term_ptr)
+
+    @property
+    def deleted_count(self) -> int:
+        return 0 if self.deleted is None else int(self.deleted.sum())
+
+    def live_docs(self) -> np.ndarray:
+        """Ordinals of docs which are not deleted."""
+        return np.arange(len(self)) if self.deleted is None else np.flatnonzero(~self.deleted)
+
+    def doc_stats(self, docs: np.ndarray) -> tuple[np.ndarray, int]:
+        """
+        Get corpus statistics of the given docs, to remove them from the global corpus statistics.
+        :param docs: doc ordinals.
+        :return: document frequency of each term among the docs, and total length of the docs.
+        """
+        all_docs, _ = self.postings()
+        terms = np.repeat(np.arange(self.vocab_size), self.df)[np.isin(all_docs, docs)]
+        return np.bincount(terms, minlength=self.vocab_size), int(np.asarray(self.doc_len)[docs].sum())
+
+    @property
+    def nbytes(self) -> int:
+        """Total bytes of the segment arrays."""
+        return sum(int(np.asarray(array).nbytes) for array in [
+            self.term_ptr, self.doc_len, self.passage_id.id_offsets, self.passage_id.id_bytes,
+            self.passage_id.id_is_uuid, self.block_ptr, self.block_last_doc, self.block_max_tf,
+            self.block_min_len, self.block_doc_ptr, self.doc_bytes, self.block_freq_ptr, self.freq_bytes])
+
+    @classmethod
+    def from_tokens(cls, tokens: List[List[int]], passage_ids: List[Union[str, UUID]]) -> 'BM25Segment':
+        """
+        Build a segment from tokenized passages.
+        :param tokens: 2d list of token ids. Each row is one passage.
+        :param passage_ids: passage id of each row.
+        """
+        assert len(tokens) == len(passage_ids)
+        doc_len = np.array([len(token) for token in tokens], dtype=np.int64)
+        flat_tokens = np.fromiter(itertools.chain.from_iterable(tokens), dtype=np.int64, count=int(doc_len.sum()))
+        flat_docs = np.repeat(np.arange(len(tokens), dtype=np.int64), doc_len)
+        # sorting (term, doc) pairs at once gives term-major postings with ascending doc ordinals
+        keys, freqs = np.unique(flat_tokens * max(len(tokens), 1) + flat_docs, return_counts=True)
+        terms, docs = np.divmod(keys, max(len(tokens), 1))
+        term_ptr = np.zeros(int(terms[-1]) + 2 if len(terms) > 0 else 1, dtype=np.int64)
+        np.cumsum(np.bincount(terms), out=term_ptr[1:])
+        return cls.from_postings(term_ptr, docs, freqs, doc_len.astype(np.int32),
+                                 PassageIdTable.from_list(passage_ids))
+
+    @classmethod
+    def merge(cls, segments: List['BM25Segment'],
+              deleted: Optional[List[Optional[np.ndarray]]] = None) -> 'BM25Segment':
+        """
+        Merge segments into one segment. Doc ordinals follow the order of given segments.
+        Deleted docs are purged, so doc ordinals of the merged segment only count live docs.
+        :param deleted: deleted docs of each segment to purge. If None, use deleted of each segment.
+        """
+        if deleted is None:
+            deleted = [segment.deleted for segment in segments]
+        terms, docs, freqs, doc_len, passage_ids = [], [], [], [], []
+        offset = 0
+        for segment, segment_deleted in zip(segments, deleted):
+            live_docs = np.arange(len(segment)) if segment_deleted is None else np.flatnonzero(~segment_deleted)
+            # new ordinal of each live doc, and -1 for deleted docs
+            new_ordinal = np.full(len(segment), -1, dtype=np.int64)
+            new_ordinal[live_docs] = np.arange(len(live_docs)) + offset
+            segment_docs, segment_freqs = segment.postings()
+            segment_docs = new_ordinal[segment_docs]
+            is_live = segment_docs >= 0
+            terms.append(np.repeat(np.arange(segment.vocab_size, dtype=np.int64), segment.df)[is_live])
+            docs.append(segment_docs[is_live])
+            freqs.append(segment_freqs[is_live])
+            doc_len.append(np.asarray(segment.doc_len)[live_docs])
+            passage_ids.append(segment.passage_id.select(live_docs))
+            offset += len(live_docs)
+        return cls._from_unsorted_postings(np.concatenate(terms), np.concatenate(docs).astype(np.int32),
+                                           np.concatenate(freqs), np.concatenate(doc_len),
+                                           PassageIdTable.concat(passage_ids))
+
+    @classmethod
+    def _from_unsorted_postings(cls, terms: np.ndarray, docs: np.ndarray, freqs: np.ndarray,
+                                doc_len: np.ndarray, passage_id: PassageIdTable) -> 'BM25Segment':
+        # stable sort keeps doc ordinals ascending in each postings list
+        order = np.argsort(terms, kind='stable')
+        term_ptr = np.zeros(int(terms.max()) + 2 if len(terms) > 0 else 1, dtype=np.int64)
+        np.cumsum(np.bincount(terms), out=term_ptr[1:])
+        return cls.from_postings(term_ptr, docs[order], freqs[order], doc_len, passage_id)
+
+    @classmethod
+    def from_postings(cls, term_ptr: np.ndarray, doc_ids: np.ndarray, term_freqs: np.ndarray,
+                      doc_len: np.ndarray, passage_id: Union[PassageIdTable, List[Union[str, UUID]]],
+                      name: Optional[str] = None) -> 'BM25Segment':
+        """
+        Build a segment from uncompressed term-major postings. Doc ordinals must be ascending in each term.
+        :param term_ptr: postings of term t are term_ptr[t]:term_ptr[t + 1]
+        :param doc_ids: doc ordinal of each posting.
+        :param term_freqs: term frequency of each posting.
+        """
+        df = np.diff(term_ptr)
+        vocab_size = len(df)
+        block_counts = -(-df // cls.BLOCK_SIZE)
+        block_ptr = np.zeros(vocab_size + 1, dtype=np.int64)
+        np.cumsum(block_counts, out=block_ptr[1:])
+        block_term = np.repeat(np.arange(vocab_size), block_counts)
+        block_start = term_ptr[block_term] + (np.arange(block_ptr[-1]) - block_ptr[block_term]) * cls.BLOCK_SIZE
+        block_end = np.minimum(block_start + cls.BLOCK_SIZE, term_ptr[block_term + 1])
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        term_freqs = np.asarray(term_freqs, dtype=np.int64)
+        if block_ptr[-1] > 0:
+            block_last_doc = doc_ids[block_end - 1].astype(np.int32)
+            block_max_tf = np.maximum.reduceat(term_freqs, block_start).astype(np.int32)
+            block_min_len = np.minimum.reduceat(np.asarray(doc_len)[doc_ids], block_start).astype(np.int32)
+        else:
+            block_last_doc = block_max_tf = block_min_len = np.zeros(0, dtype=np.int32)
+
+        # gap of the first posting of each term is from -1, so every gap is at least 1
+        previous_docs = np.full(len(doc_ids), -1, dtype=np.int64)
+        previous_docs[1:] = doc_ids[:-1]
+        previous_docs[term_ptr[:-1][df > 0]] = -1
+        doc_gaps = doc_ids - previous_docs - 1
+        term_freqs = term_freqs - 1
+        block_bounds = np.append(block_start, term_ptr[-1])
+        doc_ptr = np.concatenate([[0], np.cumsum(varbyte_sizes(doc_gaps))])[block_bounds]
+        freq_ptr = np.concatenate([[0], np.cumsum(varbyte_sizes(term_freqs))])[block_bounds]
+        return cls(term_ptr, doc_len, passage_id, block_ptr, block_last_doc, block_max_tf, block_min_len,
+                   doc_ptr, varbyte_encode(doc_gaps), freq_ptr, varbyte_encode(term_freqs), name=name)
+
+    def decode_blocks(self, blocks: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Decode postings of the given blocks with vectorized operations.
+        :param blocks: ascending block indices.
+        :return: doc ordinals and term frequencies of the postings, concatenated in the order of blocks.
+        """
+        blocks = np.asarray(blocks, dtype=np.int64)
+        if len(blocks) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        block_term = np.searchsorted(self.block_ptr, blocks, side='right') - 1
+        block_start = self.term_ptr[block_term] + (blocks - self.block_ptr[block_term]) * self.BLOCK_SIZE
+        block_size = np.minimum(self.term_ptr[block_term + 1] - block_start, self.BLOCK_SIZE)
+        doc_gaps = varbyte_decode(gather_ranges(self.doc_bytes, self.block_doc_ptr[blocks],
+                                                self.block_doc_ptr[blocks + 1])) + 1
+        freqs = varbyte_decode(gather_ranges(self.freq_bytes, self.block_freq_ptr[blocks],
+                                             self.block_freq_ptr[blocks + 1])) + 1
+        # doc ordinal is the cumulative sum of gaps from the last doc of the previous block of the term
+        is_first_block = blocks == self.block_ptr[block_term]
+        base = np.where(is_first_block, -1, np.asarray(self.block_last_doc[np.maximum(blocks - 1, 0)], np.int64))
+        gap_sums = np.cumsum(doc_gaps)
+        block_offset = np.cumsum(block_size) - block_size
+        before_block = np.where(block_offset > 0, gap_sums[np.maximum(block_offset - 1, 0)], 0)
+        docs = gap_sums + np.repeat(base - before_block, block_size)
+        return docs, freqs
+
+    def postings(self, term: Optional[int] = None) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Decode doc ordinals and term frequencies of one term, or of all terms in term-major order when term is None.
+        """
+        if term is None:
+            return self.decode_blocks(np.arange(self.block_ptr[-1]))
+        return self.decode_blocks(np.arange(self.block_ptr[term], self.block_ptr[term + 1]))
+
+    def get_scores(self, query_tokens: List[int], idf: np.ndarray, avgdl: float,
+                   k1: float, b: float) -> np.ndarray:
+        """
+        Get BM25 scores of every doc in this segment with the given corpus statistics.
+        Repeated query tokens are counted repeatedly, same as rank_bm25.
+        """
+        scores = np.zeros(len(self), dtype=np.float64)
+        for term in query_tokens:
+            if term >= self.vocab_size or term >= len(idf) or idf[term] == 0:
+                continue
+            docs, freqs = self.postings(term)
+            norms = k1 * (1 - b + b * self.doc_len[docs] / avgdl)
+            scores[docs] += idf[term] * (freqs * (k1 + 1) / (freqs + norms))
+        return scores
+
+    def weight_matrix(self, idf: np.ndarray, avgdl: float, k1: float, b: float, cache: bool = False) -> csr_matrix:
+        """
+        Get term-document BM25 weight matrix, which shape is (vocab_size, doc count), with the given corpus statistics.
+        It shares the postings layout. Weights of deleted docs are not stored.
+        :param cache: If True, keep the matrix until the corpus statistics or deleted docs change,
+        or clear_cache is called. The matrix is as large as the postings, so it is not kept by default.
+        """
+        cached = self._weight_cache
+        deleted = self.deleted
+        if cached is not None and cached[0] is idf and cached[1] == avgdl and cached[2] is deleted:
+            return cached[3]
+        terms = np.repeat(np.arange(self.vocab_size), self.df)
+        docs, freqs = self.postings()
+        norms = k1 * (1 - b + b * self.doc_len[docs] / avgdl)
+        weights = idf[:self.vocab_size][terms] * (freqs * (k1 + 1) / (freqs + norms))
+        if deleted is not None:
+            weights[deleted[docs]] = 0
+        matrix = csr_matrix((weights, docs, self.term_ptr), shape=(self.vocab_size, len(self)))
+        if deleted is not None:
+            matrix.eliminate_zeros()
+        self._weight_cache = (idf, avgdl, deleted, matrix) if cache else None
+        return matrix
+
+    def clear_cache(self):
+        """Drop the cached weight matrix."""
+        self._weight_cache = None
+
+    def save(self, path: str):
+        """
+        Save the segment as a directory of .npy files.
+        """
+        if not os.path.exists(path):
+            os.makedirs(path)
+        arrays = {
+            "term_ptr": self.term_ptr,
+            "doc_len": self.doc_len,
+            "id_offsets": self.passage_id.id_offsets,
+            "id_bytes": self.passage_id.id_bytes,
+            "id_is_uuid": self.passage_id.id_is_uuid,
+            "block_ptr": self.block_ptr,
+            "block_last_doc": self.block_last_doc,
+            "block_max_tf": self.block_max_tf,
+            "block_min_len": self.block_min_len,
+            "block_doc_ptr": self.block_doc_ptr,
+            "doc_bytes": self.doc_bytes,
+            "block_freq_ptr": self.block_freq_ptr,
+            "freq_bytes": self.freq_bytes,
+        }
+        for array_name, array in arrays.items():
+            np.save(os.path.join(path, f'{array_name}.npy'), np.ascontiguousarray(array))
+
+    @classmethod
+    def load(cls, path: str, name: Optional[str] = None) -> 'BM25Segment':
+        """
+        Open the saved segment with memory-map. Arrays are read-only.
+        """
+        arrays = {array_name: np.load(os.path.join(path, f'{array_name}.npy'), mmap_mode='r')
+                  for array_name in cls.ARRAY_NAMES}
+        passage_id = PassageIdTable(arrays.pop("id_offsets"), arrays.pop("id_bytes"), arrays.pop("id_is_uuid"))
+        return cls(passage_id=passage_id, name=name, **arrays)
@@ -0,0 +1,314 @@
+import heapq
+import multiprocessing
+import os
+import pickle
+import threading
+import zlib
+from typing import List, Union, Optional
+from uuid import UUID
+
+import numpy as np
+
+from RAGchain.utils.bm25.index import BM25Index
+
+
+def _serve_shard(save_path: str, index_kwargs: dict, connection):
+    """
+    Worker process loop of one shard. It answers (method name, args, corpus stats) requests
+    with (success, result, counts of evaluated and total postings of the request),
+    and reloads the shard when its manifest file changes.
+    """
+    index, manifest_signature, corpus_stats, applied_version = None, None, None, None
+    while True:
+        request = connection.recv()
+        if request is None:
+            break
+        method, args, new_corpus_stats = request
+        try:
+            signature = _manifest_signature(save_path)
+            if index is None or signature != manifest_signature:
+                index, signature = _load_shard(save_path, index_kwargs)
+                manifest_signature, applied_version = signature, None
+            if new_corpus_stats is not None:
+                corpus_stats = new_corpus_stats
+            if corpus_stats is not None and corpus_stats[0] != applied_version:
+                index.set_corpus_stats(*corpus_stats[1:])
+                applied_version = corpus_stats[0]
+            evaluated, total = index.postings_evaluated, index.postings_total
+            result = getattr(index, method)(*args)
+            connection.send((True, result, (index.postings_evaluated - evaluated, index.postings_total - total)))
+        except Exception as e:
+            connection.send((False, e, (0, 0)))
+
+
+def _manifest_signature(save_path: str) -> Optional[tuple[int, int]]:
+    # the manifest is replaced with os.replace, so compare inode too
+    if not os.path.exists(save_path):
+        return None
+    stat = os.stat(save_path)
+    return stat.st_ino, stat.st_mtime_ns
+
+
+def _load_shard(save_path: str, index_kwargs: dict) -> tuple[BM25Index, Optional[tuple[int, int]]]:
+    """
+    Load the shard and get signature of its manifest file when it is loaded.
+    A merge of the main process can remove segments while they are loaded,
+    and then the manifest is changed, so load again.
+    """
+    while True:
+        signature = _manifest_signature(save_path)
+        try:
+            return BM25Index.load(save_path, background_merge=False, **index_kwargs), signature
+        except FileNotFoundError:
+            if _manifest_signature(save_path) == signature:
+                raise
+
+
+class ShardedBM25Index:
+    """
+    BM25 index partitioned by passage into shards, and each shard is served by a worker process.
+    Queries are scattered to all shards, and top_k of each shard are merged with a heap.
+    So scoring runs on as many cores as shards, instead of one core bound by GIL.
+
+    Each shard is a BM25Index saved at '{save_path without extension}_shard_{i}.pkl'.
+    Passages are assigned to shards by hash of passage id, so upsert and delete of an id go to the same shard.
+    Workers score with global corpus statistics sent from this process,
+    so results are same as the unsharded index.
+    Workers reload their shard when it changes, and the segments are memory-mapped,
+    so loading costs little.
+    Workers are started with spawn, so run scripts using it under `if __name__ == '__main__':`.
+    When a worker fails to answer, all workers are stopped, and they are started again at the next query.
+    postings_evaluated and postings_total are sums of the counts of all shards, which workers send with results.
+    Manifest data structure looks like this:
+    {
+        "num_shards" : 0, # count of shards
+    }
+    """
+
+    def __init__(self, save_path: str, num_shards: int, **kwargs):
+        """
+        :param save_path: path of the manifest pickle file.
+        :param num_shards: count of shards and worker processes.
+        :param kwargs: parameters of each shard. See BM25Index.
+        """
+        if num_shards < 1:
+            raise ValueError(f"num_shards should be at least 1, but got {num_shards}")
+        self.save_path = save_path
+        self.num_shards = num_shards
+        self.index_kwargs = {key: value for key, value in kwargs.items() if key != 'background_merge'}
+        stem = os.path.splitext(save_path)[0]
+        self.shard_paths = [f'{stem}_shard_{i}.pkl' for i in range(num_shards)]
+        self.shards = [BM25Index.load(shard_path, **kwargs) for shard_path in self.shard_paths]
+        self.corpus_stats_version = 0
+        # postings counts of all shards, which workers send with each response. See BM25Index.
+        self.postings_evaluated = 0
+        self.postings_total = 0
+        self._sent_corpus_stats_version = [None] * num_shards
+        self._workers = []
+        self._connections = []
+        # a lock of each worker connection, so a request and its response are not mixed with other queries
+        self._connection_locks = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
+
+    @classmethod
+    def load(cls, save_path: str, num_shards: int, **kwargs) -> 'ShardedBM25Index':
+        """
+        Load sharded index from the manifest pickle file. If the file does not exist, make a new empty index.
+        :param save_path: path of the manifest pickle file.
+        :param num_shards: count of shards. It must be same as the saved index.
+        :param kwargs: parameters of each shard. See BM25Index.
+        """
+        if os.path.exists(save_path):
+            with open(save_path, 'rb') as f:
+                manifest = pickle.load(f)
+            if manifest.get("num_shards") != num_shards:
+                raise ValueError(f"{save_path} is not an index of {num_shards} shards.")
+        else:
+            with open(save_path, 'wb') as f:
+                pickle.dump({"num_shards": num_shards}, f)
+        return cls(save_path, num_shards, **kwargs)
+
+    def shard_of(self, passage_id: Union[str, UUID]) -> int:
+        return zlib.crc32(str(passage_id).encode('utf-8')) % self.num_shards
+
+    def add(self, tokens: List[List[int]], passage_ids: List[Union[str, UUID]]):
+        """
+        Add tokenized passages to their shards.
+        """
+        for shard, (shard_tokens, shard_ids) in zip(self.shards, self._partition(tokens, passage_ids)):
+            shard.add(shard_tokens, shard_ids)
+        self._update_corpus_stats()
+
+    def upsert(self, tokens: List[List[int]], passage_ids: List[Union[str, UUID]]):
+        """
+        Add tokenized passages to their shards, and delete existing passages which have the same ids.
+        """
+        for shard, (shard_tokens, shard_ids) in zip(self.shards, self._partition(tokens, passage_ids)):
+            shard.upsert(shard_tokens, shard_ids)
+        self._update_corpus_stats()
+
+    def delete(self, passage_ids: List[Union[str, UUID]]) -> int:
+        """
+        Delete passages by ids.
+        :return: count of deleted passages.
+        """
+        deleted_count = sum(shard.delete(shard_ids)
+                            for shard, (_, shard_ids) in zip(self.shards, self._partition(None, passage_ids)))
+        if deleted_count > 0:
+            self._update_corpus_stats()
+        return deleted_count
+
+    def top_k(self, query_tokens: List[int], top_k: int = 5, mode: str = 'exhaustive',
+              allowed_ids: Optional[List[Union[str, UUID]]] = None) -> tuple[List[Union[str, UUID]], List[float]]:
+        """
+        Get top_k passage ids and scores for a tokenized query, sorted by descending score.
+        See BM25Index.top_k. Each shard gets only allowed ids which belong to it.
+        """
+        if mode not in BM25Index.MODES:
+            raise ValueError(f"mode should be one of {BM25Index.MODES}, but got {mode}")
+        if allowed_ids is None:
+            results = self._scatter('top_k', [(query_tokens, top_k, mode)] * self.num_shards)
+        else:
+            results = self._scatter('top_k', [(query_tokens, top_k, mode, shard_ids)
+                                              for _, shard_ids in self._partition(None, allowed_ids)])
+        return self._merge_top_k(results, top_k)
+
+    def top_k_batch(self, queries_tokens: List[List[int]], top_k: int = 5) -> tuple[
+        List[List[Union[str, UUID]]], List[List[float]]]:
+        """
+        Get top_k passage ids and scores for each tokenized query, sorted by descending score.
+        See BM25Index.top_k_batch.
+        """
+        results = self._scatter('top_k_batch', [(queries_tokens, top_k)] * self.num_shards)
+        batch_ids, batch_scores = [], []
+        for i in range(len(queries_tokens)):
+            ids, scores = self._merge_top_k([(result[0][i], result[1][i]) for result in results], top_k)
+            batch_ids.append(ids)
+            batch_scores.append(scores)
+        return batch_ids, batch_scores
+
+    def close(self):
+        """Stop worker processes. They are started again at the next query."""
+        with self._lock:
+            workers, connections, connection_locks = self._workers, self._connections, self._connection_locks
+            self._workers, self._connections, self._connection_locks = [], [], []
+            self._sent_corpus_stats_version = [None] * self.num_shards
+        for connection, connection_lock, worker in zip(connections, connection_locks, workers):
+            # wait for running queries of the worker
+            with connection_lock:
+                connection.send(None)
+                worker.join()
+                connection.close()
+
+    def wait_merge(self):
+        for shard in self.shards:
+            shard.wait_merge()
+
+    @staticmethod
+    def _merge_top_k(results: List[tuple[List[Union[str, UUID]], List[float]]], top_k: int) -> tuple[
+        List[Union[str, UUID]], List[float]]:
+        # each shard result is sorted by descending score, so merge them with a heap
+        merged = heapq.merge(*[zip(scores, ids) for ids, scores in results], key=lambda pair: -pair[0])
+        top = [pair for _, pair in zip(range(top_k), merged)]
+        return [_id for _, _id in top], [score for score, _ in top]
+
+    def _partition(self, tokens: Optional[List[List[int]]], passage_ids: List[Union[str, UUID]]) -> List[
+        tuple[List[List[int]], List[Union[str, UUID]]]]:
+        partitions = [([], []) for _ in range(self.num_shards)]
+        for i, passage_id in enumerate(passage_ids):
+            shard_tokens, shard_ids = partitions[self.shard_of(passage_id)]
+            if tokens is not None:
+                shard_tokens.append(tokens[i])
+            shard_ids.append(passage_id)
+        return partitions
+
+    def _update_corpus_stats(self):
+        with self._lock:
+            self.corpus_stats_version += 1
+
+    def _corpus_stats(self) -> tuple[int, np.ndarray, int, int]:
+        df = np.zeros(max(len(shard.df) for shard in self.shards), dtype=np.int64)
+        for shard in self.shards:
+            df[:len(shard.df)] += shard.df
+        return (self.corpus_stats_version, df, sum(shard.corpus_size for shard in self.shards),
+                sum(shard.total_len for shard in self.shards))
+
+    def _start_workers(self):
+        # this process runs threads like background merges, and forking a threaded process can deadlock,
+        # so workers are spawned
+        context = multiprocessing.get_context('spawn')
+        for shard_path in self.shard_paths:
+            parent_connection, child_connection = context.Pipe()
+            worker = context.Process(target=_serve_shard, args=(shard_path, self.index_kwargs,
+                                                                child_connection), daemon=True)
+            worker.start()
+            child_connection.close()
+            self._workers.append(worker)
+            self._connections.append(parent_connection)
+            self._connection_locks.append(threading.Lock())
+
+    def _scatter(self, method: str, shard_args: List[tuple]) -> list:
+        """
+        Send the request to all shard workers with the args of each shard, and gather their results in shard order.
+        Global corpus statistics are sent only when they changed since the last request.
+        Each worker connection is locked from the request until its response, and the locks are taken in shard order.
+        So a query sends to a worker as soon as the previous query got the response of it,
+        and concurrent queries run at different workers at the same time.
+        """
+        with self._lock:
+            if len(self._workers) == 0:
+                self._start_workers()
+            connections, connection_locks = self._connections, self._connection_locks
+            sent_corpus_stats_version = self._sent_corpus_stats_version
+        corpus_stats = None
+        sent, received = 0, 0
+        try:
+            for i, (connection, connection_lock, args) in enumerate(zip(connections, connection_locks, shard_args)):
+                connection_lock.acquire()
+                sent += 1
+                with self._lock:
+                    version = self.corpus_stats_version
+                if sent_corpus_stats_version[i] == version:
+                    connection.send((method, args, None))
+                    continue
+                if corpus_stats is None or corpus_stats[0] != version:
+                    corpus_stats = self._corpus_stats()
+                connection.send((method, args, corpus_stats))
+                sent_corpus_stats_version[i] = corpus_stats[0]
+            responses = []
+            for connection, connection_lock in zip(connections, connection_locks):
+                responses.append(connection.recv())
+                connection_lock.release()
+                received += 1
+        except BaseException:
+            # workers which got the request without being read would answer the next query with this response,
+            # so stop all workers. They are started again at the next query.
+            self._discard_workers(connections)
+            raise
+        finally:
+            for connection_lock in connection_locks[received:sent]:
+                connection_lock.release()
+        with self._lock:
+            self.postings_evaluated += sum(evaluated for _, _, (evaluated, _) in responses)
+            self.postings_total += sum(total for _, _, (_, total) in responses)
+        for success, result, _ in responses:
+            if not success:
+                raise result
+        return [result for _, result, _ in responses]
+
+    def _discard_workers(self, connections: list):
+        """Stop the workers of the connections without waiting for their responses."""
+        with self._lock:
+            if self._connections is not connections:
+                # other query discarded them already
+                return
+            for worker in self._workers:
+                worker.terminate()
+                worker.join()
+            for connection in self._connections:
+                connection.close()
+            self._workers, self._connections, self._connection_locks = [], [], []
+            self._sent_corpus_stats_version = [None] * self.num_shards
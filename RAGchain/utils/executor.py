@@ -0,0 +1,165 @@
+import asyncio
+import functools
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Optional, Any
+
+
+async def run_in_thread(fn: Callable, *args, **kwargs) -> Any:
+    """
+    Run blocking fn at the default executor of the running event loop, so the event loop is not blocked.
+    Async methods use it when there is no native async client.
+    It does not use RetrievalExecutor, because submit of bounded RetrievalExecutor can block the event loop.
+    """
+    return await asyncio.get_running_loop().run_in_executor(None, functools.partial(fn, *args, **kwargs))
+
+
+class RetrievalExecutor:
+    """
+    RetrievalExecutor is a process-wide thread pool for parallel fan-out of retrievals,
+    like fetching passages from each DB or retrieving with each retrieval of HybridRetrieval.
+    Threads are made once and reused, so queries do not pay thread spawn cost,
+    and thread count is bounded under concurrent queries.
+    Set RETRIEVAL_EXECUTOR_WORKERS, RETRIEVAL_EXECUTOR_QUEUE_SIZE and RETRIEVAL_EXECUTOR_NAME to environment variable,
+    or call configure to change the shared executor.
+    """
+    __instance = None
+    __instance_lock = threading.Lock()
+
+    def __init__(self, max_workers: Optional[int] = None, max_queue_size: int = 0,
+                 thread_name_prefix: str = 'RAGchain-retrieval'):
+        """
+        :param max_workers: count of threads. If None, use min(32, cpu count + 4), same as ThreadPoolExecutor.
+        :param max_queue_size: max count of tasks waiting for a thread. When the queue is full,
+        submit blocks until a task is done. If it is 0, the queue is not bounded. Default is 0.
+        :param thread_name_prefix: name prefix of threads.
+        """
+        self.max_workers = max_workers if max_workers is not None else min(32, (os.cpu_count() or 1) + 4)
+        self.max_queue_size = max_queue_size
+        self.thread_name_prefix = thread_name_prefix
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=thread_name_prefix)
+        self._slots = threading.BoundedSemaphore(self.max_workers + max_queue_size) if max_queue_size > 0 else None
+        self._worker = threading.local()
+        self._lock = threading.Lock()
+        self.reset_metrics()
+
+    @classmethod
+    def get(cls) -> 'RetrievalExecutor':
+        """Get the shared executor. Make it with environment variables if it does not exist."""
+        with cls.__instance_lock:
+            if cls.__instance is None:
+                max_workers = os.getenv("RETRIEVAL_EXECUTOR_WORKERS")
+                cls.__instance = cls(max_workers=int(max_workers) if max_workers is not None else None,
+                                     max_queue_size=int(os.getenv("RETRIEVAL_EXECUTOR_QUEUE_SIZE", 0)),
+                                     thread_name_prefix=os.getenv("RETRIEVAL_EXECUTOR_NAME", 'RAGchain-retrieval'))
+            return cls.__instance
+
+    @classmethod
+    def configure(cls, max_workers: Optional[int] = None, max_queue_size: int = 0,
+                  thread_name_prefix: str = 'RAGchain-retrieval') -> 'RetrievalExecutor':
+        """
+        Replace the shared executor with new one. Tasks submitted to the previous executor still run.
+        See __init__ for params.
+        """
+        with cls.__instance_lock:
+            previous = cls.__instance
+            cls.__instance = cls(max_workers, max_queue_size, thread_name_prefix)
+        if previous is not None:
+            previous.shutdown(wait=False)
+        return cls.__instance
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        """
+        Run fn with args at a thread of the executor.
+        When it is called at a thread of this executor, like nested HybridRetrieval, fn runs right away
+        at the calling thread. Waiting for the task at a thread of the same executor can deadlock.
+        """
+        if getattr(self._worker, 'is_worker', False):
+            future = Future()
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+        if self._slots is not None:
+            self._slots.acquire()
+        with self._lock:
+            self.submitted += 1
+            self.queue_depth += 1
+            self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+        try:
+            return self._executor.submit(self._run, time.perf_counter(), fn, args, kwargs)
+        except Exception:
+            # the executor is shut down
+            with self._lock:
+                self.queue_depth -= 1
+            self._done(0.0, 0.0, failed=True)
+            raise
+
+    def metrics(self) -> dict:
+        """
+        Metrics of the executor since it is made or reset_metrics is called.
+        queue_depth is count of tasks waiting for a thread now, and latencies are in seconds.
+        Wait latency is time in the queue, and run latency is time of running the task.
+        """
+        with self._lock:
+            finished = self.completed + self.failed
+            return {
+                'max_workers': self.max_workers,
+                'max_queue_size': self.max_queue_size,
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'failed': self.failed,
+                'queue_depth': self.queue_depth,
+                'max_queue_depth': self.max_queue_depth,
+                'running': self.running,
+                'avg_wait_latency': self.total_wait_latency / finished if finished > 0 else 0.0,
+                'avg_run_latency': self.total_run_latency / finished if finished > 0 else 0.0,
+                'max_run_latency': self.max_run_latency,
+            }
+
+    def reset_metrics(self):
+        with self._lock:
+            self.submitted = 0
+            self.completed = 0
+            self.failed = 0
+            self.queue_depth = 0
+            self.max_queue_depth = 0
+            self.running = 0
+            self.total_wait_latency = 0.0
+            self.total_run_latency = 0.0
+            self.max_run_latency = 0.0
+
+    def shutdown(self, wait: bool = True):
+        self._executor.shutdown(wait=wait)
+
+    def _run(self, submitted_at: float, fn: Callable, args: tuple, kwargs: dict):
+        started_at = time.perf_counter()
+        with self._lock:
+            self.queue_depth = max(self.queue_depth - 1, 0)
+            self.running += 1
+        self._worker.is_worker = True
+        failed = True
+        try:
+            result = fn(*args, **kwargs)
+            failed = False
+            return result
+        finally:
+            self._worker.is_worker = False
+            with self._lock:
+                self.running -= 1
+            self._done(started_at - submitted_at, time.perf_counter() - started_at, failed)
+
+    def _done(self, wait_latency: float, run_latency: float, failed: bool):
+        with self._lock:
+            if failed:
+                self.failed += 1
+            else:
+                self.completed += 1
+            self.total_wait_latency += wait_latency
+            self.total_run_latency += run_latency
+            self.max_run_latency = max(self.max_run_latency, run_latency)
+        if self._slots is not None:
+            self._slots.release()
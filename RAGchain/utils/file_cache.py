@@ -27,7 +27,7 @@ class FileCache:
 
     def delete_duplicate(self, documents: List[Document]) -> List[Document]:
         for document in documents.copy():
-            result = self.db.search(filepath=[document.metadata['source']])
+            result = self.db.search(filepath=[document.metadata['source']], fields=[])
             if len(result) > 0:
                 documents.remove(document)
         return documents
@@ -0,0 +1,31 @@
+import contextlib
+import os
+
+try:
+    import fcntl
+except ImportError:
+    # not available at Windows
+    fcntl = None
+
+
+@contextlib.contextmanager
+def file_lock(lock_path: str, exclusive: bool = True):
+    """
+    Lock the lock file between processes with flock, while the context is running.
+    Writers take exclusive lock and readers take shared lock, so readers do not see half-written files.
+    The lock file is made if it does not exist. Where flock is not available, it does not lock.
+    flock locks each open file, so do not take the same lock again in the context. It blocks forever.
+    :param lock_path: path of the lock file.
+    :param exclusive: If True, take exclusive lock. Otherwise, take shared lock. Default is True.
+    """
+    if fcntl is None:
+        yield
+        return
+    if os.path.dirname(lock_path) != '' and not os.path.exists(os.path.dirname(lock_path)):
+        os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+    with open(lock_path, 'a') as lock_file:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
@@ -1 +1,4 @@
+from .base import BaseLinker
 from .redisdbSingleton import RedisDBSingleton
+from .sqlite_linker import SQLiteLinker
+from .linkerfactory import LinkerFactory, LinkerType
@@ -0,0 +1,61 @@
+from abc import ABC, abstractmethod
+from typing import List, Optional, Union
+from uuid import UUID
+
+from RAGchain.utils.executor import run_in_thread
+
+
+class BaseLinker(ABC):
+    """
+    Abstract class of linker, which links passage ids to the db origin of each passage.
+    Retrievals store passage ids only, so they find the DB of each passage with the linker.
+    """
+
+    @abstractmethod
+    def get_json(self, ids: List[Union[UUID, str]]) -> List[Optional[dict]]:
+        """
+        Get db origins of the given ids at once.
+        :param ids: list of passage ids.
+        :return: list of db origin of each id. None if the id is not linked.
+        """
+        pass
+
+    async def aget_json(self, ids: List[Union[UUID, str]]) -> List[Optional[dict]]:
+        """
+        Async version of get_json. Default implementation runs get_json at a thread.
+        Override it when the linker has a native async client.
+        """
+        return await run_in_thread(self.get_json, ids)
+
+    @abstractmethod
+    def set_json(self, ids: List[Union[UUID, str]], values: List[dict]):
+        """
+        Link the given ids to db origins at once.
+        :param ids: list of passage ids.
+        :param values: db origin of each id.
+        """
+        pass
+
+    @abstractmethod
+    def delete_json(self, ids: List[Union[UUID, str]]):
+        """Remove links of the given ids."""
+        pass
+
+    @abstractmethod
+    def get_db_origins(self) -> Optional[List[dict]]:
+        """
+        Get all db origins which are linked at set_json.
+        Db origins of deleted links can be included, so it is a superset of linked db origins.
+        :return: list of db origins. None if the linker can not tell that the list has all linked db origins.
+        """
+        pass
+
+    @abstractmethod
+    def connection_check(self) -> bool:
+        """Check the linker is available."""
+        pass
+
+    @abstractmethod
+    def flush_db(self):
+        """Remove all links."""
+        pass
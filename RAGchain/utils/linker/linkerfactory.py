@@ -0,0 +1,48 @@
+import os
+from enum import Enum
+from typing import Optional
+
+from RAGchain.utils.linker.base import BaseLinker
+from RAGchain.utils.util import text_modifier
+
+
+class LinkerType(Enum):
+    REDIS = 'redis'
+    SQLITE = 'sqlite'
+
+
+class LinkerFactory:
+    """
+    LinkerFactory is a factory class that returns the linker according to the linker type.
+    DBs and retrievals get the linker with this class, so they share the same linker.
+    """
+
+    def __init__(self, linker_type: Optional[str] = None):
+        """
+        :param linker_type: Linker type. If None, use LINKER_TYPE environment variable,
+        and use redis when it is not set. You can choose one of the following types.
+        - redis: RedisDBSingleton. Set REDIS_HOST, REDIS_PORT, REDIS_DB_NAME and REDIS_PW to environment variable.
+        - sqlite: SQLiteLinker, which is embedded and does not need any server.
+        Set LINKER_SAVE_PATH to environment variable.
+        """
+        if linker_type is None:
+            linker_type = os.getenv("LINKER_TYPE", "redis")
+        if linker_type in text_modifier('redis'):
+            self.linker_type = LinkerType.REDIS
+        elif linker_type in text_modifier('sqlite'):
+            self.linker_type = LinkerType.SQLITE
+        else:
+            raise ValueError(f"Unknown linker type: {linker_type}")
+
+    def get(self) -> BaseLinker:
+        """
+        Returns the linker according to the linker type.
+        """
+        if self.linker_type == LinkerType.REDIS:
+            from RAGchain.utils.linker.redisdbSingleton import RedisDBSingleton
+            return RedisDBSingleton()
+        elif self.linker_type == LinkerType.SQLITE:
+            from RAGchain.utils.linker.sqlite_linker import SQLiteLinker
+            return SQLiteLinker()
+        else:
+            raise ValueError(f"Unknown linker type: {self.linker_type}")
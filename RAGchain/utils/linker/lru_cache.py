@@ -0,0 +1,59 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Optional, Hashable
+
+
+class LRUCache:
+    """
+    Thread-safe in-process LRU cache with size limit and TTL.
+    When the cache is full, the least recently used item is evicted.
+    Items older than ttl seconds are treated as missing.
+    """
+
+    def __init__(self, max_size: int, ttl: Optional[float] = None):
+        """
+        :param max_size: max count of cached items. If it is 0, nothing is cached.
+        :param ttl: seconds to keep each item. If None, items are kept until they are evicted.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._items: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """
+        Get the cached value of the key. None if the key is not cached or expired.
+        """
+        with self._lock:
+            item = self._items.get(key)
+            if item is None or (self.ttl is not None and time.monotonic() - item[1] > self.ttl):
+                if item is not None:
+                    del self._items[key]
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def set(self, key: Hashable, value: Any):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._items[key] = (value, time.monotonic())
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def delete(self, key: Hashable):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
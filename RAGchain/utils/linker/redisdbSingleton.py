@@ -1,18 +1,34 @@
+import asyncio
+import json
 import os
 import warnings
-from typing import Union
+import weakref
+from typing import Union, List, Optional
 from uuid import UUID
 
 import redis
+import redis.asyncio
+from redis.commands.json.path import Path
 
+from RAGchain.utils.linker.base import BaseLinker
+from RAGchain.utils.linker.lru_cache import LRUCache
 
-class RedisDBSingleton:
+
+class RedisDBSingleton(BaseLinker):
     """
     RedisDBSingleton is a singleton class that manages redis.
     We use redis to link DB and passage ids that stores in retrievals.
+    It can cache db origins in process with LRU cache, because they rarely change once they are written.
+    Set REDIS_CACHE_SIZE (and REDIS_CACHE_TTL in seconds) to environment variable, or call set_cache to use it.
+    Cached db origins are updated at set_json and removed at delete_json of this process.
+    aget_json uses redis.asyncio client, which is made for each event loop, because its connections belong to the loop.
     """
     __instance = None
     _is_initialized = False
+    # key of the redis set which has all linked db origins as JSON strings
+    DB_ORIGINS_KEY = 'RAGchain:db_origins'
+    # marker key which exists when DB_ORIGINS_KEY has db origins of all links
+    DB_ORIGINS_COMPLETE_KEY = 'RAGchain:db_origins_complete'
 
     def __new__(cls, *args, **kwargs):
         if not cls.__instance:
@@ -44,18 +60,168 @@ class RedisDBSingleton:
             decode_responses=True,
             password=password
         )
+        self._client_kwargs = dict(host=host, port=port, db=db_name, decode_responses=True, password=password)
+        self._async_clients = weakref.WeakKeyDictionary()
+        cache_ttl = os.getenv("REDIS_CACHE_TTL")
+        self.set_cache(int(os.getenv("REDIS_CACHE_SIZE", 0)), float(cache_ttl) if cache_ttl is not None else None)
         self._is_initialized = True
 
-    def get_json(self, ids: list[Union[UUID, str]]):
+    def set_cache(self, max_size: int, ttl: Optional[float] = None):
+        """
+        Set in-process LRU cache of db origins. Cached items are cleared.
+        :param max_size: max count of cached passage ids. If it is 0, cache is not used.
+        :param ttl: seconds to keep each cached db origin. If None, keep until it is evicted.
+        """
+        self.cache = LRUCache(max_size, ttl)
+
+    @property
+    def cache_hits(self) -> int:
+        return self.cache.hits
+
+    @property
+    def cache_misses(self) -> int:
+        return self.cache.misses
+
+    def invalidate(self, ids: Optional[list[Union[UUID, str]]] = None):
+        """
+        Remove cached db origins of the given ids. If ids is None, clear all cached db origins.
+        """
+        if ids is None:
+            self.cache.clear()
+            return
+        for find_id in ids:
+            self.cache.delete(str(find_id))
+
+    def get_json(self, ids: list[Union[UUID, str]]) -> List[Optional[dict]]:
+        """
+        Get db origins of the given ids in one round trip with JSON.MGET.
+        When the cache is used, only ids which are not cached are sent to redis.
+        Do not modify returned db origins, because they can be shared with the cache.
+        :param ids: list of passage ids.
+        :return: list of db origin of each id. None if the id is not in redis.
+        """
+        if len(ids) == 0:
+            return []
         # redis only accept str type key
         str_ids = [str(find_id) for find_id in ids]
-        return [self.client.json().get(find_id) for find_id in str_ids]
+        if self.cache.max_size <= 0:
+            return self.client.json().mget(str_ids, Path.root_path())
+        result = [self.cache.get(find_id) for find_id in str_ids]
+        missed = [i for i, value in enumerate(result) if value is None]
+        if len(missed) > 0:
+            missed_values = self.client.json().mget([str_ids[i] for i in missed], Path.root_path())
+            for i, value in zip(missed, missed_values):
+                result[i] = value
+                # missing ids are not cached, because they can be written by other processes
+                if value is not None:
+                    self.cache.set(str_ids[i], value)
+        return result
+
+    async def aget_json(self, ids: list[Union[UUID, str]]) -> List[Optional[dict]]:
+        """
+        Async version of get_json with redis.asyncio. It shares the cache with get_json.
+        :param ids: list of passage ids.
+        :return: list of db origin of each id. None if the id is not in redis.
+        """
+        if len(ids) == 0:
+            return []
+        str_ids = [str(find_id) for find_id in ids]
+        client = self.async_client
+        if self.cache.max_size <= 0:
+            return await client.json().mget(str_ids, Path.root_path())
+        result = [self.cache.get(find_id) for find_id in str_ids]
+        missed = [i for i, value in enumerate(result) if value is None]
+        if len(missed) > 0:
+            missed_values = await client.json().mget([str_ids[i] for i in missed], Path.root_path())
+            for i, value in zip(missed, missed_values):
+                result[i] = value
+                if value is not None:
+                    self.cache.set(str_ids[i], value)
+        return result
+
+    @property
+    def async_client(self) -> redis.asyncio.Redis:
+        """redis.asyncio client of the running event loop."""
+        loop = asyncio.get_running_loop()
+        if loop not in self._async_clients:
+            self._async_clients[loop] = redis.asyncio.Redis(**self._client_kwargs)
+        return self._async_clients[loop]
+
+    def set_json(self, ids: list[Union[UUID, str]], values: List[dict], batch_size: int = 1000):
+        """
+        Set db origins of the given ids. Commands are sent with pipelines of batch_size,
+        so it costs one round trip per batch instead of per id.
+        :param ids: list of passage ids.
+        :param values: db origin of each id.
+        :param batch_size: count of commands in one pipeline. Default is 1000.
+        """
+        for start in range(0, len(ids), batch_size):
+            pipeline = self.client.json().pipeline(transaction=False)
+            for find_id, value in zip(ids[start:start + batch_size], values[start:start + batch_size]):
+                pipeline.set(str(find_id), '$', value)
+            pipeline.execute()
+        if len(values) > 0:
+            self.client.sadd(self.DB_ORIGINS_KEY, *{json.dumps(value, sort_keys=True) for value in values})
+        for find_id, value in zip(ids, values):
+            self.cache.set(str(find_id), value)
+
+    def delete_json(self, ids: list[Union[UUID, str]]):
+        """
+        Delete db origins of the given ids at redis and the cache.
+        """
+        if len(ids) > 0:
+            self.client.delete(*[str(find_id) for find_id in ids])
+        self.invalidate(ids)
+
+    def get_db_origins(self) -> Optional[List[dict]]:
+        """
+        Get all db origins which are linked at set_json.
+        Links which are set before db origins were recorded are not in the list,
+        so it returns None until flush_db or backfill_db_origins is called once.
+        :return: list of db origins. None if the list is not known to be complete.
+        """
+        with self.client.pipeline(transaction=True) as pipeline:
+            pipeline.exists(self.DB_ORIGINS_COMPLETE_KEY)
+            pipeline.smembers(self.DB_ORIGINS_KEY)
+            is_complete, origin_texts = pipeline.execute()
+        if not is_complete:
+            return None
+        return [json.loads(origin_text) for origin_text in origin_texts]
+
+    def backfill_db_origins(self, batch_size: int = 1000):
+        """
+        Record db origins of all links, and mark the recorded db origins as complete.
+        Call it once when links are set by versions which did not record db origins.
+        :param batch_size: count of keys to read in one request. Default is 1000.
+        """
+        internal_keys = {self.DB_ORIGINS_KEY, self.DB_ORIGINS_COMPLETE_KEY}
+        keys = []
+        for key in self.client.scan_iter(count=batch_size):
+            if key in internal_keys:
+                continue
+            keys.append(key)
+            if len(keys) >= batch_size:
+                self.__record_db_origins(keys)
+                keys = []
+        self.__record_db_origins(keys)
+        self.client.set(self.DB_ORIGINS_COMPLETE_KEY, 1)
+
+    def __record_db_origins(self, keys: List[str]):
+        if len(keys) == 0:
+            return
+        origin_texts = {json.dumps(value, sort_keys=True)
+                        for value in self.client.json().mget(keys, Path.root_path()) if value is not None}
+        if len(origin_texts) > 0:
+            self.client.sadd(self.DB_ORIGINS_KEY, *origin_texts)
 
     def connection_check(self):
         return self.client.ping()
 
     def flush_db(self):
         self.client.flushdb()
+        # there is no link, so recorded db origins are complete
+        self.client.set(self.DB_ORIGINS_COMPLETE_KEY, 1)
+        self.invalidate()
 
     def __del__(self):
         self.client.close()
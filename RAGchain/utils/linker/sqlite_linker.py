@@ -0,0 +1,123 @@
+import json
+import os
+import sqlite3
+import threading
+from typing import List, Optional, Union
+from uuid import UUID
+
+from RAGchain.utils.linker.base import BaseLinker
+
+
+class SQLiteLinker(BaseLinker):
+    """
+    SQLiteLinker is an embedded linker, which stores links at a local SQLite file.
+    It does not need any server, so it fits single-node deployments and benchmarks.
+    There is one instance for each save path, like RedisDBSingleton.
+    Most passages link to a few db origins, so db origins are stored once at origins table,
+    and parsed db origins are kept in process. So lookups cost one indexed query for all ids.
+    Ids of db origins are never reused, so processes sharing the file can keep parsed db origins safely.
+    Multiple processes can share the file, because it uses WAL journal mode.
+    """
+    __instances = {}
+    __instances_lock = threading.Lock()
+    # SQLite limits the count of variables in one query
+    QUERY_BATCH_SIZE = 500
+
+    def __new__(cls, save_path: Optional[str] = None, *args, **kwargs):
+        save_path = cls.__get_save_path(save_path)
+        with cls.__instances_lock:
+            if save_path not in cls.__instances:
+                instance = super().__new__(cls)
+                instance._is_initialized = False
+                cls.__instances[save_path] = instance
+            return cls.__instances[save_path]
+
+    def __init__(self, save_path: Optional[str] = None):
+        """
+        :param save_path: path of the SQLite file. If None, use LINKER_SAVE_PATH environment variable.
+        """
+        if self._is_initialized:
+            return
+        self.save_path = self.__get_save_path(save_path)
+        if self.save_path != ':memory:' and os.path.dirname(self.save_path) != '' \
+                and not os.path.exists(os.path.dirname(self.save_path)):
+            os.makedirs(os.path.dirname(self.save_path))
+        self.connection = sqlite3.connect(self.save_path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS origins '
+                                '(origin_id INTEGER PRIMARY KEY AUTOINCREMENT, origin TEXT UNIQUE NOT NULL)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS links '
+                                '(id TEXT PRIMARY KEY, origin_id INTEGER NOT NULL) WITHOUT ROWID')
+        self.connection.commit()
+        self._origins = {}
+        self._lock = threading.Lock()
+        self._is_initialized = True
+
+    @staticmethod
+    def __get_save_path(save_path: Optional[str]) -> str:
+        save_path = save_path if save_path is not None else os.getenv("LINKER_SAVE_PATH")
+        if save_path is None:
+            raise ValueError("Please set LINKER_SAVE_PATH to environment variable")
+        return save_path
+
+    def get_json(self, ids: List[Union[UUID, str]]) -> List[Optional[dict]]:
+        """
+        Get db origins of the given ids. Do not modify returned db origins, because they are shared.
+        :param ids: list of passage ids.
+        :return: list of db origin of each id. None if the id is not linked.
+        """
+        str_ids = [str(find_id) for find_id in ids]
+        origin_ids = {}
+        with self._lock:
+            for start in range(0, len(str_ids), self.QUERY_BATCH_SIZE):
+                batch = str_ids[start:start + self.QUERY_BATCH_SIZE]
+                rows = self.connection.execute(
+                    f'SELECT id, origin_id FROM links WHERE id IN ({",".join("?" * len(batch))})', batch)
+                origin_ids.update(rows.fetchall())
+            return [self.__get_origin(origin_ids[find_id]) if find_id in origin_ids else None
+                    for find_id in str_ids]
+
+    def set_json(self, ids: List[Union[UUID, str]], values: List[dict]):
+        """
+        Link the given ids to db origins in one transaction.
+        :param ids: list of passage ids.
+        :param values: db origin of each id.
+        """
+        origin_texts = [json.dumps(value, sort_keys=True) for value in values]
+        with self._lock, self.connection:
+            self.connection.executemany('INSERT OR IGNORE INTO origins (origin) VALUES (?)',
+                                        [(origin_text,) for origin_text in set(origin_texts)])
+            origin_ids = {origin_text: self.connection.execute(
+                'SELECT origin_id FROM origins WHERE origin = ?', (origin_text,)).fetchone()[0]
+                          for origin_text in set(origin_texts)}
+            self.connection.executemany('INSERT OR REPLACE INTO links (id, origin_id) VALUES (?, ?)',
+                                        [(str(find_id), origin_ids[origin_text])
+                                         for find_id, origin_text in zip(ids, origin_texts)])
+
+    def delete_json(self, ids: List[Union[UUID, str]]):
+        with self._lock, self.connection:
+            self.connection.executemany('DELETE FROM links WHERE id = ?', [(str(find_id),) for find_id in ids])
+
+    def get_db_origins(self) -> Optional[List[dict]]:
+        """Get all db origins which are linked at set_json. Origins table is written with links, so it is complete."""
+        with self._lock:
+            origin_ids = [row[0] for row in self.connection.execute('SELECT origin_id FROM origins')]
+            return [self.__get_origin(origin_id) for origin_id in origin_ids]
+
+    def connection_check(self) -> bool:
+        with self._lock:
+            return self.connection.execute('SELECT 1').fetchone()[0] == 1
+
+    def flush_db(self):
+        with self._lock, self.connection:
+            self.connection.execute('DELETE FROM links')
+            self.connection.execute('DELETE FROM origins')
+            self._origins = {}
+
+    def __get_origin(self, origin_id: int) -> dict:
+        if origin_id not in self._origins:
+            origin_text = self.connection.execute('SELECT origin FROM origins WHERE origin_id = ?',
+                                                  (origin_id,)).fetchone()[0]
+            self._origins[origin_id] = json.loads(origin_text)
+        return self._origins[origin_id]
@@ -60,9 +60,12 @@ def main(test_type, retrieval_type, suffix, device_type, embedding_type, vectord
     else:
         raise ValueError("retrieval type is not valid")
     pred = {}
-    for key in tqdm(list(data.keys())):
-        query = data[key]["question"]
-        retrieved_ids = retrieval.retrieve_id(query, top_k=10)
+    keys = list(data.keys())
+    if isinstance(retrieval, BM25Retrieval):
+        batch_ids, _ = retrieval.retrieve_id_with_scores_batch([data[key]["question"] for key in keys], top_k=10)
+    else:
+        batch_ids = [retrieval.retrieve_id(data[key]["question"], top_k=10) for key in tqdm(keys)]
+    for key, retrieved_ids in zip(keys, batch_ids):
         pred[key] = {
             "answer": str(True),
             "decomposition": [],
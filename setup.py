@@ -28,6 +28,7 @@ setup(
         'tiktoken',
         'rank_bm25',
         'numpy',
+        'scipy',
         'pandas',
         'pydantic',
         'tqdm',
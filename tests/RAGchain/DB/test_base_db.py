@@ -1,7 +1,10 @@
+import asyncio
 from typing import List
 
+import pytest
+
 from RAGchain.DB.base import BaseDB
-from RAGchain.schema import Passage
+from RAGchain.schema import Passage, LazyPassage
 
 TEST_PASSAGES: List[Passage] = [
     Passage(
@@ -76,3 +79,37 @@ def search_test_base(db: BaseDB):
     test_result_6 = db.search(id=['test_id_3', 'test_id_4'], filepath=['./test/second_file.txt'])
     assert len(test_result_6) == 1
     assert 'test_id_3' == test_result_6[0].id
+
+
+def fetch_fields_test_base(db: BaseDB):
+    ids = [passage.id for passage in TEST_PASSAGES[:2]]
+    fetch_passages = db.fetch(ids, fields=['filepath'])
+    assert set(passage.id for passage in fetch_passages) == set(ids)
+    for passage in fetch_passages:
+        expected = TEST_PASSAGES[ids.index(passage.id)]
+        assert passage.filepath == expected.filepath
+        assert passage.content == expected.content  # loaded lazily
+        assert passage.to_passage().is_exactly_same(expected)
+        assert passage == expected and expected == passage
+
+    # passage which is deleted after the projection can not be loaded
+    deleted_passage = LazyPassage('deleted_id', db._lazy_loader('deleted_id'), filepath='./test/deleted_file.txt')
+    assert deleted_passage.filepath == './test/deleted_file.txt'
+    with pytest.raises(KeyError, match='deleted_id'):
+        deleted_passage.content
+
+    search_passages = db.search(filepath=['./test/second_file.txt'], test=['test3'], fields=[])
+    assert [passage.id for passage in search_passages] == ['test_id_3']
+    assert search_passages[0].metadata_etc == TEST_PASSAGES[2].metadata_etc
+
+
+def async_test_base(db: BaseDB):
+    async def fetch_and_search():
+        return await asyncio.gather(db.afetch(ids), db.asearch(filepath=['./test/second_file.txt'], test=['test3']),
+                                    db.afetch(ids, fields=['filepath']))
+
+    ids = [passage.id for passage in TEST_PASSAGES]
+    fetch_passages, search_passages, fields_passages = asyncio.run(fetch_and_search())
+    assert fetch_passages == db.fetch(ids)
+    assert [passage.id for passage in search_passages] == ['test_id_3']
+    assert [passage.filepath for passage in fields_passages] == [passage.filepath for passage in fetch_passages]
@@ -1,6 +1,7 @@
 import os
 
 import pytest
+from pymongo.errors import BulkWriteError
 
 import test_base_db
 from RAGchain.DB import MongoDB
@@ -34,3 +35,66 @@ def test_db_type(mongo_db):
 
 def test_search(mongo_db):
     test_base_db.search_test_base(mongo_db)
+
+
+def test_bulk_save(mongo_db):
+    passages = [passage.copy(update={'id': f'{passage.id}_bulk'}) for passage in test_base_db.TEST_PASSAGES]
+    mongo_db.batch_size = 3
+    try:
+        mongo_db.save(passages)
+        assert [passage.id for passage in mongo_db.search(id=[passage.id for passage in passages])] == \
+               [passage.id for passage in passages]
+
+        updated_passage = passages[0].copy(update={'content': 'This is updated test number 1'})
+        mongo_db.save([updated_passage], upsert=True)
+        assert mongo_db.fetch([updated_passage.id])[0].is_exactly_same(updated_passage)
+        assert mongo_db.collection.count_documents({}) == len(test_base_db.TEST_PASSAGES) + len(passages)
+    finally:
+        mongo_db.batch_size = 1000
+        mongo_db.collection.delete_many({'_id': {'$in': [passage.id for passage in passages]}})
+
+
+def test_save_duplicated_id(mongo_db):
+    passages = [passage.copy(update={'id': f'{passage.id}_duplicated'}) for passage in test_base_db.TEST_PASSAGES]
+    mongo_db.linker.delete_json([passage.id for passage in passages])
+    try:
+        mongo_db.save(passages[:1])
+        with pytest.raises(BulkWriteError):
+            mongo_db.save(passages)
+        # passages after the duplicated one are still written and linked
+        assert mongo_db.collection.count_documents({'_id': {'$in': [passage.id for passage in passages]}}) == \
+               len(passages)
+        assert mongo_db.linker.get_json([passage.id for passage in passages]) == \
+               [mongo_db.get_db_origin().to_dict()] * len(passages)
+    finally:
+        mongo_db.collection.delete_many({'_id': {'$in': [passage.id for passage in passages]}})
+        mongo_db.linker.delete_json([passage.id for passage in passages])
+
+
+def test_shared_client(mongo_db):
+    other_db = MongoDB(
+        mongo_url=os.getenv('MONGO_URL'),
+        db_name=os.getenv('MONGO_DB_NAME'),
+        collection_name=os.getenv('MONGO_COLLECTION_NAME'))
+    other_db.load_if_changed()
+    assert other_db.client is mongo_db.client
+    test_base_db.fetch_test_base(other_db)
+
+    # clients are keyed by mongo url only, so db made from its db origin shares the client made with client_kwargs
+    pooled_db = MongoDB(
+        mongo_url=os.getenv('MONGO_URL'),
+        db_name=os.getenv('MONGO_DB_NAME'),
+        collection_name=os.getenv('MONGO_COLLECTION_NAME'),
+        client_kwargs={'maxPoolSize': 10})
+    pooled_db.load_if_changed()
+    origin_db = MongoDB(**pooled_db.get_db_origin().db_path)
+    origin_db.load_if_changed()
+    assert pooled_db.client is origin_db.client is mongo_db.client
+
+
+def test_fetch_fields(mongo_db):
+    test_base_db.fetch_fields_test_base(mongo_db)
+
+
+def test_async(mongo_db):
+    test_base_db.async_test_base(mongo_db)
@@ -1,10 +1,14 @@
 import os
 import pathlib
+import pickle
+import threading
 
 import pytest
 
 from RAGchain.DB import PickleDB
-from test_base_db import fetch_test_base, TEST_PASSAGES, search_test_base
+from RAGchain.utils.file_lock import file_lock
+from test_base_db import fetch_test_base, TEST_PASSAGES, search_test_base, fetch_fields_test_base, \
+    async_test_base
 
 
 @pytest.fixture(scope='module')
@@ -19,6 +23,7 @@ def pickle_db():
     pickle_db.save(TEST_PASSAGES)
     yield pickle_db
     os.remove(pickle_db_path)
+    os.remove(f'{pickle_db_path}.lock')
 
 
 def test_create_or_load(pickle_db):
@@ -35,3 +40,134 @@ def test_db_type(pickle_db):
 
 def test_search(pickle_db):
     search_test_base(pickle_db)
+
+
+def test_load_if_changed(pickle_db):
+    other_db = PickleDB(save_path=pickle_db.save_path)
+    other_db.load_if_changed()
+    assert len(other_db.db) == len(pickle_db.db)
+    loaded_db = other_db.db
+    other_db.load_if_changed()
+    assert other_db.db is loaded_db  # not changed, so not loaded again
+
+    # another process writes the file
+    with open(pickle_db.save_path, 'wb') as w:
+        pickle.dump(pickle_db.db[:1], w)
+    try:
+        other_db.load_if_changed()
+        assert other_db.db is not loaded_db
+        assert len(other_db.db) == 1
+    finally:
+        pickle_db.save(TEST_PASSAGES)
+        pickle_db.compact()
+
+
+def test_fetch_order(pickle_db):
+    ids = [passage.id for passage in reversed(TEST_PASSAGES)]
+    assert [passage.id for passage in pickle_db.fetch(ids + ['missing_id'])] == ids
+
+    updated_passage = TEST_PASSAGES[1].copy(update={'content': 'This is updated test number 2'})
+    try:
+        pickle_db.save([updated_passage])
+        assert len(pickle_db.db) == len(TEST_PASSAGES)
+        assert pickle_db.db[1].content == updated_passage.content
+        assert pickle_db.fetch([updated_passage.id])[0].content == updated_passage.content
+    finally:
+        pickle_db.save([TEST_PASSAGES[1]])
+
+
+def test_append_log(pickle_db):
+    other_db = PickleDB(save_path=pickle_db.save_path)
+    other_db.load()
+    file_size = os.path.getsize(pickle_db.save_path)
+    updated_passage = TEST_PASSAGES[0].copy(update={'content': 'This is updated test number 1'})
+    try:
+        pickle_db.save([updated_passage])
+        assert os.path.getsize(pickle_db.save_path) - file_size < file_size  # only the new record is written
+
+        other_db.load_if_changed()  # reads the appended record only
+        assert len(other_db.db) == len(TEST_PASSAGES)
+        assert other_db.fetch([updated_passage.id])[0].content == updated_passage.content
+
+        pickle_db.compact()
+        with open(pickle_db.save_path, 'rb') as f:
+            assert pickle.load(f) == pickle_db.db
+        other_db.load_if_changed()
+        assert other_db.db == pickle_db.db
+    finally:
+        pickle_db.save([TEST_PASSAGES[0]])
+        pickle_db.compact()
+
+
+def test_compact_keeps_appended_records(pickle_db):
+    other_db = PickleDB(save_path=pickle_db.save_path)
+    other_db.load()
+    new_passage = TEST_PASSAGES[0].copy(update={'id': 'test_id_compact', 'content': 'This is appended test'})
+    try:
+        # another process appends a record, then this process compacts before loading it
+        other_db.save([new_passage])
+        pickle_db.compact()
+        assert pickle_db.fetch([new_passage.id])[0].content == new_passage.content
+        with open(pickle_db.save_path, 'rb') as f:
+            assert new_passage.id in [passage.id for passage in pickle.load(f)]
+        reloaded_db = PickleDB(save_path=pickle_db.save_path)
+        reloaded_db.load()
+        assert len(reloaded_db.db) == len(TEST_PASSAGES) + 1
+    finally:
+        with open(pickle_db.save_path, 'wb') as w:
+            pickle.dump(TEST_PASSAGES, w, protocol=pickle.HIGHEST_PROTOCOL)
+        pickle_db.load()
+        pickle_db.linker.delete_json([new_passage.id])
+
+
+def test_compact_file_lock(pickle_db):
+    compact_thread = threading.Thread(target=pickle_db.compact)
+    with file_lock(f'{pickle_db.save_path}.lock'):
+        # another process is appending, so compact waits
+        compact_thread.start()
+        compact_thread.join(0.2)
+        assert compact_thread.is_alive()
+    compact_thread.join()
+    assert len(pickle_db.db) == len(TEST_PASSAGES)
+
+
+def test_load_if_changed_rewritten_in_place(pickle_db):
+    other_db = PickleDB(save_path=pickle_db.save_path)
+    other_db.load()
+    more_passages = [passage.copy(update={'id': f'{passage.id}_more'}) for passage in TEST_PASSAGES]
+    try:
+        # another process rewrites the file in place, so it keeps the inode and grows
+        with open(pickle_db.save_path, 'wb') as w:
+            pickle.dump(TEST_PASSAGES + more_passages, w, protocol=pickle.HIGHEST_PROTOCOL)
+        other_db.load_if_changed()
+        assert len(other_db.db) == len(TEST_PASSAGES) + len(more_passages)
+        other_db.load_if_changed()
+        assert len(other_db.db) == len(TEST_PASSAGES) + len(more_passages)
+    finally:
+        with open(pickle_db.save_path, 'wb') as w:
+            pickle.dump(TEST_PASSAGES, w, protocol=pickle.HIGHEST_PROTOCOL)
+        pickle_db.load()
+
+
+def test_secondary_index(pickle_db):
+    indexed_db = PickleDB(save_path=pickle_db.save_path, index_metadata_keys=['test'])
+    indexed_db.load()
+    assert indexed_db.indexes['test'].candidates(['test3']) == {'test_id_3', 'test_id_4'}
+    search_test_base(indexed_db)
+
+    unhashable_passage = TEST_PASSAGES[3].copy(update={'metadata_etc': {'test': ['test3']}})
+    try:
+        indexed_db.save([unhashable_passage])
+        assert [passage.id for passage in indexed_db.search(test=['test3'])] == ['test_id_3']
+        assert [passage.id for passage in indexed_db.search(test=[['test3']])] == ['test_id_4']
+        assert indexed_db.search(filepath=['./test/third_file.txt'], test=['test1']) == []
+    finally:
+        indexed_db.save([TEST_PASSAGES[3]])
+
+
+def test_fetch_fields(pickle_db):
+    fetch_fields_test_base(pickle_db)
+
+
+def test_async(pickle_db):
+    async_test_base(pickle_db)
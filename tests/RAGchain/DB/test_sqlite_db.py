@@ -0,0 +1,66 @@
+import os
+import pathlib
+
+import pytest
+
+from RAGchain.DB import SQLiteDB
+from test_base_db import fetch_test_base, TEST_PASSAGES, search_test_base, fetch_fields_test_base, \
+    async_test_base
+
+
+@pytest.fixture(scope='module')
+def sqlite_db():
+    root_dir = pathlib.PurePath(os.path.dirname(os.path.realpath(__file__))).parent.parent
+    resource_dir = os.path.join(root_dir, "resources")
+    sqlite_db_path = os.path.join(resource_dir, "sqlite", "sqlite_db.db")
+    sqlite_db = SQLiteDB(
+        save_path=sqlite_db_path,
+        index_metadata_keys=['test']
+    )
+    sqlite_db.create_or_load()
+    sqlite_db.save(TEST_PASSAGES)
+    yield sqlite_db
+    for path in [sqlite_db_path, f'{sqlite_db_path}-wal', f'{sqlite_db_path}-shm']:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def test_create_or_load(sqlite_db):
+    assert os.path.exists(sqlite_db.save_path)
+
+
+def test_fetch(sqlite_db):
+    fetch_test_base(sqlite_db)
+    ids = [passage.id for passage in reversed(TEST_PASSAGES)]
+    assert [passage.id for passage in sqlite_db.fetch(ids + ['missing_id'])] == ids
+
+
+def test_db_type(sqlite_db):
+    assert sqlite_db.db_type == 'sqlite_db'
+
+
+def test_search(sqlite_db):
+    search_test_base(sqlite_db)
+    plan = sqlite_db.connection.execute(
+        f"EXPLAIN QUERY PLAN SELECT id FROM passages WHERE {sqlite_db._metadata_expression('test')} IN (?)",
+        ['test1']).fetchall()
+    assert 'idx_metadata_test' in str(plan)
+
+
+def test_save_existing_id(sqlite_db):
+    updated_passage = TEST_PASSAGES[1].copy(update={'content': 'This is updated test number 2'})
+    try:
+        sqlite_db.save([updated_passage])
+        assert sqlite_db.fetch([updated_passage.id])[0].is_exactly_same(updated_passage)
+        assert [passage.id for passage in sqlite_db.search(filepath=['./test/second_file.txt'])] == \
+               ['test_id_2', 'test_id_3']
+    finally:
+        sqlite_db.save([TEST_PASSAGES[1]])
+
+
+def test_fetch_fields(sqlite_db):
+    fetch_fields_test_base(sqlite_db)
+
+
+def test_async(sqlite_db):
+    async_test_base(sqlite_db)
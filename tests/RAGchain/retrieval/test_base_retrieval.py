@@ -1,6 +1,9 @@
+import asyncio
 import os
 import pathlib
 import pickle
+import shutil
+import threading
 from typing import List, Union
 from uuid import UUID
 
@@ -139,6 +142,8 @@ def just_bm25_retrieval():
     # teardown
     if os.path.exists(bm25_path):
         os.remove(bm25_path)
+    if os.path.exists(bm25_retrieval.index.segment_dir):
+        shutil.rmtree(bm25_retrieval.index.segment_dir)
     if os.path.exists(pickle_path):
         os.remove(pickle_path)
 
@@ -223,3 +228,44 @@ def test_fetch_each_db(just_mongo_db, just_mongo_db_2, just_bm25_retrieval):
     just_mongo_db_2.save(TEST_PASSAGES_3)
     # Test
     assert just_bm25_retrieval.fetch_each_db(TEST_DB_ORIGIN_RESULT_2, TEST_IDS) == TEST_RESULT_PASSAGES
+
+
+def test_fetch_data_order(just_bm25_retrieval):
+    ids = [SEARCH_TEST_PASSAGES[2].id, TEST_PASSAGES[3].id, SEARCH_TEST_PASSAGES[2].id, 'missing_id',
+           TEST_PASSAGES[0].id]
+    passages, missed_ids = just_bm25_retrieval.fetch_data_with_misses(ids)
+    assert [passage.id for passage in passages] == [SEARCH_TEST_PASSAGES[2].id, TEST_PASSAGES[3].id,
+                                                    TEST_PASSAGES[0].id]
+    assert missed_ids == ['missing_id']
+    assert just_bm25_retrieval.fetch_data(ids) == passages
+
+
+def test_afetch_data(just_bm25_retrieval, monkeypatch):
+    ids = [SEARCH_TEST_PASSAGES[2].id, TEST_PASSAGES[3].id, 'missing_id', TEST_PASSAGES[0].id]
+    load_threads = []
+    load_if_changed = PickleDB.load_if_changed
+
+    def spy_load_if_changed(self):
+        load_threads.append(threading.current_thread())
+        return load_if_changed(self)
+
+    monkeypatch.setattr(PickleDB, 'load_if_changed', spy_load_if_changed)
+    passages, missed_ids = asyncio.run(just_bm25_retrieval.afetch_data_with_misses(ids))
+    # loading db must not block the event loop
+    assert len(load_threads) > 0 and threading.main_thread() not in load_threads
+    assert (passages, missed_ids) == just_bm25_retrieval.fetch_data_with_misses(ids)
+    assert asyncio.run(just_bm25_retrieval.afetch_data(ids, fields=[])) == passages
+
+
+def test_get_db_origins(just_bm25_retrieval, monkeypatch):
+    pickle_path = os.path.join(root_dir, "resources", "pickle", "just_bm25_retrieval.pkl")
+    db_origin = PickleDB(save_path=pickle_path).get_db_origin().to_dict()
+    monkeypatch.setattr(just_bm25_retrieval.linker, 'get_db_origins', lambda: [db_origin])
+    # linked dbs are not used by the retrieval yet, so they are not loaded to search allowed ids
+    assert just_bm25_retrieval.get_db_origins() is None
+    just_bm25_retrieval.fetch_data([TEST_PASSAGES[0].id])
+    assert just_bm25_retrieval.get_db_origins() == [db_origin]
+    monkeypatch.setattr(just_bm25_retrieval.linker, 'get_db_origins', lambda: None)
+    assert just_bm25_retrieval.get_db_origins() is None
+    just_bm25_retrieval.set_db_origins([PickleDB(save_path=pickle_path).get_db_origin()])
+    assert just_bm25_retrieval.get_db_origins() == [db_origin]
@@ -1,8 +1,12 @@
+import asyncio
 import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 
 import pytest
 
 import test_base_retrieval
+from RAGchain.DB import PickleDB
 from RAGchain.retrieval import BM25Retrieval
 
 
@@ -16,8 +20,11 @@ def bm25_retrieval():
     test_base_retrieval.ready_pickle_db(pickle_path)
     yield bm25_retrieval
     # teardown
+    bm25_retrieval.index.wait_merge()
     if os.path.exists(bm25_path):
         os.remove(bm25_path)
+    if os.path.exists(bm25_retrieval.index.segment_dir):
+        shutil.rmtree(bm25_retrieval.index.segment_dir)
     if os.path.exists(pickle_path):
         os.remove(pickle_path)
 
@@ -35,6 +42,11 @@ def test_bm25_retrieval(bm25_retrieval):
     assert len(retrieved_ids_2) == len(scores)
     assert max(scores) == scores[0]
     assert min(scores) == scores[-1]
+    batch_ids, batch_scores = bm25_retrieval.retrieve_id_with_scores_batch(
+        queries=['What is visconde structure?', 'What is visconde structure?'], top_k=top_k)
+    assert len(batch_ids) == len(batch_scores) == 2
+    assert batch_scores[0] == pytest.approx(scores)
+    test_base_retrieval.validate_ids(batch_ids[1], top_k)
 
     bm25_retrieval.ingest(test_base_retrieval.SEARCH_TEST_PASSAGES)
     retrieved_passages = bm25_retrieval.retrieve_with_filter(
@@ -44,3 +56,147 @@ def test_bm25_retrieval(bm25_retrieval):
     )
     assert len(retrieved_passages) == 3
     assert 'test_id_1_search' in [passage.id for passage in retrieved_passages]
+
+
+def test_bm25_filter_push_down(bm25_retrieval, monkeypatch):
+    bm25_retrieval.ingest(test_base_retrieval.TEST_PASSAGES + test_base_retrieval.SEARCH_TEST_PASSAGES)
+    pickle_path = os.path.join(test_base_retrieval.root_dir, "resources", "pickle", "test_bm25_retrieval.pkl")
+    bm25_retrieval.set_db_origins([PickleDB(save_path=pickle_path).get_db_origin()])
+    allowed_ids_list = []
+    retrieve_id = bm25_retrieval.retrieve_id
+
+    def spy_retrieve_id(*args, **kwargs):
+        allowed_ids_list.append(kwargs.get('allowed_ids'))
+        return retrieve_id(*args, **kwargs)
+
+    monkeypatch.setattr(bm25_retrieval, 'retrieve_id', spy_retrieve_id)
+    filters = [{'filepath': ['./test/second_file.txt']}, {'content': ['This is test number 3']},
+               {'filepath': ['./test/not_exist_file.txt']}]
+    pushed_down = [bm25_retrieval.retrieve_with_filter(query='test number', top_k=2, **filter_kwargs)
+                   for filter_kwargs in filters]
+    # the last filter matches nothing, so nothing is retrieved
+    assert allowed_ids_list == [['test_id_2_search', 'test_id_3_search'], ['test_id_3_search', 'test_id_4_search']]
+    monkeypatch.setattr(bm25_retrieval, 'supports_allowed_ids', lambda: False)
+    for filter_kwargs, passages in zip(filters, pushed_down):
+        expected = bm25_retrieval.retrieve_with_filter(query='test number', top_k=2, **filter_kwargs)
+        # passages of same score can be retrieved in any order
+        assert {passage.id for passage in passages} == {passage.id for passage in expected}
+    assert {passage.id for passage in pushed_down[0]} == {'test_id_2_search', 'test_id_3_search'}
+    assert pushed_down[2] == []
+
+    # more passages than max_allowed_ids match, so retrieved passages are filtered
+    monkeypatch.setattr(bm25_retrieval, 'supports_allowed_ids', lambda: True)
+    monkeypatch.setattr(bm25_retrieval, 'max_allowed_ids', lambda: 1)
+    allowed_ids_list.clear()
+    passages = bm25_retrieval.retrieve_with_filter(query='test number', top_k=2, **filters[0])
+    assert allowed_ids_list == [None]
+    assert {passage.id for passage in passages} == {passage.id for passage in pushed_down[0]}
+
+
+def test_bm25_async_retrieval(bm25_retrieval):
+    bm25_retrieval.ingest(test_base_retrieval.TEST_PASSAGES)
+    queries = ['What is visconde structure?', 'How to use RAG?'] * 50
+
+    async def retrieve_concurrently():
+        return await asyncio.gather(*[bm25_retrieval.aretrieve(query, top_k=4) for query in queries],
+                                    bm25_retrieval.aretrieve_id_with_scores(queries[0], top_k=4))
+
+    *results, (ids, scores) = asyncio.run(retrieve_concurrently())
+    assert len(results) == len(queries)
+    for query, passages in zip(queries[:2], results[:2]):
+        assert passages == bm25_retrieval.retrieve(query, top_k=4)
+    assert (ids, scores) == bm25_retrieval.retrieve_id_with_scores(queries[0], top_k=4)
+
+
+def test_bm25_parallel_ingest(bm25_retrieval):
+    bm25_path = os.path.join(test_base_retrieval.root_dir, "resources", "bm25", "test_bm25_parallel_ingest.pkl")
+    parallel_retrieval = BM25Retrieval(save_path=bm25_path, batch_size=3, num_workers=2)
+    try:
+        bm25_retrieval.ingest(test_base_retrieval.TEST_PASSAGES)
+        parallel_retrieval.ingest(test_base_retrieval.TEST_PASSAGES)
+        assert list(parallel_retrieval.index.segments[0].passage_id) == \
+               [passage.id for passage in test_base_retrieval.TEST_PASSAGES]
+        for query in ['What is visconde structure?', 'How to use RAG?']:
+            assert parallel_retrieval.retrieve_id_with_scores(query, top_k=6) == \
+                   bm25_retrieval.retrieve_id_with_scores(query, top_k=6)
+    finally:
+        parallel_retrieval.index.wait_merge()
+        if os.path.exists(bm25_path):
+            os.remove(bm25_path)
+        if os.path.exists(parallel_retrieval.index.segment_dir):
+            shutil.rmtree(parallel_retrieval.index.segment_dir)
+
+
+def test_bm25_delete_and_upsert(bm25_retrieval):
+    bm25_retrieval.ingest(test_base_retrieval.SEARCH_TEST_PASSAGES)
+    query = 'This is test number 3'
+    retrieved_ids = bm25_retrieval.retrieve_id(query=query, top_k=4)
+    assert set(retrieved_ids) == {passage.id for passage in test_base_retrieval.SEARCH_TEST_PASSAGES}
+    assert bm25_retrieval.delete(['test_id_3_search']) == 1
+    assert 'test_id_3_search' not in bm25_retrieval.retrieve_id(query=query, top_k=4)
+
+    edited_passage = test_base_retrieval.SEARCH_TEST_PASSAGES[0].copy(update={'content': 'visconde structure'})
+    bm25_retrieval.upsert([edited_passage])
+    retrieved_ids = bm25_retrieval.retrieve_id(query='visconde structure', top_k=3)
+    assert retrieved_ids[0] == edited_passage.id
+    assert retrieved_ids.count(edited_passage.id) == 1
+    assert len(bm25_retrieval.index) == 3
+
+
+def test_bm25_sharded_retrieval(bm25_retrieval):
+    bm25_path = os.path.join(test_base_retrieval.root_dir, "resources", "bm25", "test_bm25_sharded_retrieval.pkl")
+    sharded_retrieval = BM25Retrieval(save_path=bm25_path, num_shards=3)
+    try:
+        bm25_retrieval.ingest(test_base_retrieval.TEST_PASSAGES)
+        sharded_retrieval.ingest(test_base_retrieval.TEST_PASSAGES)
+        assert all(len(shard) > 0 for shard in sharded_retrieval.index.shards)
+        queries = ['What is visconde structure?', 'How to use RAG?']
+        for query in queries:
+            ids, scores = sharded_retrieval.retrieve_id_with_scores(query, top_k=6)
+            expected_ids, expected_scores = bm25_retrieval.retrieve_id_with_scores(query, top_k=6)
+            assert scores == pytest.approx(expected_scores)
+            assert set(ids) == set(expected_ids)
+        # postings counts are sent from the workers and summed
+        for retrieval in [sharded_retrieval, bm25_retrieval]:
+            retrieval.index.postings_evaluated = retrieval.index.postings_total = 0
+            retrieval.retrieve_id_with_scores(queries[0], top_k=6)
+        assert sharded_retrieval.index.postings_total == bm25_retrieval.index.postings_total > 0
+        assert sharded_retrieval.index.postings_evaluated == bm25_retrieval.index.postings_evaluated
+        # concurrent queries share the worker connections
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            concurrent_results = list(executor.map(
+                lambda query: sharded_retrieval.retrieve_id_with_scores(query, top_k=6), queries * 20))
+        for query, (ids, scores) in zip(queries * 20, concurrent_results):
+            assert scores == pytest.approx(bm25_retrieval.retrieve_id_with_scores(query, top_k=6)[1])
+        # a dead worker fails the query, and workers are started again at the next query
+        sharded_retrieval.index._workers[1].kill()
+        sharded_retrieval.index._workers[1].join()
+        with pytest.raises((EOFError, OSError)):
+            sharded_retrieval.retrieve_id_with_scores(queries[0], top_k=6)
+        assert sharded_retrieval.retrieve_id_with_scores(queries[0], top_k=6)[1] == pytest.approx(
+            bm25_retrieval.retrieve_id_with_scores(queries[0], top_k=6)[1])
+        batch_ids, batch_scores = sharded_retrieval.retrieve_id_with_scores_batch(queries, top_k=6)
+        assert batch_scores[0] == pytest.approx(bm25_retrieval.retrieve_id_with_scores(queries[0], top_k=6)[1])
+
+        allowed_ids = [passage.id for passage in test_base_retrieval.TEST_PASSAGES[::2]]
+        ids, scores = sharded_retrieval.retrieve_id_with_scores(queries[0], top_k=6, allowed_ids=allowed_ids)
+        expected_ids, expected_scores = bm25_retrieval.retrieve_id_with_scores(queries[0], top_k=6,
+                                                                               allowed_ids=allowed_ids)
+        assert scores == pytest.approx(expected_scores)
+        assert set(ids) <= set(allowed_ids)
+
+        deleted_id = sharded_retrieval.retrieve_id(queries[0], top_k=1)[0]
+        assert sharded_retrieval.delete([deleted_id]) == bm25_retrieval.delete([deleted_id]) == 1
+        ids, scores = sharded_retrieval.retrieve_id_with_scores(queries[0], top_k=6)
+        assert deleted_id not in ids
+        assert scores == pytest.approx(bm25_retrieval.retrieve_id_with_scores(queries[0], top_k=6)[1])
+    finally:
+        sharded_retrieval.index.close()
+        sharded_retrieval.index.wait_merge()
+        for shard in sharded_retrieval.index.shards:
+            if os.path.exists(shard.save_path):
+                os.remove(shard.save_path)
+            if os.path.exists(shard.segment_dir):
+                shutil.rmtree(shard.segment_dir)
+        if os.path.exists(bm25_path):
+            os.remove(bm25_path)
@@ -38,6 +38,8 @@ def hybrid_retrieval():
         os.remove(pickle_path)
     if os.path.exists(bm25_path):
         os.remove(bm25_path)
+    if os.path.exists(bm25_retrieval.index.segment_dir):
+        shutil.rmtree(bm25_retrieval.index.segment_dir)
     if os.path.exists(chroma_path):
         shutil.rmtree(chroma_path)
 
@@ -61,3 +63,18 @@ def test_hybrid_retrieval(hybrid_retrieval):
 def test_hybrid_retrieval_rrf(hybrid_retrieval):
     hybrid_retrieval.method = 'rrf'
     test_hybrid_retrieval(hybrid_retrieval)
+
+
+def test_hybrid_fuse():
+    results = [(['a', 'b', 'c'], [1.0, 0.5, 0.0]), (['d', 'b', 'a', 'c'], [5.0, 2.0, 1.0, 0.0])]
+    hybrid_retrieval = HybridRetrieval(retrievals=[], weights=[0.5, 0.5], method='cc')
+    ids, scores = hybrid_retrieval.fuse(results, top_k=2)
+    # only passages retrieved at every retrieval are fused with cc
+    assert ids == ['a', 'b']
+    assert scores == pytest.approx([0.75, 0.75])
+    assert hybrid_retrieval.fuse(results, top_k=10)[0] == ['a', 'b', 'c']
+
+    hybrid_retrieval = HybridRetrieval(retrievals=[], method='rrf', rrf_k=60)
+    ids, scores = hybrid_retrieval.fuse(results, top_k=10)
+    assert ids == ['a', 'b', 'c', 'd']
+    assert scores == pytest.approx([1 / 61 + 1 / 63, 2 / 62, 1 / 63 + 1 / 64, 1 / 61])
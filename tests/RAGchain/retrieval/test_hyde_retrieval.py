@@ -1,4 +1,5 @@
 import os
+import shutil
 
 import pytest
 
@@ -24,6 +25,8 @@ def hyde_retrieval():
         os.remove(pickle_path)
     if os.path.exists(bm25_path):
         os.remove(bm25_path)
+    if os.path.exists(bm25_retrieval.index.segment_dir):
+        shutil.rmtree(bm25_retrieval.index.segment_dir)
 
 
 def test_hyde_retrieval(hyde_retrieval):
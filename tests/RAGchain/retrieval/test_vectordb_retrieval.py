@@ -6,6 +6,7 @@ import pytest
 from langchain.vectorstores import Chroma
 
 import test_base_retrieval
+from RAGchain.DB import PickleDB
 from RAGchain.retrieval import VectorDBRetrieval
 from RAGchain.utils.embed import EmbeddingFactory
 from RAGchain.utils.vectorstore import ChromaSlim
@@ -63,6 +64,34 @@ def test_vectordb_retrieval_slim(slim_vectordb_retrieval):
     vectordb_retrieval_test(slim_vectordb_retrieval)
 
 
+def test_vectordb_filter_fallback(vectordb_retrieval, monkeypatch):
+    # chromadb supports $in operator from 0.4.9
+    chroma_version = tuple(int(number) for number in chromadb.__version__.split('.')[:3])
+    assert vectordb_retrieval.supports_allowed_ids() == (chroma_version >= (0, 4, 9))
+
+    vectordb_retrieval.ingest(test_base_retrieval.TEST_PASSAGES + test_base_retrieval.SEARCH_TEST_PASSAGES)
+    pickle_path = os.path.join(test_base_retrieval.root_dir, "resources", "pickle", "test_vectordb_retrieval.pkl")
+    vectordb_retrieval.set_db_origins([PickleDB(save_path=pickle_path).get_db_origin()])
+    allowed_ids_list = []
+    retrieve_id = vectordb_retrieval.retrieve_id
+
+    def spy_retrieve_id(*args, **kwargs):
+        allowed_ids_list.append(kwargs.get('allowed_ids'))
+        return retrieve_id(*args, **kwargs)
+
+    monkeypatch.setattr(vectordb_retrieval, 'retrieve_id', spy_retrieve_id)
+    monkeypatch.setattr(vectordb_retrieval, 'supports_allowed_ids', lambda: True)
+    monkeypatch.setattr(vectordb_retrieval, 'max_allowed_ids', lambda: 2)
+    # three passages match, which is over max_allowed_ids, so retrieved passages are filtered
+    retrieved_passages = vectordb_retrieval.retrieve_with_filter(
+        query='What is visconde structure?',
+        top_k=3,
+        content=['This is test number 1', 'This is test number 3']
+    )
+    assert len(retrieved_passages) == 3
+    assert all(allowed_ids is None for allowed_ids in allowed_ids_list)
+
+
 def vectordb_retrieval_test(retrieval: VectorDBRetrieval):
     retrieval.ingest(test_base_retrieval.TEST_PASSAGES)
     top_k = 6
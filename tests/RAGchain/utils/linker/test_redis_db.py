@@ -1,3 +1,5 @@
+import asyncio
+
 import pytest
 
 from RAGchain.utils.linker import RedisDBSingleton
@@ -25,3 +27,54 @@ def redis_db():
 
 def test_get_json(redis_db):
     assert redis_db.get_json(TEST_IDS) == [TEST_DB_ORIGIN]
+
+
+def test_aget_json(redis_db):
+    async def get_json_concurrently():
+        return await asyncio.gather(*[redis_db.aget_json(TEST_IDS + ['missing_id']) for _ in range(10)])
+
+    assert asyncio.run(get_json_concurrently()) == [[TEST_DB_ORIGIN, None]] * 10
+    assert asyncio.run(redis_db.aget_json([])) == []
+
+
+def test_set_json(redis_db):
+    ids = [f'test_set_id_{i}' for i in range(5)]
+    redis_db.set_json(ids, [TEST_DB_ORIGIN] * len(ids), batch_size=2)
+    assert redis_db.get_json(ids + TEST_IDS) == [TEST_DB_ORIGIN] * (len(ids) + 1)
+    assert redis_db.get_json([]) == []
+
+
+def test_get_db_origins(redis_db):
+    redis_db.client.delete(redis_db.DB_ORIGINS_COMPLETE_KEY)
+    redis_db.set_json(['test_set_id'], [TEST_DB_ORIGIN])
+    # TEST_IDS[0] is linked without recording its db origin
+    assert redis_db.get_db_origins() is None
+    other_db_origin = {'db_type': 'other_db', 'db_path': {'save_path': 'test.pkl'}}
+    redis_db.client.json().set('test_other_id', '$', other_db_origin)
+    redis_db.backfill_db_origins(batch_size=1)
+    db_origins = redis_db.get_db_origins()
+    assert len(db_origins) == 2 and TEST_DB_ORIGIN in db_origins and other_db_origin in db_origins
+    redis_db.flush_db()
+    assert redis_db.get_db_origins() == []
+
+
+def test_cache(redis_db):
+    redis_db.set_cache(max_size=2)
+    try:
+        assert redis_db.get_json(TEST_IDS) == [TEST_DB_ORIGIN]
+        assert redis_db.get_json(TEST_IDS) == [TEST_DB_ORIGIN]
+        assert redis_db.cache_hits == 1
+        assert redis_db.cache_misses == 1
+
+        ids = [f'test_cache_id_{i}' for i in range(3)]
+        redis_db.set_json(ids, [TEST_DB_ORIGIN] * len(ids))
+        assert len(redis_db.cache) == 2  # least recently used ids are evicted
+        redis_db.delete_json(ids[-1:])
+        assert redis_db.get_json(ids) == [TEST_DB_ORIGIN, TEST_DB_ORIGIN, None]
+
+        redis_db.set_cache(max_size=10, ttl=0)
+        redis_db.get_json(TEST_IDS)
+        redis_db.get_json(TEST_IDS)
+        assert redis_db.cache_hits == 0  # expired right away
+    finally:
+        redis_db.set_cache(max_size=0)
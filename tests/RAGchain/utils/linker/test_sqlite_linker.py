@@ -0,0 +1,69 @@
+import os
+import pathlib
+import shutil
+
+import pytest
+
+from RAGchain.utils.linker import SQLiteLinker, LinkerFactory, LinkerType
+
+TEST_IDS = [f'test_id_{i}' for i in range(1200)]
+
+TEST_DB_ORIGIN = {
+    'db_type': 'test_db',
+    'db_path': {
+        'url': 'test_host',
+        'db_name': 'test_port',
+        'collection_name': 'test_db_name',
+    }
+}
+
+OTHER_DB_ORIGIN = {
+    'db_type': 'other_db',
+    'db_path': {
+        'save_path': 'test_path.pkl',
+    }
+}
+
+
+@pytest.fixture
+def sqlite_linker():
+    root_dir = pathlib.PurePath(os.path.dirname(os.path.realpath(__file__))).parent.parent.parent
+    save_dir = os.path.join(root_dir, 'resources', 'sqlite_linker')
+    sqlite_linker = SQLiteLinker(os.path.join(save_dir, 'test_linker.db'))
+    yield sqlite_linker
+    sqlite_linker.flush_db()
+    assert sqlite_linker.connection_check() is True
+    sqlite_linker.connection.close()
+    SQLiteLinker._SQLiteLinker__instances.clear()
+    if os.path.exists(save_dir):
+        shutil.rmtree(save_dir)
+
+
+def test_set_json(sqlite_linker):
+    # more ids than SQLiteLinker.QUERY_BATCH_SIZE
+    sqlite_linker.set_json(TEST_IDS, [TEST_DB_ORIGIN] * 1000 + [OTHER_DB_ORIGIN] * 200)
+    assert sqlite_linker.get_json(TEST_IDS) == [TEST_DB_ORIGIN] * 1000 + [OTHER_DB_ORIGIN] * 200
+    assert sqlite_linker.get_json(['missing_id', TEST_IDS[0]]) == [None, TEST_DB_ORIGIN]
+    assert sqlite_linker.get_json([]) == []
+
+    sqlite_linker.set_json(TEST_IDS[:1], [OTHER_DB_ORIGIN])
+    assert sqlite_linker.get_json(TEST_IDS[:1]) == [OTHER_DB_ORIGIN]
+    db_origins = sqlite_linker.get_db_origins()
+    assert len(db_origins) == 2 and TEST_DB_ORIGIN in db_origins and OTHER_DB_ORIGIN in db_origins
+
+
+def test_delete_json(sqlite_linker):
+    sqlite_linker.set_json(TEST_IDS[:3], [TEST_DB_ORIGIN] * 3)
+    sqlite_linker.delete_json(TEST_IDS[1:2])
+    assert sqlite_linker.get_json(TEST_IDS[:3]) == [TEST_DB_ORIGIN, None, TEST_DB_ORIGIN]
+
+
+def test_singleton(sqlite_linker):
+    assert SQLiteLinker(sqlite_linker.save_path) is sqlite_linker
+
+
+def test_linker_factory():
+    assert LinkerFactory('sqlite').linker_type == LinkerType.SQLITE
+    assert LinkerFactory('redis').linker_type == LinkerType.REDIS
+    with pytest.raises(ValueError):
+        LinkerFactory('unknown')
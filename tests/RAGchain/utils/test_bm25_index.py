@@ -0,0 +1,229 @@
+import os
+import pathlib
+import pickle
+import random
+import shutil
+from uuid import uuid4
+
+import numpy as np
+import pytest
+from rank_bm25 import BM25Okapi
+
+from RAGchain.utils.bm25 import BM25Index
+from RAGchain.utils.bm25.codec import varbyte_encode, varbyte_decode
+from RAGchain.utils.bm25.segment import PassageIdTable, BM25Segment
+
+random.seed(42)
+TEST_TOKENS = [[random.randint(0, 300) for _ in range(random.randint(1, 60))] for _ in range(200)]
+TEST_IDS = [f'test_id_{i}' for i in range(len(TEST_TOKENS))]
+TEST_QUERIES = [[random.randint(0, 320) for _ in range(random.randint(1, 8))] for _ in range(20)]
+
+
+@pytest.fixture
+def bm25_index():
+    yield BM25Index.from_tokens(TEST_TOKENS, TEST_IDS)
+
+
+@pytest.fixture
+def saved_bm25_index():
+    root_dir = pathlib.PurePath(os.path.dirname(os.path.realpath(__file__))).parent.parent
+    save_path = os.path.join(root_dir, "resources", "bm25", "test_bm25_index.pkl")
+    if not os.path.exists(os.path.dirname(save_path)):
+        os.makedirs(os.path.dirname(save_path))
+    bm25_index = BM25Index.load(save_path, merge_factor=3, background_merge=False)
+    yield bm25_index
+    if os.path.exists(save_path):
+        os.remove(save_path)
+    if os.path.exists(bm25_index.segment_dir):
+        shutil.rmtree(bm25_index.segment_dir)
+
+
+def test_get_scores(bm25_index):
+    bm25 = BM25Okapi(TEST_TOKENS)
+    for query in TEST_QUERIES:
+        assert np.allclose(bm25_index.get_scores(query), bm25.get_scores(query))
+
+
+def test_top_k(bm25_index):
+    bm25 = BM25Okapi(TEST_TOKENS)
+    for query in TEST_QUERIES:
+        ids, scores = bm25_index.top_k(query, top_k=10)
+        assert len(ids) == len(scores) == 10
+        assert scores == sorted(scores, reverse=True)
+        assert np.allclose(scores, sorted(bm25.get_scores(query), reverse=True)[:10])
+
+
+def test_top_k_allowed_ids(saved_bm25_index):
+    for start in range(0, len(TEST_TOKENS), 50):
+        saved_bm25_index.add(TEST_TOKENS[start:start + 50], TEST_IDS[start:start + 50])
+    saved_bm25_index.delete(TEST_IDS[:10])
+    allowed_ids = TEST_IDS[::7] + ['not_exist_id']
+    for query in TEST_QUERIES:
+        ids, scores = saved_bm25_index.top_k(query, top_k=10, allowed_ids=allowed_ids)
+        all_ids, all_scores = saved_bm25_index.top_k(query, top_k=len(TEST_TOKENS))
+        expected = [(_id, score) for _id, score in zip(all_ids, all_scores) if _id in allowed_ids][:10]
+        assert len(ids) == len(expected)
+        assert np.allclose(scores, [score for _, score in expected])
+        assert set(ids) <= set(allowed_ids) - set(TEST_IDS[:10])
+    assert saved_bm25_index.top_k(TEST_QUERIES[0], top_k=10, allowed_ids=[]) == ([], [])
+
+
+def test_dynamic_pruning(saved_bm25_index):
+    bm25 = BM25Okapi(TEST_TOKENS)
+    for start in range(0, len(TEST_TOKENS), 50):
+        saved_bm25_index.add(TEST_TOKENS[start:start + 50], TEST_IDS[start:start + 50])
+    queries = TEST_QUERIES + [[0, 1, 2, 3, 4, 5]] + [[7]]
+    for mode in ['wand', 'bmw']:
+        saved_bm25_index.postings_evaluated = saved_bm25_index.postings_total = 0
+        for query in queries:
+            for top_k in [1, 5, 10, len(TEST_TOKENS) + 1]:
+                ids, scores = saved_bm25_index.top_k(query, top_k=top_k, mode=mode)
+                expected = sorted(bm25.get_scores(query), reverse=True)[:top_k]
+                assert np.allclose(scores, expected)
+                assert len(set(ids)) == len(ids)
+        assert saved_bm25_index.postings_evaluated < saved_bm25_index.postings_total
+    with pytest.raises(ValueError):
+        saved_bm25_index.top_k(queries[0], mode='invalid_mode')
+
+
+def test_top_k_batch(bm25_index):
+    bm25 = BM25Okapi(TEST_TOKENS)
+    batch_ids, batch_scores = bm25_index.top_k_batch(TEST_QUERIES, top_k=10)
+    assert len(batch_ids) == len(batch_scores) == len(TEST_QUERIES)
+    for query, ids, scores in zip(TEST_QUERIES, batch_ids, batch_scores):
+        assert len(ids) == len(scores) == 10
+        assert np.allclose(scores, sorted(bm25.get_scores(query), reverse=True)[:10])
+    # weight matrices are not kept by default
+    assert all(segment._weight_cache is None for segment in bm25_index.segments)
+
+
+def test_weight_matrix_cache():
+    index = BM25Index(merge_factor=2, background_merge=False, cache_weight_matrix=True)
+    for start in range(0, len(TEST_TOKENS), 100):
+        index.add(TEST_TOKENS[start:start + 100], TEST_IDS[start:start + 100])
+    expected = index.top_k_batch(TEST_QUERIES, top_k=10)
+    targets = list(index.segments)
+    assert all(segment._weight_cache is not None for segment in targets)
+    assert index.top_k_batch(TEST_QUERIES, top_k=10) == expected
+    index.merge()
+    # merged segments are retired, so their caches are dropped
+    assert all(segment._weight_cache is None for segment in targets)
+    # passages of same score can be retrieved in any order, so compare scores
+    assert np.allclose(index.top_k_batch(TEST_QUERIES, top_k=10)[1], expected[1])
+
+
+def test_segments(saved_bm25_index):
+    bm25 = BM25Okapi(TEST_TOKENS)
+    for start in range(0, len(TEST_TOKENS), 20):
+        saved_bm25_index.add(TEST_TOKENS[start:start + 20], TEST_IDS[start:start + 20])
+    assert len(saved_bm25_index) == len(TEST_TOKENS)
+    assert len(saved_bm25_index.segments) == 10
+    saved_bm25_index.merge()
+    assert len(saved_bm25_index.segments) < 10
+    assert len(os.listdir(saved_bm25_index.segment_dir)) == len(saved_bm25_index.segments)
+    for query in TEST_QUERIES:
+        assert np.allclose(saved_bm25_index.get_scores(query), bm25.get_scores(query))
+
+    loaded = BM25Index.load(saved_bm25_index.save_path)
+    assert len(loaded) == len(TEST_TOKENS)
+    assert isinstance(loaded.segments[0].doc_bytes, np.memmap)
+    for query in TEST_QUERIES:
+        assert loaded.top_k(query, top_k=10) == saved_bm25_index.top_k(query, top_k=10)
+    batch_ids, batch_scores = loaded.top_k_batch(TEST_QUERIES, top_k=10)
+    for query, scores in zip(TEST_QUERIES, batch_scores):
+        assert np.allclose(scores, sorted(bm25.get_scores(query), reverse=True)[:10])
+
+
+def test_delete(saved_bm25_index):
+    for start in range(0, len(TEST_TOKENS), 40):
+        saved_bm25_index.add(TEST_TOKENS[start:start + 40], TEST_IDS[start:start + 40])
+    deleted_ids = TEST_IDS[::3] + ['not_exist_id']
+    assert saved_bm25_index.delete(deleted_ids) == len(TEST_IDS[::3])
+    assert saved_bm25_index.delete(deleted_ids) == 0
+    live = [i for i in range(len(TEST_TOKENS)) if TEST_IDS[i] not in deleted_ids]
+    live_tokens = [TEST_TOKENS[i] for i in live]
+    upserted_tokens = [[random.randint(0, 300) for _ in range(20)] for _ in range(5)]
+    upserted_ids = [TEST_IDS[live[i]] for i in range(5)]
+    saved_bm25_index.upsert(upserted_tokens, upserted_ids)
+    live_ids = [TEST_IDS[i] for i in live[5:]] + upserted_ids
+    live_tokens = live_tokens[5:] + upserted_tokens
+
+    def validate(index):
+        bm25 = BM25Okapi(live_tokens)
+        assert len(index) == len(live_tokens)
+        for query in TEST_QUERIES:
+            # merge may change doc ordinal order of segments
+            expected = sorted(bm25.get_scores(query), reverse=True)
+            assert np.allclose(sorted(index.get_scores(query), reverse=True), expected)
+            for mode in BM25Index.MODES:
+                ids, scores = index.top_k(query, top_k=len(TEST_TOKENS), mode=mode)
+                assert np.allclose(scores, expected)
+                assert sorted(ids) == sorted(live_ids)
+        batch_ids, batch_scores = index.top_k_batch(TEST_QUERIES, top_k=len(TEST_TOKENS))
+        for query, ids, scores in zip(TEST_QUERIES, batch_ids, batch_scores):
+            assert np.allclose(scores, sorted(bm25.get_scores(query), reverse=True))
+            assert sorted(ids) == sorted(live_ids)
+
+    validate(saved_bm25_index)
+    validate(BM25Index.load(saved_bm25_index.save_path))
+    saved_bm25_index.merge()
+    assert sum(len(segment) for segment in saved_bm25_index.segments) < len(TEST_TOKENS) + len(upserted_tokens)
+    validate(saved_bm25_index)
+    validate(BM25Index.load(saved_bm25_index.save_path))
+
+
+def test_migrate(saved_bm25_index):
+    save_path = saved_bm25_index.save_path
+    with open(save_path, 'wb') as f:
+        pickle.dump({"tokens": TEST_TOKENS, "passage_id": TEST_IDS}, f)
+    try:
+        with pytest.raises(ValueError):
+            BM25Index.load(save_path)
+        # loading does not write any file
+        assert not os.path.exists(saved_bm25_index.segment_dir)
+        assert BM25Index.migrate(save_path)
+        assert not BM25Index.migrate(save_path)
+        migrated = BM25Index.load(save_path, background_merge=False)
+        assert len(migrated.segments) == 1
+        assert np.allclose(migrated.get_scores(TEST_QUERIES[0]), BM25Okapi(TEST_TOKENS).get_scores(TEST_QUERIES[0]))
+    finally:
+        if os.path.exists(f'{save_path}.lock'):
+            os.remove(f'{save_path}.lock')
+
+
+def test_passage_id_table():
+    ids = [uuid4(), 'test_id', uuid4(), '테스트_아이디']
+    table = PassageIdTable.from_list(ids)
+    assert list(table) == ids
+    concat_table = PassageIdTable.concat([table, PassageIdTable.from_list(ids[:2])])
+    assert list(concat_table) == ids + ids[:2]
+    assert isinstance(concat_table[4], type(ids[0]))
+    assert concat_table.isin([ids[1], str(ids[0])]).tolist() == [True, True, False, False, True, True]
+    assert concat_table.ordinals([ids[1], str(ids[0]), 'missing_id']).tolist() == [0, 1, 4, 5]
+    assert concat_table.ordinals([]).tolist() == []
+    assert list(concat_table.select(np.array([3, 1]))) == [ids[3], ids[1]]
+
+
+def test_compressed_postings():
+    values = np.array([0, 1, 127, 128, 16383, 16384, 2 ** 31 - 1, 5], dtype=np.int64)
+    encoded = varbyte_encode(values)
+    assert encoded.dtype == np.uint8
+    assert np.array_equal(varbyte_decode(encoded), values)
+
+    tokens = TEST_TOKENS * 10
+    segment = BM25Segment.from_tokens(tokens, TEST_IDS * 10)
+    for term in range(segment.vocab_size):
+        docs, freqs = segment.postings(term)
+        expected_docs = [doc for doc, token in enumerate(tokens) if term in token]
+        assert docs.tolist() == expected_docs
+        assert freqs.tolist() == [tokens[doc].count(term) for doc in expected_docs]
+    assert segment.block_ptr[-1] > segment.vocab_size  # some terms have several blocks
+    blocks = np.array([1, 3, 4])
+    docs, _ = segment.decode_blocks(blocks)
+    all_docs, _ = segment.postings()
+    block_term = np.searchsorted(segment.block_ptr, blocks, side='right') - 1
+    block_start = segment.term_ptr[block_term] + (blocks - segment.block_ptr[block_term]) * BM25Segment.BLOCK_SIZE
+    expected = np.concatenate([all_docs[start:min(start + BM25Segment.BLOCK_SIZE, segment.term_ptr[term + 1])]
+                               for start, term in zip(block_start, block_term)])
+    assert np.array_equal(docs, expected)
+    assert segment.nbytes < 8 * len(all_docs)
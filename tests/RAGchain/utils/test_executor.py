@@ -0,0 +1,66 @@
+import threading
+
+import pytest
+
+from RAGchain.utils.executor import RetrievalExecutor
+
+
+@pytest.fixture
+def executor():
+    executor = RetrievalExecutor(max_workers=2, max_queue_size=1, thread_name_prefix='test-retrieval')
+    yield executor
+    executor.shutdown()
+
+
+def test_submit(executor):
+    futures = [executor.submit(pow, 2, i) for i in range(5)]
+    assert [future.result() for future in futures] == [2 ** i for i in range(5)]
+    with pytest.raises(ZeroDivisionError):
+        executor.submit(lambda: 1 / 0).result()
+    executor.shutdown()
+    metrics = executor.metrics()
+    assert metrics['submitted'] == 6
+    assert metrics['completed'] == 5
+    assert metrics['failed'] == 1
+    assert metrics['queue_depth'] == 0
+    assert metrics['running'] == 0
+
+
+def test_queue_bound(executor):
+    release = threading.Event()
+    futures = [executor.submit(release.wait) for _ in range(3)]
+    submitted = threading.Event()
+
+    def submit_more():
+        futures.append(executor.submit(release.wait))
+        submitted.set()
+
+    thread = threading.Thread(target=submit_more)
+    thread.start()
+    # two tasks run and one task waits, so the queue is full
+    assert not submitted.wait(0.2)
+    assert executor.metrics()['queue_depth'] == 1
+    release.set()
+    thread.join()
+    assert all(future.result() for future in futures)
+    assert executor.metrics()['max_queue_depth'] >= 1
+
+
+def test_nested_submit(executor):
+    def nested():
+        assert threading.current_thread().name.startswith('test-retrieval')
+        # waiting for tasks at threads of the same executor must not deadlock
+        return sum(future.result() for future in [executor.submit(abs, -1) for _ in range(4)])
+
+    assert [future.result() for future in [executor.submit(nested) for _ in range(2)]] == [4, 4]
+
+
+def test_shared_executor():
+    executor = RetrievalExecutor.get()
+    assert RetrievalExecutor.get() is executor
+    configured = RetrievalExecutor.configure(max_workers=3, thread_name_prefix='test-shared')
+    try:
+        assert RetrievalExecutor.get() is configured is not executor
+        assert configured.metrics()['max_workers'] == 3
+    finally:
+        RetrievalExecutor.configure()
@@ -2,13 +2,13 @@ import logging
 
 import pytest
 
-from RAGchain.utils.linker import RedisDBSingleton
+from RAGchain.utils.linker import LinkerFactory
 
 logger = logging.getLogger(__name__)
 
 
 @pytest.hookimpl(tryfirst=True)
 def pytest_sessionfinish(session, exitstatus):
-    r = RedisDBSingleton()
+    r = LinkerFactory().get()
     r.flush_db()
-    logger.info("Pytest Session End. Flushing Redis DB")
+    logger.info("Pytest Session End. Flushing linker")